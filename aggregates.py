@@ -0,0 +1,429 @@
+#!/usr/bin/python3
+
+# aggregates.py
+
+# Running hourly and daily statistics of inverter data, updated with every
+# data block as it arrives, and kept in small summary files, so daily yield,
+# peak power or phase and string balance don't need a scan of all samples.
+# Usage: python3 aggregates.py <summary file> [start [end [field,...]]]
+# e.g. python3 aggregates.py /root/delta/1-1234-daily.sum 2018-03-01 2018-04-01 ac1P,ac2P,ac3P
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Usage from a collector:
+#
+#   summary = aggregates.Summary(decoder.rpi_m, "/root/delta/1-<serial>")
+#   summary.add(time, summary.selection.decode(data, offset))     # For every reply
+#   summary.flush()                                              # Now and then
+#
+# For every hour and day (local time) a summary keeps:
+#
+#  - the energy produced, integrated from 'power' with the trapezoidal rule
+#    (in Wh, not the kWh resolution of 'energytotal'). Gaps of more than
+#    'maxgap' seconds between samples are not integrated,
+#  - the energy produced according to the increase of 'energytotal_day',
+#  - the peak of 'power' and when it occurred,
+#  - the mean, minimum and maximum of 'power' and the voltage, current and
+#    power of each AC phase and DC string.
+#
+# Hours and days are appended to <path>-hourly.sum and <path>-daily.sum
+# when they are complete. The current hour and day are also written (and
+# overwritten) at the end of these files on every flush, so they survive a
+# restart. A summary file is:
+#
+#  - 8 bytes magic, b'SLVSUM01'
+#  - 4 bytes period in seconds (3600 or 86400)
+#  - 2 bytes number of fields, 2 bytes length of the field names
+#  - the field names, separated by commas
+#
+# followed by fixed-size records (little-endian), sorted by time: the start
+# of the period (seconds since the epoch, double), number of samples
+# (32-bit), integrated seconds (double, so flushes and restarts don't round
+# it), integrated energy and 'energytotal_day' increase in Wh (floats), the
+# last 'energytotal_day', peak power (float) and its time (double), and for
+# each field its mean, minimum and maximum as 32-bit floats. That's 236
+# bytes per hour for an RPI M inverter, about 2 MB per year of hours, and a
+# year of days is about 86 kB.
+
+
+import bisect
+import collections
+import datetime
+import math
+import os
+import struct
+import sys
+
+MAGIC = b'SLVSUM01'
+HEADER = struct.Struct('<8sIHH')        # Magic, period, number of fields, length of the names
+RECORD = struct.Struct('<dIdffIfd')     # Start, samples, seconds, energy, counter increase, last counter, peak, time of peak
+STAT = struct.Struct('<fff')            # Mean, minimum and maximum of a field
+
+PERIODS = (('hourly', 3600), ('daily', 86400))
+
+# Fields with statistics, if the data block has them: total AC power, and each AC phase and DC string
+
+FIELDS = ('power',
+          'ac1V', 'ac1I', 'ac1P', 'ac2V', 'ac2I', 'ac2P', 'ac3V', 'ac3I', 'ac3P',
+          'dc1V', 'dc1I', 'dc1P', 'dc2V', 'dc2I', 'dc2P')
+
+PHASES = ('ac1P', 'ac2P', 'ac3P')
+STRINGS = ('dc1P', 'dc2P')
+
+Aggregate = collections.namedtuple('Aggregate', 'start samples seconds energy counter counter_last peak peak_time stats')
+
+
+def period_start (t, step):
+
+    """ Return the start of the local hour or day that datetime t is in """
+
+    if step == 86400:
+        return t.replace(hour=0, minute=0, second=0, microsecond=0)
+    return t.replace(minute=0, second=0, microsecond=0)
+
+
+def imbalance (aggregate, names):
+
+    """
+    Return the spread between the highest and lowest mean of the given fields
+    (e.g. PHASES or STRINGS), as a fraction of their average, or None
+    """
+
+    means = [aggregate.stats[name][0] for name in names if name in aggregate.stats]
+    if len(means) < 2 or not sum(means):
+        return None
+    return (max(means) - min(means)) / (sum(means) / len(means))
+
+
+class Period:
+
+    """ Running statistics of one hour or day """
+
+    def __init__ (self, start, width):
+
+        self.start = start              # Datetime at the start of the period
+        self.count = 0
+        self.seconds = 0.0              # Time covered by the energy integration
+        self.energy = 0.0               # Wh, integrated from power
+        self.counter = 0.0              # Wh, increase of energytotal_day
+        self.counter_last = 0           # Last energytotal_day seen, to continue after a restart
+        self.peak = -math.inf
+        self.peak_time = None
+        self.sum = [0.0] * width
+        self.low = [math.inf] * width
+        self.high = [-math.inf] * width
+
+    @classmethod
+    def resume (cls, aggregate, names):
+
+        """ Continue a period from a stored record """
+
+        period = cls(datetime.datetime.fromtimestamp(aggregate.start), len(names))
+        period.count = aggregate.samples
+        period.seconds = aggregate.seconds
+        period.energy = aggregate.energy
+        period.counter = aggregate.counter
+        period.counter_last = aggregate.counter_last
+        if aggregate.peak_time:
+            period.peak = aggregate.peak
+            period.peak_time = aggregate.peak_time
+        for idx, name in enumerate(names):
+            mean, low, high = aggregate.stats[name]
+            if period.count:
+                period.sum[idx] = mean * period.count
+                period.low[idx] = low
+                period.high[idx] = high
+        return period
+
+    def add (self, t, values):
+        self.count += 1
+        for idx, value in enumerate(values):
+            self.sum[idx] += value
+            if value < self.low[idx]:
+                self.low[idx] = value
+            if value > self.high[idx]:
+                self.high[idx] = value
+
+    def pack (self):
+        record = RECORD.pack(self.start.timestamp(), self.count, self.seconds, self.energy, self.counter,
+                             self.counter_last, max(self.peak, 0),
+                             self.peak_time.timestamp() if self.peak_time else 0)
+        if not self.count:
+            return record + b''.join(STAT.pack(math.nan, math.nan, math.nan) for total in self.sum)
+        return record + b''.join(STAT.pack(total / self.count, low, high)
+                                 for total, low, high in zip(self.sum, self.low, self.high))
+
+
+class SummaryFile:
+
+    """ A file of fixed-size summary records for one period length """
+
+    def __init__ (self, fname, step, names):
+
+        self.fname = fname
+        self.step = step
+        self.names = list(names)
+        self.size = RECORD.size + STAT.size * len(self.names)
+
+        header = ",".join(self.names).encode('ascii')
+        new = not os.path.isfile(fname) or not os.path.getsize(fname)
+        self.file = open(fname, "w+b" if new else "r+b")
+
+        if new:
+            self.file.write(HEADER.pack(MAGIC, step, len(self.names), len(header)) + header)
+            self.file.flush()
+        elif read_header(self.file) != (step, self.names):
+            self.file.close()
+            raise ValueError(fname + " is not a summary file with these fields and period")
+
+        self.offset = HEADER.size + len(header)
+        self.file.seek(0, os.SEEK_END)
+        self.count = (self.file.tell() - self.offset) // self.size     # Drop a partly written record at the end
+
+    def last (self):
+
+        """ Return the last record, or None """
+
+        if not self.count:
+            return None
+        self.file.seek(self.offset + (self.count - 1) * self.size)
+        return unpack(self.file.read(self.size), self.names)
+
+    def put (self, period):
+
+        """ Write a period: overwrite the last record if it is the same period, else append it """
+
+        last = self.last()
+        position = self.count
+        if last and last.start == period.start.timestamp():
+            position -= 1
+        elif last and last.start > period.start.timestamp():
+            return                          # The clock went back, don't break the order
+        self.file.seek(self.offset + position * self.size)
+        self.file.write(period.pack())
+        self.count = position + 1
+
+    def flush (self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close (self):
+        self.flush()
+        self.file.close()
+
+
+def read_header (f):
+
+    """ Return the period and field names of an open summary file """
+
+    f.seek(0)
+    magic, step, fields, length = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(getattr(f, 'name', 'File') + " is not a summary file")
+    names = f.read(length).decode('ascii').split(",") if fields else []
+    return step, names
+
+
+def unpack (data, names):
+    values = RECORD.unpack_from(data)
+    stats = {name: STAT.unpack_from(data, RECORD.size + idx * STAT.size) for idx, name in enumerate(names)}
+    return Aggregate(*values[:7], datetime.datetime.fromtimestamp(values[7]) if values[7] else None, stats)
+
+
+class Summary:
+
+    """
+    Hourly and daily statistics for one inverter. With a path, periods are
+    kept in <path>-hourly.sum and <path>-daily.sum.
+    """
+
+    def __init__ (self, dec, path=None, maxgap=900):
+
+        self.dec = dec
+        self.names = [name for name in FIELDS if name in dec.index]
+        self.selection = dec.select(tuple(self.names) + tuple(name for name in ('energytotal_day',)
+                                                               if name in dec.index and name not in self.names))
+        scales = {dec.header[idx]: (mul, div) for idx, mul, div, unit in dec.scales}
+        self.scales = [scales.get(name, (1, 1)) for name in self.names]
+        self.maxgap = maxgap            # Longest time between samples to integrate power over
+
+        self.files = {}
+        self.periods = {}               # Current Period of each length
+        if path:
+            for suffix, step in PERIODS:
+                self.files[step] = SummaryFile(path + "-" + suffix + ".sum", step, self.names)
+
+        self.last_time = None           # Time and power of the previous sample
+        self.last_power = None
+        self.counter_last = None        # energytotal_day of the previous sample
+
+    def add (self, t, record):
+
+        """
+        Update the statistics with a sample at datetime t: a record from the
+        decoder or selection.decode() (anything with the fields as attributes)
+        """
+
+        values = [getattr(record, name) for name in self.names]
+        values = [value / div if div > 1 else value * mul for value, (mul, div) in zip(values, self.scales)]
+        power = values[0] if self.names and self.names[0] == 'power' else None
+        counter = getattr(record, 'energytotal_day', None)
+
+        # Integrate power since the previous sample, split at the start of a new hour
+
+        segments = []
+        if power is not None and self.last_time is not None and 0 < (t - self.last_time).total_seconds() <= self.maxgap:
+            boundary = period_start(t, 3600)
+            if self.last_time < boundary:
+                fraction = (boundary - self.last_time) / (t - self.last_time)
+                middle = self.last_power + fraction * (power - self.last_power)
+                segments.append((self.last_time, boundary, self.last_power, middle))
+                segments.append((boundary, t, middle, power))
+            else:
+                segments.append((self.last_time, t, self.last_power, power))
+
+        for suffix, step in PERIODS:
+
+            start = period_start(t, step)
+            period = self.periods.get(step)
+
+            if period is None:
+                period = self.periods[step] = self._resume(step, start)
+                if self.counter_last is None and period.count:
+                    self.counter_last = period.counter_last
+            elif period.start != start:
+                for begin, end, first, second in segments:
+                    if begin < start:
+                        self._integrate(period, begin, end, first, second)
+                self._complete(step, period)
+                self.periods[step] = Period(start, len(self.names))
+
+        # The daily counter restarts when the inverter starts up in the morning
+
+        increase = 0
+        if counter is not None and self.counter_last is not None:
+            increase = counter - self.counter_last if counter >= self.counter_last else counter
+
+        for period in self.periods.values():
+            for begin, end, first, second in segments:
+                if begin >= period.start:
+                    self._integrate(period, begin, end, first, second)
+            if counter is not None:
+                period.counter += increase
+                period.counter_last = counter
+            if power is not None and power > period.peak:
+                period.peak = power
+                period.peak_time = t
+            period.add(t, values)
+
+        if counter is not None:
+            self.counter_last = counter
+        self.last_time = t
+        self.last_power = power
+
+    def _integrate (self, period, begin, end, first, second):
+        seconds = (end - begin).total_seconds()
+        period.seconds += seconds
+        period.energy += (first + second) / 2 * seconds / 3600
+
+    def _resume (self, step, start):
+
+        """ Continue the stored period that starts at start, if any """
+
+        f = self.files.get(step)
+        last = f.last() if f else None
+        if last and last.start == start.timestamp():
+            return Period.resume(last, self.names)
+        return Period(start, len(self.names))
+
+    def _complete (self, step, period):
+        if step in self.files:
+            self.files[step].put(period)
+
+    def current (self, step=86400):
+
+        """ Return the statistics of the current day or hour so far, as an Aggregate """
+
+        period = self.periods.get(step)
+        return unpack(period.pack(), self.names) if period else None
+
+    def flush (self):
+
+        """ Write the current periods, and make sure the files are on disk """
+
+        for step, f in self.files.items():
+            if step in self.periods:
+                f.put(self.periods[step])
+            f.flush()
+
+    def close (self):
+        self.flush()
+        for f in self.files.values():
+            f.file.close()
+        self.files = {}
+
+
+def read (fname, start=None, end=None):
+
+    """
+    Yield the Aggregates in a summary file for the periods that start from
+    start up to end (datetimes), found with a binary search
+    """
+
+    with open(fname, "rb") as f:
+
+        step, names = read_header(f)
+        size = RECORD.size + STAT.size * len(names)
+        offset = f.tell()
+        count = (os.fstat(f.fileno()).st_size - offset) // size
+
+        class Starts:
+            def __len__ (self):
+                return count
+            def __getitem__ (self, idx):
+                f.seek(offset + idx * size)
+                return struct.unpack('<d', f.read(8))[0]
+
+        first = bisect.bisect_left(Starts(), start.timestamp()) if start else 0
+        f.seek(offset + first * size)
+
+        for idx in range(first, count):
+            aggregate = unpack(f.read(size), names)
+            if end and aggregate.start >= end.timestamp():
+                break
+            yield aggregate
+
+
+def main ():
+
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<summary file> [start [end [field,...]]]", file=sys.stderr)
+        sys.exit(1)
+
+    start = datetime.datetime.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] else None
+    end = datetime.datetime.fromisoformat(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3] else None
+    fields = sys.argv[4].split(",") if len(sys.argv) > 4 else []
+
+    print("\t".join(["start", "samples", "energy_Wh", "counter_Wh", "peak_W", "peak_time", "phase_imbalance",
+                     "string_imbalance"] + [field + suffix for field in fields for suffix in ("", "_min", "_max")]))
+    total = 0.0
+
+    for aggregate in read(sys.argv[1], start, end):
+        row = [datetime.datetime.fromtimestamp(aggregate.start).isoformat(), str(aggregate.samples),
+               "%.1f" % aggregate.energy, "%.0f" % aggregate.counter, "%.0f" % aggregate.peak,
+               aggregate.peak_time.isoformat() if aggregate.peak_time else ""]
+        for names in (PHASES, STRINGS):
+            spread = imbalance(aggregate, names)
+            row.append("%.3f" % spread if spread is not None else "")
+        for field in fields:
+            row.extend("%.10g" % value for value in aggregate.stats[field])
+        print("\t".join(row))
+        total += aggregate.energy
+
+    print("Total:", "%.1f" % total, "Wh", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
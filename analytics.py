@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+
+# analytics.py
+
+# Fleet-wide analytics of stored samples with NumPy: conversion efficiency,
+# string mismatch, phase imbalance, clipping, temperature derating and
+# yield compared to the rest of the fleet, per time bucket and inverter.
+# Usage: python3 analytics.py <directory> [start [end [bucket-seconds]]]
+# e.g. python3 analytics.py /root/delta/ 2018-06-01 2018-09-01 86400
+# reports every inverter with samples in the directory (tab-separated
+# files, or directories of binstore or deltastore segments).
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Usage from Python:
+#
+#   fleet = analytics.Fleet(datetime.datetime(2018, 1, 1), datetime.datetime(2019, 1, 1), 3600)
+#   fleet.load("/root/delta/")                  # Or fleet.add(name, times, values) for each inverter
+#   metrics = fleet.metrics()                   # {metric: array of inverters x buckets}
+#
+# The history of each inverter is loaded into arrays once, scaled to its
+# units, and reduced to time-weighted sums per bucket (energy from power
+# with the trapezoidal rule, gaps of more than 'maxgap' seconds are not
+# counted). Only these sums are kept, so a year of 1-minute samples of a
+# fleet needs little more memory than the history of one inverter. The
+# metrics are then computed for all inverters and buckets at once:
+#
+#  - efficiency: AC energy / DC energy of both strings,
+#  - mismatch: spread between the highest and lowest string energy as a
+#    fraction of their average, like aggregates.imbalance(),
+#  - imbalance: the same for the AC phases,
+#  - clipping: fraction of the producing time at 'clip' x rating or more.
+#    The rating is the highest power in the history, unless it is given,
+#  - temperature: mean temperature while producing,
+#  - relative: energy per W of rating compared to the median of the fleet,
+#  - derating: the shortfall (1 - relative) in buckets where the mean
+#    temperature while producing was 'deratetemp' or more, otherwise 0.
+#
+# Metrics are NaN where they are undefined, e.g. at night, or for a string
+# or phase that produced nothing at all in the whole history (not connected).
+
+
+import datetime
+import os
+import re
+import sys
+import warnings
+
+import numpy
+
+import aggregates
+import binstore
+import decoder
+import deltastore
+import query
+
+FIELDS = ('power', 'temp') + aggregates.PHASES + aggregates.STRINGS
+METRICS = ('energy', 'efficiency', 'mismatch', 'imbalance', 'clipping', 'temperature', 'relative', 'derating')
+
+# Exponent (10^x) of every variable with a unit, to scale the raw values in tab-separated files
+
+exponents = {var[0]: var[3] for dec in decoder.decoders for var in dec.layout if len(var) > 4}
+
+verbose = 0
+
+
+def _scale (name, values):
+    exponent = exponents.get(name, 0)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    return values / 10 ** -exponent if exponent < 0 else values * 10 ** exponent
+
+
+def load_csv (fname, start=None, end=None, names=FIELDS):
+
+    """
+    Return the times (seconds since the epoch) and a dictionary with the
+    scaled values of the given fields of a tab-separated sample file
+    """
+
+    index = query.LogIndex(fname)
+    header = index.fields()
+    columns = {name: header.index(name) for name in names if name in header}
+    rows = [(t, [row[idx] for idx in columns.values()]) for t, row in index.rows(start, end)]
+
+    times = numpy.array([t for t, values in rows], dtype=numpy.float64)
+    data = numpy.array([values for t, values in rows], dtype=numpy.float64).reshape(len(rows), len(columns))
+    return times, {name: _scale(name, data[:, n]) for n, name in enumerate(columns)}
+
+
+def load_segments (path, start=None, end=None, names=FIELDS):
+
+    """
+    Return the times and a dictionary with the scaled values of the given
+    fields of the binstore (.bin) or deltastore (.dlt) segments in a directory
+    """
+
+    times = []
+    data = {}
+    first = datetime.datetime.fromtimestamp(start) if start is not None else None
+    last = datetime.datetime.fromtimestamp(end) if end is not None else None
+
+    for fname in binstore.segments(path, first, last):
+        records = binstore.read_numpy(fname)
+        keep = numpy.ones(len(records), dtype=bool)
+        if start is not None:
+            keep &= records['time'] >= start
+        if end is not None:
+            keep &= records['time'] < end
+        times.append(records['time'][keep])
+        for name in names:
+            if name in records.dtype.names:
+                data.setdefault(name, []).append(records[name][keep])
+
+    for fname in binstore.segments(path, first, last, deltastore.EXT):
+        rows = list(deltastore.read_segment(fname, start, end))
+        if not rows:
+            continue
+        dec = rows[0][1]
+        times.append(numpy.array([t for t, dec, record in rows]))
+        for name in names:
+            if name in dec.index:
+                idx = dec.index[name]
+                data.setdefault(name, []).append(numpy.array([record[idx] for t, dec, record in rows]))
+
+    if not times:
+        return numpy.zeros(0), {}
+    times = numpy.concatenate(times).astype(numpy.float64)
+    order = numpy.argsort(times, kind='stable')     # Binary and delta segments of the same day
+    return times[order], {name: _scale(name, numpy.concatenate(values))[order] for name, values in data.items()
+                          if sum(len(v) for v in values) == len(times)}
+
+
+def histories (path):
+
+    """ Return (name, path) of the sample files and segment directories in a directory, e.g. ('1-1234', ...) """
+
+    found = []
+    for name in sorted(os.listdir(path)):
+        fname = os.path.join(path, name)
+        if os.path.isdir(fname) and re.fullmatch(r'\d+-[^-]+', name):
+            found.append((name, fname))
+        elif re.fullmatch(r'\d+-[^-]+\.csv', name):      # Not ring store tiers, <bus ID>-<serial>-<step>s.csv
+            found.append((name[:-len('.csv')], fname))
+    return found
+
+
+class Fleet:
+
+    """
+    Sums per time bucket of the samples of a fleet of inverters, from start up
+    to end (datetimes) in buckets of 'bucket' seconds, and the metrics computed
+    from them. See the top of this file.
+    """
+
+    sums = ('seconds', 'producing', 'ac', 'dc', 'clipped', 'heat') + aggregates.STRINGS + aggregates.PHASES
+
+    def __init__ (self, start, end, bucket=3600, maxgap=900, clip=0.98, deratetemp=60, minenergy=1.0):
+
+        self.start = start.timestamp()
+        self.bucket = bucket
+        self.buckets = int(-(-(end.timestamp() - self.start) // bucket))
+        self.maxgap = maxgap
+        self.clip = clip                # Fraction of the rating above which power counts as clipped
+        self.deratetemp = deratetemp    # Temperature (C) from which a shortfall in yield counts as derating
+        self.minenergy = minenergy      # Wh of DC energy in a bucket below which ratios are not computed
+
+        self.names = []
+        self.ratings = []
+        self.produced = []              # Strings and phases of each inverter that produced anything
+        self.rows = {name: [] for name in self.sums}
+
+    def times (self):
+
+        """ Return the start of every bucket (seconds since the epoch) """
+
+        return self.start + self.bucket * numpy.arange(self.buckets)
+
+    def add (self, name, times, values, rating=None):
+
+        """
+        Add the history of an inverter: times (seconds since the epoch, sorted)
+        and a dictionary with arrays of the values of FIELDS, scaled to their units
+        """
+
+        times = numpy.asarray(times, dtype=numpy.float64)
+        missing = numpy.full(len(times), numpy.nan)
+        power = values.get('power', missing)
+
+        # Every interval between two samples belongs to the bucket its first sample is in
+
+        seconds = numpy.diff(times)
+        seconds[seconds > self.maxgap] = 0
+        bucket = (times[:-1] - self.start) // self.bucket
+        keep = (bucket >= 0) & (bucket < self.buckets)
+        bucket = bucket[keep].astype(numpy.intp)
+        seconds = seconds[keep]
+
+        def total (weights):
+            return numpy.bincount(bucket, weights=weights, minlength=self.buckets)
+
+        def energy (field):
+            field = values.get(field, missing)
+            return total((field[:-1] + field[1:])[keep] * seconds) / 7200
+
+        if rating is None:
+            rating = numpy.nanmax(power) if len(power) and not numpy.all(numpy.isnan(power)) else numpy.nan
+        producing = seconds * (power[:-1][keep] > 0)
+
+        rows = self.rows
+        rows['seconds'].append(total(seconds))
+        rows['producing'].append(total(producing))
+        rows['ac'].append(energy('power'))
+        rows['clipped'].append(total(producing * (power[:-1][keep] >= self.clip * rating)))
+        rows['heat'].append(total(producing * values.get('temp', missing)[:-1][keep]))
+        for field in aggregates.STRINGS + aggregates.PHASES:
+            rows[field].append(energy(field))
+        rows['dc'].append(sum(rows[field][-1] for field in aggregates.STRINGS))
+
+        self.names.append(name)
+        self.ratings.append(rating)
+        self.produced.append({field for field in aggregates.STRINGS + aggregates.PHASES
+                              if numpy.nansum(rows[field][-1]) > 0})
+
+    def load (self, path, ratings=None):
+
+        """ Add every inverter with samples in a directory, with ratings in W by name, if known """
+
+        start = self.start
+        end = self.start + self.buckets * self.bucket
+
+        for name, fname in histories(path):
+            if os.path.isdir(fname):
+                times, values = load_segments(fname, start, end)
+            else:
+                times, values = load_csv(fname, start, end)
+            if verbose:
+                print("Loaded", len(times), "samples of", name, file=sys.stderr)
+            if len(times):
+                self.add(name, times, values, (ratings or {}).get(name))
+
+    def arrays (self):
+
+        """ Return the sums as arrays of inverters x buckets """
+
+        return {name: numpy.vstack(rows) if rows else numpy.zeros((0, self.buckets)) for name, rows in self.rows.items()}
+
+    def metrics (self, sums=None):
+
+        """
+        Return a dictionary with an array of inverters x buckets for each of
+        METRICS, computed from sums (default: the sums per bucket, but e.g. sums
+        over all buckets with keepdims work as well)
+        """
+
+        if sums is None:
+            sums = self.arrays()
+        ratings = numpy.array(self.ratings, dtype=numpy.float64).reshape(-1, 1)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)         # Median of buckets without production
+
+            active = sums['dc'] >= self.minenergy
+            efficiency = numpy.where(active, sums['ac'] / sums['dc'], numpy.nan)
+
+            specific = numpy.where(sums['producing'] > 0, sums['ac'] / ratings, numpy.nan)
+            relative = specific / numpy.nanmedian(specific, axis=0) if len(specific) else specific
+            temperature = numpy.where(sums['producing'] > 0, sums['heat'] / sums['producing'], numpy.nan)
+            derating = numpy.where(temperature >= self.deratetemp, numpy.clip(1 - relative, 0, 1), 0)
+            derating[numpy.isnan(relative)] = numpy.nan
+
+            return {'energy': sums['ac'],
+                    'efficiency': efficiency,
+                    'mismatch': self._spread(sums, aggregates.STRINGS, active),
+                    'imbalance': self._spread(sums, aggregates.PHASES, sums['ac'] >= self.minenergy),
+                    'clipping': numpy.where(sums['producing'] > 0, sums['clipped'] / sums['producing'], numpy.nan),
+                    'temperature': temperature,
+                    'relative': relative,
+                    'derating': derating}
+
+    def _spread (self, sums, fields, active):
+
+        """ (highest - lowest) / average of the energies of the strings or phases that ever produced """
+
+        connected = numpy.array([[field in produced for produced in self.produced] for field in fields],
+                                dtype=bool).reshape(len(fields), -1, 1)
+        stack = numpy.where(connected, numpy.stack([sums[field] for field in fields]), numpy.nan)
+        count = connected.sum(axis=0)
+        mean = numpy.where(connected, stack, 0).sum(axis=0) / count
+        spread = (numpy.fmax.reduce(stack, axis=0) - numpy.fmin.reduce(stack, axis=0)) / mean
+        return numpy.where(active & (count >= 2), spread, numpy.nan)
+
+    def totals (self):
+
+        """ Return the metrics over all buckets, as arrays with a value per inverter """
+
+        arrays = self.arrays()
+        metrics = self.metrics({name: values.sum(axis=1, keepdims=True) for name, values in arrays.items()})
+        per_bucket = self.metrics(arrays)
+        with numpy.errstate(invalid='ignore'):
+            metrics['derating'] = numpy.nansum(per_bucket['derating'] * arrays['producing'], axis=1,
+                                               keepdims=True) / arrays['producing'].sum(axis=1, keepdims=True)
+        return {name: values[:, 0] for name, values in metrics.items()}
+
+
+def main ():
+
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<directory> [start [end [bucket-seconds]]]", file=sys.stderr)
+        sys.exit(1)
+
+    end = datetime.datetime.now()
+    start = end - datetime.timedelta(days=365)
+    if len(sys.argv) > 2 and sys.argv[2]:
+        start = datetime.datetime.fromisoformat(sys.argv[2])
+    if len(sys.argv) > 3 and sys.argv[3]:
+        end = datetime.datetime.fromisoformat(sys.argv[3])
+    bucket = float(sys.argv[4]) if len(sys.argv) > 4 else 3600
+
+    fleet = Fleet(start, end, bucket)
+    fleet.load(sys.argv[1])
+    totals = fleet.totals()
+    metrics = fleet.metrics()
+
+    print("\t".join(["inverter", "rating W", "energy kWh"] + list(METRICS[1:]) + ["mismatch > 10%", "derated"]))
+    with numpy.errstate(invalid='ignore'):
+        mismatched = (metrics['mismatch'] > 0.1).sum(axis=1)
+        derated = (metrics['derating'] > 0.05).sum(axis=1)
+    for n, name in enumerate(fleet.names):
+        print("\t".join([name, "%.0f" % fleet.ratings[n], "%.1f" % (totals['energy'][n] / 1000)] +
+                        ["%.3f" % totals[metric][n] for metric in METRICS[1:]] +
+                        ["%d buckets" % mismatched[n], "%d buckets" % derated[n]]))
+
+
+if __name__ == "__main__":
+    main()
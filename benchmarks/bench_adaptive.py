@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+# bench_adaptive.py
+
+# Simulate a day of polling a bus of inverters on a virtual clock, with a
+# fixed interval and with scheduler.AdaptiveScheduler. Power follows the sun
+# with passing clouds (fast ramps), and one inverter stops answering in the
+# afternoon. Compare the number of requests, the samples taken while power
+# ramps, and the share of bus time used.
+# Usage: python3 benchmarks/bench_adaptive.py [inverters [interval in seconds]]
+
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import scheduler
+
+DAY = 24 * 3600
+LATENCY = 0.15          # Seconds from request to the end of the reply
+PEAK = 3000             # W at noon on a clear day
+
+
+class Clock:
+    def __init__ (self):
+        self.now = 0.0
+    def __call__ (self):
+        return self.now
+
+
+def clouds (seed):
+
+    """ Return a list of (start, end) of periods with passing clouds """
+
+    rnd = random.Random(seed)
+    return [(start, start + rnd.uniform(300, 1800)) for start in sorted(rnd.uniform(8, 17) * 3600 for n in range(6))]
+
+
+def power (t, shade):
+
+    """ Power in W at time t (seconds since midnight) """
+
+    if not 6 * 3600 < t < 20 * 3600:
+        return 0
+    p = PEAK * math.sin(math.pi * (t - 6 * 3600) / (14 * 3600))
+    for start, end in shade:
+        if start <= t < end:
+            p *= 0.6 + 0.4 * math.cos(2 * math.pi * (t - start) / 120)  # A cloud every two minutes
+    return int(p)
+
+
+def run (polls, clock, inv_ids, adaptive):
+
+    shade = {inv_id: clouds(inv_id) for inv_id in inv_ids}
+    silent = inv_ids[-1]                # Stops answering from 14:00
+    requests = samples = ramping = 0
+    busy = 0.0                          # Seconds of bus time used by requests and replies
+    worst = 0.0                         # Highest estimated utilisation
+
+    while clock.now < DAY:
+
+        clock.now = max(clock.now, polls.next_deadline())
+        inv_id = polls.pop_due()
+        if inv_id is None:
+            clock.now += 0.01
+            continue
+        requests += 1
+
+        if inv_id == silent and clock.now > 14 * 3600:
+            busy += polls.replytimeout
+            continue
+
+        clock.now += LATENCY
+        busy += LATENCY + polls.turnaround
+        polls.received(inv_id)
+        if polls.sample_due(inv_id):
+            p = power(clock.now, shade[inv_id])
+            if adaptive:
+                polls.adapt(inv_id, {'power': p, 'feedintime_day': int(clock.now > 6 * 3600 + 60)})
+                worst = max(worst, polls.utilisation())
+            polls.sampled(inv_id)
+            samples += 1
+            if any(start <= clock.now < end for start, end in shade[inv_id]):
+                ramping += 1
+
+    return requests, samples, ramping, busy / DAY, worst
+
+
+def main ():
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+    inv_ids = list(range(1, count + 1))
+
+    for name in ("fixed", "adaptive"):
+        clock = Clock()
+        if name == "fixed":
+            polls = scheduler.PollScheduler(inv_ids, interval, clock=clock)
+        else:
+            polls = scheduler.AdaptiveScheduler(inv_ids, interval, clock=clock, floor=5, budget=0.5)
+        requests, samples, ramping, used, worst = run(polls, clock, inv_ids, name == "adaptive")
+        print("%-9s %6d requests, %6d samples, %5d while clouds pass, %4.1f%% of bus time" %
+              (name + ":", requests, samples, ramping, 100 * used), end="")
+        print(", at most %.0f%% estimated" % (100 * worst) if worst else "")
+        if name == "adaptive":
+            print(polls.summary())
+            if worst > polls.budget + 0.01:
+                print("MISMATCH: the bus-time budget of %.0f%% was exceeded" % (100 * polls.budget))
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# bench_analytics.py
+
+# Generate a synthetic fleet (by default 100 inverters, a year of samples
+# every minute) with a few faults: a weak string, an unbalanced phase, an
+# oversized array that clips and an inverter that overheats. Reduce it with
+# analytics.Fleet, report the runtime and peak memory, check that the
+# faults are found, and compare with a plain Python loop over the rows of
+# one inverter (already parsed, so this favours the loop). The sun is
+# scaled so the brightest day of the period reaches full power, so the
+# faults show in any period, e.g. only a few days in January.
+# Usage: python3 benchmarks/bench_analytics.py [inverters [days [interval in seconds [bucket in seconds]]]]
+
+import datetime
+import math
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import numpy
+
+import analytics
+
+RATING = 15000          # W, an RPI M15A
+WEAK, UNBALANCED, CLIPPING, HOT = 1, 2, 3, 4     # Inverters with a fault
+
+
+def history (inv, start, days, interval):
+
+    """ Return times and values (scaled, like analytics.load_segments() does) of a synthetic inverter """
+
+    rnd = numpy.random.default_rng(inv)
+    times = start + numpy.arange(0, days * 86400, interval, dtype=numpy.float64)
+    times += rnd.uniform(0, 0.5, len(times))
+
+    day = (times - start) // 86400
+    hour = (times - start) % 86400 / 3600
+    season = 0.55 + 0.45 * numpy.sin(2 * math.pi * (day - 80) / 365)
+    sun = numpy.clip(numpy.sin(math.pi * (hour - 6) / 12), 0, None) * season / season.max()
+    cloud = 1 - 0.5 * (rnd.random(len(times)) < 0.1)
+
+    array = 1.5 if inv == CLIPPING else 1.0     # DC array size compared to the rating
+    dc = RATING * 0.97 * array * sun * cloud    # Healthy inverters peak below the clipping threshold
+    strings = numpy.array([0.5, 0.35 if inv == WEAK else 0.5])
+    temp = 25 + 40 * sun * cloud + (25 if inv == HOT else 0)
+
+    ac = numpy.minimum(dc * 0.97, RATING)
+    if inv == HOT:
+        ac = numpy.where(temp >= 70, ac * 0.8, ac)
+    ac = numpy.floor(ac)
+    phases = numpy.array([0.4, 0.3, 0.3]) if inv == UNBALANCED else numpy.full(3, 1 / 3)
+
+    values = {'power': ac, 'temp': numpy.floor(temp)}
+    for n, field in enumerate(('dc1P', 'dc2P')):
+        values[field] = numpy.floor(dc * strings[n] / strings.sum())
+    for n, field in enumerate(('ac1P', 'ac2P', 'ac3P')):
+        values[field] = numpy.floor(ac * phases[n])
+    return times, values
+
+
+def python_sums (fleet, times, values):
+
+    """ The AC and DC energy per bucket of one inverter, one row at a time """
+
+    ac = [0.0] * fleet.buckets
+    dc = [0.0] * fleet.buckets
+    power = values['power'].tolist()
+    strings = (values['dc1P'] + values['dc2P']).tolist()
+    times = times.tolist()
+
+    for n in range(len(times) - 1):
+        seconds = times[n + 1] - times[n]
+        if seconds > fleet.maxgap:
+            continue
+        bucket = int((times[n] - fleet.start) // fleet.bucket)
+        ac[bucket] += (power[n] + power[n + 1]) * seconds / 7200
+        dc[bucket] += (strings[n] + strings[n + 1]) * seconds / 7200
+
+    return numpy.array(ac), numpy.array(dc)
+
+
+def main ():
+
+    inverters = max(HOT + 1, int(sys.argv[1]) if len(sys.argv) > 1 else 100)     # The faulty ones and a healthy one
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+    interval = float(sys.argv[3]) if len(sys.argv) > 3 else 60
+    bucket = float(sys.argv[4]) if len(sys.argv) > 4 else 3600
+
+    start = datetime.datetime(2018, 1, 1)
+    fleet = analytics.Fleet(start, start + datetime.timedelta(days=days), bucket)
+
+    tracemalloc.start()
+    generating = reducing = 0.0
+    samples = 0
+
+    for inv in range(1, inverters + 1):
+        t0 = time.perf_counter()
+        times, values = history(inv, start.timestamp(), days, interval)
+        t1 = time.perf_counter()
+        fleet.add("%d-%d" % (inv, 1000 + inv), times, values, RATING)
+        reducing += time.perf_counter() - t1
+        generating += t1 - t0
+        samples += len(times)
+        if inv == 1:
+            check = times, values
+        del times, values
+
+    t0 = time.perf_counter()
+    metrics = fleet.metrics()
+    totals = fleet.totals()
+    computing = time.perf_counter() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("%d inverters x %d days every %g s: %d samples (generated in %.1f s)" %
+          (inverters, days, interval, samples, generating))
+    print("Reduced to %d buckets of %g s in %.2f s (%.0f samples/s), metrics in %.2f s" %
+          (fleet.buckets, bucket, reducing, samples / reducing, computing))
+    print("Peak memory %.0f MB traced (sums %.1f MB), %.0f MB resident" %
+          (peak / 1e6, sum(values.nbytes for values in fleet.arrays().values()) / 1e6,
+           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
+
+    t0 = time.perf_counter()
+    ac, dc = python_sums(fleet, *check)
+    elapsed = time.perf_counter() - t0
+    print("Python loop over one inverter: %.2f s, %.0fx the time per inverter with NumPy" %
+          (elapsed, elapsed / (reducing / inverters)))
+
+    for name, inv in (("weak string", WEAK), ("unbalanced phase", UNBALANCED), ("clipping", CLIPPING), ("overheating", HOT)):
+        n = inv - 1
+        print("  %-17s inverter %s: efficiency %.3f, mismatch %.2f, imbalance %.2f, clipping %.2f, derating %.3f" %
+              (name + ":", fleet.names[n], totals['efficiency'][n], totals['mismatch'][n], totals['imbalance'][n],
+               totals['clipping'][n], totals['derating'][n]))
+
+    healthy = numpy.arange(inverters) >= HOT
+    arrays = fleet.arrays()
+    if not (numpy.allclose(ac, arrays['ac'][0]) and numpy.allclose(dc, arrays['dc'][0])
+            and totals['mismatch'][WEAK - 1] > 0.3 > numpy.nanmax(totals['mismatch'][healthy])
+            and totals['imbalance'][UNBALANCED - 1] > 0.2 > numpy.nanmax(totals['imbalance'][healthy])
+            and totals['clipping'][CLIPPING - 1] > 0.05 > numpy.nanmax(totals['clipping'][healthy])
+            and totals['derating'][HOT - 1] > 0.02 > numpy.nanmax(totals['derating'][healthy])
+            and numpy.nanmin(metrics['efficiency'][healthy]) > 0.9):
+        print("MISMATCH: the faults were not found, or the sums differ from the Python loop")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
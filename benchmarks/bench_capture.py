@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+# bench_capture.py
+
+# Write synthetic capture segments (requests and replies of a bus of
+# inverters polled every 10 seconds), check that a crashed writer's segment
+# is repaired, and measure how fast the captures are decoded again with a
+# corrected field map, with one process and with a process per CPU.
+# Usage: python3 benchmarks/bench_capture.py [days [inverters]]
+
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import capture
+import crc16
+import decoder
+import protocol
+from bench_framing import parse_dump, DUMP_RPI_M15A
+
+INTERVAL = 10
+
+
+def reply_for (reply, inv_id):
+    frame = bytearray(reply)
+    frame[2] = inv_id
+    crc = crc16.calcData(bytes(frame[1:-3]))
+    frame[-3] = crc & 0xff
+    frame[-2] = crc >> 8
+    return bytes(frame)
+
+
+def write (path, days, inverters):
+
+    """ Write days of captures, return the number of messages """
+
+    reply = parse_dump(DUMP_RPI_M15A)[9:]
+    replies = {inv_id: reply_for(reply, inv_id) for inv_id in range(1, inverters + 1)}
+    requests = {inv_id: protocol.build_request(inv_id, capture.COMMAND) for inv_id in replies}
+
+    writer = capture.CaptureWriter(path)
+    start = datetime.datetime(2018, 1, 1).timestamp()
+    count = 0
+
+    for t in range(0, days * 86400, INTERVAL):
+        for inv_id in replies:
+            wall = start + t + inv_id * 0.3
+            writer.append(0, wall - start, wall, requests[inv_id])
+            writer.append(0, wall - start + 0.05, wall + 0.05, replies[inv_id])
+            count += 2
+    writer.close()
+    return count
+
+
+def check_repair (path):
+
+    """ Cut a segment in the middle of a record and drop index entries, as a crash could """
+
+    fname = os.path.join(path, '2018-01-01.cap')
+    segment = capture.CaptureSegment(fname)
+    count = len(segment)
+    segment.close()
+
+    with open(fname, 'r+b') as f:
+        f.truncate(os.path.getsize(fname) - 100)
+    with open(fname + '.idx', 'r+b') as f:
+        f.truncate(os.path.getsize(fname + '.idx') - 50 * capture.ENTRY.size)
+
+    writer = capture.CaptureWriter(path)
+    writer._open(datetime.date(2018, 1, 1))
+    writer.close()
+
+    segment = capture.CaptureSegment(fname)
+    repaired = len(segment)
+    last = segment[repaired - 1]
+    segment.close()
+
+    if repaired != count - 1 or last[3][-1] != 0x03:
+        print("MISMATCH: %d records after repair, expected %d" % (repaired, count - 1))
+        sys.exit(1)
+
+
+def main ():
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 14
+    inverters = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    capture.verbose = 0
+
+    # A corrected field map: the "bus" voltages as plain numbers, in volts
+
+    mapping = capture.fieldmap(decoder.rpi_m)
+    mapping['decoder'] = "RPI_M_fixed"
+    mapping['hexfields'] = []
+    mapping['layout'] = [var if var[0] not in ("bus+V", "bus-V") else var[:3] + [-1, "V"] for var in mapping['layout']]
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        path = os.path.join(tmp, 'capture')
+        t0 = time.perf_counter()
+        count = write(path, days, inverters)
+        elapsed = time.perf_counter() - t0
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        print("Captured %d messages in %d days in %.1f s, %.1f MB with index (%.0f bytes/message)" %
+              (count, days, elapsed, size / 1e6, size / count))
+
+        check_repair(path)
+
+        for processes in sorted({1, os.cpu_count()}):
+            out = os.path.join(tmp, 'out%d' % processes)
+            t0 = time.perf_counter()
+            messages, blocks, unknown = capture.redecode(path, out, mapping, processes)
+            elapsed = time.perf_counter() - t0
+            print("Decoded %d data blocks again with %d processes in %.2f s, %.0f blocks/s" %
+                  (blocks, processes, elapsed, blocks / elapsed))
+
+        with open(os.path.join(out, '0-1-RPI_M_fixed-2018-01-02.csv')) as f:
+            header = f.readline().split('\t')
+            row = f.readline().split('\t')
+        value = row[header.index('bus+V')]
+        if blocks != messages // 2 or unknown or value.startswith('0x'):
+            print("MISMATCH: %d blocks in %d messages, bus+V is %s" % (blocks, messages, value))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+# bench_crc16.py
+
+# Check that all CRC-16 implementations in crc16.py agree with the
+# original table-based calculation, and compare their speed.
+# Usage: python3 benchmarks/bench_crc16.py [iterations]
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import crc16
+from bench_framing import DUMP_RPI_M15A, DUMP_NA_G4, parse_dump
+
+
+implementations = [("table", crc16.calcDataTable), ("pairs", crc16.calcDataPairs)]
+if hasattr(crc16, "calcDataCrcmod"):
+    implementations.append(("crcmod", crc16.calcDataCrcmod))
+
+
+def recorded_frames ():
+
+    """ Return the messages in the recorded dumps, without STX, CRC and ETX """
+
+    frames = []
+    for dump in (DUMP_RPI_M15A, DUMP_NA_G4):
+        data = parse_dump(dump)
+        request, reply = data[:9], data[9:]
+        frames += [request[1:-3], reply[1:-3]]
+    return frames
+
+
+def check ():
+
+    """ Compare every implementation with calcDataTable(), and exit on a mismatch """
+
+    rng = random.Random(1)
+    inputs = [bytes(rng.getrandbits(8) for i in range(rng.randrange(300))) for j in range(1000)]
+    inputs += recorded_frames()
+
+    for name, calc in implementations + [("incremental", None)]:
+        for data in inputs:
+            for initial in (crc16.INITIAL_DF1, crc16.INITIAL_MODBUS):
+                expected = crc16.calcDataTable(data, initial)
+                if calc:
+                    result = calc(data, initial)
+                else:
+                    split = rng.randrange(len(data) + 1)
+                    crc = crc16.CRC16(crc=initial)
+                    crc.update(data[:split])
+                    result = crc.update(memoryview(data)[split:])
+                if result != expected:
+                    print("MISMATCH:", name, data.hex(), hex(initial), hex(result), hex(expected))
+                    sys.exit(1)
+
+    # The recorded messages should match the CRC transmitted with them
+
+    for dump in (DUMP_RPI_M15A, DUMP_NA_G4):
+        data = parse_dump(dump)
+        for message in (data[:9], data[9:]):
+            if crc16.calcData(message[1:-3]) != message[-3] | message[-2] << 8:
+                print("MISMATCH: recorded message", message.hex())
+                sys.exit(1)
+
+    print("All", len(implementations), "implementations and the incremental API agree on", len(inputs), "inputs")
+
+
+def main ():
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    check()
+
+    print("calcData() is", crc16.calcData.__name__)
+    crc16.calcDataPairs(b'')    # Build the two-byte table outside the timing
+
+    frame = recorded_frames()[1]
+    for name, calc in implementations:
+        seconds = min(timeit.repeat(lambda: calc(frame), number=iterations, repeat=3))
+        print("%-8s %7.2f us per %d-byte message" % (name, seconds * 1e6 / iterations, len(frame)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+# bench_decoder.py
+
+# Compare the work per reply of unpacking the whole RPI M data block
+# (and converting the serial to a string) with the identity cache and
+# decoding only the variables that are needed, e.g. for reporting.
+# Usage: python3 benchmarks/bench_decoder.py [replies]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import decoder
+from bench_framing import parse_dump, DUMP_RPI_M15A
+
+OFFSET = 6          # Start of the data block in a reply
+
+
+def full (dec, frame):
+    u = dec.decode(frame, OFFSET)
+    subset = dec.subset(u)
+    serial = str(u.serial, "ascii")
+    return serial, u.energytotal * 1000, subset
+
+
+def cached (dec, identities, selection, frame):
+    serial = identities.get(1, dec, frame, OFFSET).serial
+    return serial, selection.decode(frame, OFFSET)
+
+
+def main ():
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    dec = decoder.rpi_m
+    frame = parse_dump(DUMP_RPI_M15A)[9:]        # The reply, without the request
+    identities = decoder.IdentityCache()
+
+    u = dec.decode(frame, OFFSET)
+    for names in (("energytotal",), ("power", "energytotal_day", "temp")):
+        if tuple(dec.select(names).decode(frame, OFFSET)) != tuple(getattr(u, name) for name in names):
+            print("MISMATCH: selection of", names, "differs from the full record")
+            sys.exit(1)
+
+    base = timeit.timeit(lambda: full(dec, frame), number=count)
+    print("%-48s %6.2f us/reply" % ("full decode, subset and serial:", base / count * 1e6))
+
+    for names in (("energytotal",), ("power", "energytotal_day", "temp")):
+        selection = dec.select(names)
+        t = timeit.timeit(lambda: cached(dec, identities, selection, frame), number=count)
+        print("%-48s %6.2f us/reply, %4.1fx less work" %
+              ("identity cache + " + ", ".join(names) + ":", t / count * 1e6, base / t))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+# bench_deltastore.py
+
+# Compare the size of a day of samples in CSV, binstore and deltastore
+# format, and the decoding speed of binstore and deltastore, for simulated
+# inverters (simulator.py) on a sunny and a cloudy day.
+# Usage: python3 benchmarks/bench_deltastore.py [inverters [sample interval in seconds]]
+
+import csv
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import binstore
+import decoder
+import deltastore
+import simulator
+
+
+def day_samples (inv_id, day, interval, cloudy):
+
+    """ Return (time, record) pairs for one simulated inverter during a day """
+
+    dec = decoder.rpi_m
+    inv = simulator.Inverter(inv_id, rng=random.Random(inv_id))
+    samples = []
+    t = datetime.datetime.combine(day, datetime.time())
+    end = t + datetime.timedelta(days=1)
+    while t < end:
+        if not cloudy:
+            inv.clouds = 1.0
+        record = dec.decode(inv.block(t.timestamp()))
+        samples.append((t + datetime.timedelta(microseconds=random.randrange(1000000)), record))
+        t += datetime.timedelta(seconds=interval)
+    return samples
+
+
+def directory_size (path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def main ():
+
+    inverters = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+    dec = decoder.rpi_m
+    day = datetime.date(2018, 6, 21)
+
+    for profile, cloudy in (("sunny", False), ("cloudy", True)):
+
+        sizes = {'csv': 0, 'binstore': 0, 'deltastore': 0}
+        decode_time = {'binstore': 0.0, 'deltastore': 0.0}
+        count = 0
+
+        with tempfile.TemporaryDirectory() as tmp:
+
+            for inv_id in range(1, inverters + 1):
+
+                samples = day_samples(inv_id, day, interval, cloudy)
+                count += len(samples)
+
+                fname = os.path.join(tmp, "%d.csv" % inv_id)
+                with open(fname, "w") as f:
+                    csvw = csv.writer(f, delimiter='\t')
+                    csvw.writerow(["time"] + dec.subset_header)
+                    csvw.writerows([t.isoformat()] + dec.subset(record) for t, record in samples)
+                sizes['csv'] += os.path.getsize(fname)
+
+                for name, module in (('binstore', binstore), ('deltastore', deltastore)):
+
+                    path = os.path.join(tmp, "%s-%d" % (name, inv_id))
+                    writer = module.SegmentWriter(path, dec)
+                    writer.writerows(samples)
+                    writer.close()
+                    sizes[name] += directory_size(path)
+
+                    ext = deltastore.EXT if module is deltastore else '.bin'
+                    t0 = time.perf_counter()
+                    decoded = [(t, record) for fname in binstore.segments(path, ext=ext)
+                               for t, dec_, record in module.read_segment(fname)]
+                    decode_time[name] += time.perf_counter() - t0
+
+                    if [record for t, record in decoded] != [record for t, record in samples] or \
+                            any(abs(t - s.timestamp()) > 0.001 for (t, r), (s, q) in zip(decoded, samples)):
+                        print("MISMATCH: decoded", name, "records differ from the originals")
+                        sys.exit(1)
+
+        print("%s day, %d inverters, %d samples (all decoded records identical):" % (profile, inverters, count))
+        for name, size in sizes.items():
+            print("  %-10s %9d bytes  %6.1f bytes/sample  %5.1fx smaller than csv" %
+                  (name, size, size / count, sizes['csv'] / size))
+        for name, seconds in decode_time.items():
+            print("  decode %-10s %9.0f samples/s" % (name, count / seconds))
+
+
+if __name__ == "__main__":
+    main()
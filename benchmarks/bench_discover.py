@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+# bench_discover.py
+
+# Run discover.py against a simulated bus (simulator.py) with inverters at
+# scattered bus IDs, set to another baud rate than the default, and check
+# that all of them are found, with the right serials, in a site config.
+# Usage: python3 benchmarks/bench_discover.py [reply latency in seconds [baud rate]]
+
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import discover
+import simulator
+
+BUS_IDS = (3, 17, 18, 130, 254)
+
+
+def main ():
+
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+    speed = int(sys.argv[2]) if len(sys.argv) > 2 else 9600
+
+    sim = simulator.BusSimulator(BUS_IDS, latency, baudrate=speed, speed=speed)
+    process = multiprocessing.get_context('fork').Process(target=sim.run, daemon=True)
+    process.start()
+    os.close(sim.master)
+
+    discover.verbose = 0
+    fd = discover.open_port(sim.port)
+    rates = discover.RATES[:discover.RATES.index(speed) + 1]
+
+    try:
+        start = time.monotonic()
+        discovery = discover.Discovery(fd)
+        baudrate, inverters = discovery.discover(rates)
+        elapsed = time.monotonic() - start
+    finally:
+        process.terminate()
+        process.join()
+        os.close(fd)
+        os.close(sim.slave)
+
+    print("Scanned %d baud rates in %.1f s with %d requests (one at a time with 1 s time-outs: ~%d s)" %
+          (len(rates), elapsed, discovery.requests, len(rates) * 254))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "site.json")
+        with open(fname, "w") as f:
+            json.dump({'sampleinterval': 30, 'buses': [{'port': '/dev/ttyUSB9', 'inverters': [1]}]}, f)
+        discover.write_site_config(fname, sim.port, baudrate, inverters)
+        with open(fname) as f:
+            site = json.load(f)
+
+    bus = site['buses'][-1]
+    for inv_id in sorted(inverters):
+        print("  bus ID %3d: %s %s, reply in %.3f s" % (inv_id, inverters[inv_id]['partno'],
+                                                        inverters[inv_id]['serial'], inverters[inv_id]['latency']))
+
+    expected = {inv_id: simulator.Inverter(inv_id).serial.decode('ascii') for inv_id in BUS_IDS}
+    if baudrate != speed or bus['inverters'] != list(BUS_IDS) or site['sampleinterval'] != 30 or len(site['buses']) != 2 \
+            or {inv_id: inverters[inv_id]['serial'] for inv_id in inverters} != expected:
+        print("MISMATCH: expected bus IDs", BUS_IDS, "at", speed, "baud, site config is", json.dumps(site))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
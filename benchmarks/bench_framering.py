@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# bench_framering.py
+
+# Measure how many messages per second pass through framering.FrameRing
+# between two processes, and check that the ring absorbs a consumer that
+# stalls (e.g. on a slow flush or report) without losing messages, and
+# counts overruns when the stall is longer than the ring can hold.
+# Usage: python3 benchmarks/bench_framering.py [ring size in bytes for the throughput test]
+
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import framering
+
+# A reply with an RPI M data block on the bus: 4 + 157 + 3 bytes
+
+MESSAGE = bytes(164)
+
+
+def produce (ring, count, rate):
+
+    """ Put count messages in the ring, at rate messages per second (0 for as fast as possible) """
+
+    start = time.monotonic()
+    for n in range(count):
+        if rate:
+            delay = start + n / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        ring.put(framering.SAMPLE, n % 255 + 1, MESSAGE, time.monotonic(), time.time(), 0.05)
+
+
+def run (size, count, rate, stall=0.0):
+
+    """ Pass count messages through a ring, with the consumer stalling for a while halfway """
+
+    context = multiprocessing.get_context('fork')
+    ring = framering.FrameRing(size, context)
+    producer = context.Process(target=produce, args=(ring, count, rate))
+
+    received = 0
+    t0 = time.perf_counter()
+    producer.start()
+    while producer.is_alive() or ring.used():
+        if stall and received == count // 4:
+            time.sleep(stall)
+            stall = 0.0
+        if ring.get(0.1):
+            received += 1
+    elapsed = time.perf_counter() - t0
+    producer.join()
+
+    result = (received, ring.overruns(), ring.max_occupancy(), elapsed)
+    ring.close()
+    return result
+
+
+def main ():
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64*1024
+    record = framering.RECORD.size + len(MESSAGE)
+
+    received, overruns, most, elapsed = run(size, 100000, 0)
+    print("Throughput: %d messages of %d bytes in %.2f s, %.0f messages/s, %d overruns" %
+          (received, len(MESSAGE), elapsed, received / elapsed, overruns))
+
+    # 19200 baud is ~1900 bytes/s, so at most ~12 replies per second on a busy
+    # bus. Use a small ring, so the stalls don't take minutes.
+
+    size = 8*1024
+    rate = 12
+    capacity = size // record
+    for stall in (capacity / rate / 2, capacity / rate * 1.5):
+        count = int(rate * stall * 2)
+        received, overruns, most, elapsed = run(size, count, rate, stall)
+        print("Consumer stalls %.0f s at %d messages/s: %d of %d received, %d overruns, at most %.0f%% of %d bytes in use" %
+              (stall, rate, received, count, overruns, 100 * most, size))
+        if received + overruns != count:
+            print("MISMATCH: messages lost without an overrun")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+
+# bench_framing.py
+
+# Compare the old byte-at-a-time get_message() with framing.FrameReader,
+# by feeding recorded RS485 traffic through a simulated serial port.
+# Note that FrameReader also checks the CRC of every message, which
+# get_message() left to decode_response(). Also checks that stray bytes
+# that look like the header of a long message don't hold up a reply that
+# follows them.
+# Usage: python3 benchmarks/bench_framing.py [number of request/reply pairs]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import framing
+
+
+# Recorded traffic (jpnevulator dumps, see README.md)
+
+DUMP_RPI_M15A = """
+02 05 01 02 60 01 85 FC 03 02 06 01 9D 60 01 31
+35 33 46 41 30 45 30 30 30 30 32 34 31 30 35 31
+35 30 35 30 30 33 34 36 33 32 32 33 30 39 30 31
+30 30 02 18 0F 2D 01 3C 0F 0C 02 24 0F 26 0F C1
+08 BA 14 9C 13 89 0F B7 13 88 0F CB 08 C2 14 B4
+13 89 0F BC 13 88 0F C4 08 C7 14 D3 13 89 0F BD
+13 88 1D 1D 03 52 18 C5 19 08 06 29 27 7C 3E 23
+0E 78 0E A6 00 00 9C 40 00 00 54 4F 00 00 28 22
+00 95 94 70 00 32 00 00 00 00 00 00 00 00 00 00
+00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00
+00 00 00 00 00 00 00 00 00 00 5B C6 03
+"""
+
+DUMP_NA_G4 = """
+02 05 01 02 60 01 85 FC 03 02 06 01 96 60 01 45
+4F 45 34 36 30 31 30 31 37 35 32 32 30 31 37 35
+31 30 31 32 33 34 30 30 30 35 30 34 31 32 33 34
+31 30 00 2D 2D 00 2D 2D 00 2D 2D 00 2D 2D 01 0A
+00 3E 00 00 00 2B 00 00 00 41 00 F2 06 3E 17 6F
+00 29 62 D4 17 6F 00 01 5E 88 17 6F 00 01 01 41
+00 E9 00 42 00 EC 00 F4 06 43 17 69 17 74 00 00
+AC 9E 00 00 10 9D 00 79 01 6E 0C 3C 00 00 06 D6
+00 00 00 08 00 00 00 00 00 00 00 00 00 00 00 01
+01 01 01 01 01 01 01 01 01 01 01 01 01 01 01 01
+01 01 01 FC C6 03
+"""
+
+
+def parse_dump (text):
+
+    """ Convert the hex-part of a jpnevulator dump to bytes """
+
+    data = bytearray()
+    for line in text.strip().splitlines():
+        data.extend(bytes.fromhex(line.split('\t')[0]))
+    return bytes(data)
+
+
+class RecordedSerial:
+
+    """
+    Minimal stand-in for serial.Serial that replays a byte stream.
+    'gaps' are stream offsets where the sender paused for longer than
+    the read time-out, so a read can't return data beyond a gap.
+    """
+
+    def __init__(self, stream, gaps, chunk=64):
+        self.stream = stream
+        self.gaps = sorted(gaps) + [len(stream)]
+        self.gap_idx = 0
+        self.pos = 0
+        self.chunk = chunk          # Bytes delivered per USB transfer
+        self.timeout = None
+        self.reads = 0
+
+    def _limit(self):
+        while self.gaps[self.gap_idx] <= self.pos and self.gap_idx < len(self.gaps) - 1:
+            self.gap_idx += 1
+        return self.gaps[self.gap_idx]
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, self._limit() - self.pos)
+
+    def read(self, size=1):
+        self.reads += 1
+        limit = self._limit()
+        if self.pos >= limit:               # Time-out, skip over the gap
+            if self.gap_idx < len(self.gaps) - 1:
+                self.gap_idx += 1
+            return b''
+        end = min(self.pos + size, limit)
+        data = self.stream[self.pos:end]
+        self.pos = end
+        return data
+
+    def exhausted(self):
+        return self.pos >= len(self.stream)
+
+
+def legacy_get_message (connection, timeout):
+
+    """ The byte-at-a-time reader that soliviamonitor.py used before FrameReader """
+
+    connection.timeout = timeout
+    data = connection.read(1)
+    if data and data[0] == 0x02:
+        newdata = connection.read(1)
+        data = bytearray(data)
+        if newdata:
+            if newdata[0] == 0x05 or newdata[0] == 0x06:
+                data.extend(newdata)
+                newdata = connection.read(2)
+                if len(newdata) == 2:       # The original only checked for an empty read, and crashed here
+                    data.extend(newdata)
+                    length = newdata[1]
+                else:
+                    return None
+                newdata = connection.read(length + 3)
+                if not newdata:
+                    return None
+                data.extend(newdata)
+                return data
+            return None
+    return None
+
+
+def make_stream (count, noise, gap_rate, seed=1):
+
+    """ Build a stream of recorded request/reply pairs with some line noise and pauses """
+
+    rng = random.Random(seed)
+    dumps = (parse_dump(DUMP_RPI_M15A), parse_dump(DUMP_NA_G4))
+    stream = bytearray()
+    gaps = []
+    for i in range(count):
+        if rng.random() < noise:
+            stream.extend(rng.choice((b'\x02', b'\x00', b'\x02\x06', b'\xff\x02')))
+        pair = dumps[i % 2]
+        if rng.random() < gap_rate:
+            gaps.append(len(stream) + rng.randrange(len(pair)))
+        stream.extend(pair)
+    return bytes(stream), gaps, count * 2
+
+
+def run (name, stream, gaps, expected, reader_factory):
+    connection = RecordedSerial(stream, gaps)
+    get = reader_factory(connection)
+    messages = []
+    t0 = time.perf_counter()
+    while True:
+        data = get(0.2)
+        if data:
+            messages.append(data)
+        elif connection.exhausted():
+            break
+    elapsed = time.perf_counter() - t0
+    found = sum(1 for data in messages if framing.FrameReader().feed(data))  # Count only valid messages
+    print("%-12s %8d of %d messages  %6.2f reads/message  %8.1f us/message" % \
+          (name, found, expected, connection.reads / max(1, found), elapsed * 1e6 / max(1, found)))
+
+
+def check_stray_header ():
+
+    """ A reply behind stray bytes like 02 06 01 ff (a header of a 262-byte message) should come out at once """
+
+    reply = parse_dump(DUMP_RPI_M15A)[9:]
+    for stray in (b'\x02\x06\x01\xff', b'\x02\x05\x01\xf0\x60\x01', b'\x02\x06'):
+        reader = framing.FrameReader()
+        frames = reader.feed(stray) + reader.feed(reply)
+        if frames != [reply]:
+            print("MISMATCH: a reply behind", stray.hex(), "gave", len(frames), "messages")
+            sys.exit(1)
+    print("Replies behind stray header bytes are returned at once")
+
+
+def main ():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for noise, gap_rate in ((0.0, 0.0), (0.02, 0.0), (0.02, 0.01)):
+        stream, gaps, expected = make_stream(count, noise, gap_rate)
+        print("Noise rate %.2f, pause rate %.2f, %d bytes:" % (noise, gap_rate, len(stream)))
+        run("get_message", stream, gaps, expected,
+            lambda connection: lambda timeout: legacy_get_message(connection, timeout))
+        run("FrameReader", stream, gaps, expected,
+            lambda connection: framing.FrameReader(connection).get_message)
+        print()
+    check_stray_header()
+
+
+if __name__ == "__main__":
+    main()
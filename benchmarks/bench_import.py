@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+# bench_import.py
+
+# Measure how long the protocol and decoder modules, and soliviamonitor.py
+# and multibus.py as libraries, take to import in a fresh interpreter, and
+# check that importing the collectors loads no serial, storage or reporting
+# backend and creates no files.
+# Usage: python3 benchmarks/bench_import.py [runs]
+
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+MODULES = ('crc16', 'protocol', 'decoder', 'framing', 'scheduler', 'soliviamonitor', 'multibus')
+COLLECTORS = ('soliviamonitor', 'multibus')
+BACKENDS = ('serial', 'binstore', 'deltastore', 'wal', 'ringstore', 'aggregates', 'capture',
+            'reportqueue', 'report', 'framering', 'multiprocessing', 'http.server')
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start)
+print(' '.join(sorted(sys.modules)))
+"""
+
+
+def probe (module, cwd):
+
+    """ Import a module in a new interpreter, return (seconds, names of the loaded modules) """
+
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(ROOT), PYTHONDONTWRITEBYTECODE='1')
+    out = subprocess.run([sys.executable, '-c', PROBE % module], cwd=cwd, env=env,
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.split('\n')
+    return float(out[0]), set(out[1].split())
+
+
+def main ():
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    failed = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for module in MODULES:
+            times = []
+            for n in range(runs):
+                elapsed, loaded = probe(module, tmp)
+                times.append(elapsed)
+            print("import %-15s %6.1f ms (best of %d)" % (module, 1000 * min(times), runs))
+
+            backends = sorted(loaded.intersection(BACKENDS))
+            created = os.listdir(tmp)
+            if module in COLLECTORS and (backends or created):
+                print("MISMATCH: importing", module, "loaded", backends, "and created", created)
+                failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
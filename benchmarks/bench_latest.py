@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+# bench_latest.py
+
+# Feed a latest.LatestCache with replies from a bus of inverters, like a
+# collector would, serve it on a Unix socket, and measure what it costs
+# the collector per reply, how many "latest" queries (JSON and binary)
+# clients get answered per second, and how soon subscribers see a new
+# block. Checks that subscribers get every block, and the blocks unchanged.
+# Usage: python3 benchmarks/bench_latest.py [clients [inverters [seconds]]]
+
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import crc16
+import decoder
+import latest
+from bench_framing import parse_dump, DUMP_RPI_M15A
+
+RATE = 50               # Replies per second from the bus, e.g. 16 inverters every 0.3 s
+
+
+def replies (inverters):
+    reply = parse_dump(DUMP_RPI_M15A)[9:]
+    frames = []
+    for inv_id in range(1, inverters + 1):
+        frame = bytearray(reply)
+        frame[2] = inv_id
+        crc = crc16.calcData(bytes(frame[1:-3]))
+        frame[-3] = crc & 0xff
+        frame[-2] = crc >> 8
+        frames.append(bytes(frame))
+    return frames
+
+
+def collector (cache, frames, seconds, costs):
+
+    """ Put RATE replies per second in the cache, and record how long put() takes """
+
+    start = time.monotonic()
+    n = 0
+    while time.monotonic() - start < seconds:
+        frame = frames[n % len(frames)]
+        t0 = time.perf_counter()
+        cache.put(0, frame[2], decoder.rpi_m, frame, 6)
+        costs.append(time.perf_counter() - t0)
+        n += 1
+        time.sleep(max(0, start + n / RATE - time.monotonic()))
+
+
+def connect (path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    return s, s.makefile('rb')
+
+
+def query (path, request, stop, counts):
+
+    """ Send the same request over and over until stop is set, count the answers """
+
+    s, f = connect(path)
+    line = json.dumps(request).encode('utf-8') + b'\n'
+    binary = request.get('format') == 'binary'
+    while not stop.is_set():
+        s.sendall(line)
+        if binary:
+            count = latest.COUNT.unpack(f.read(latest.COUNT.size))[0]
+            for n in range(count):
+                length = latest.RECORD.unpack(f.read(latest.RECORD.size))[4]
+                f.read(length)
+        else:
+            json.loads(f.readline())
+        counts.append(1)
+    s.close()
+
+
+def subscribe (s, f, frames, results):
+
+    """ Receive pushed blocks in binary until the socket is shut down, check them and record their delay """
+
+    blocks = {frame[2]: frame[6:6 + decoder.rpi_m.size] for frame in frames}
+    delays = []
+    wrong = 0
+    while True:
+        try:
+            wall, bus_idx, inv_id, dec, length = latest.RECORD.unpack(f.read(latest.RECORD.size))
+        except struct.error:
+            break
+        block = f.read(length)
+        delays.append(time.time() - wall)
+        wrong += block != blocks[inv_id] or decoder.decoders[dec] is not decoder.rpi_m
+    s.close()
+    results.append((len(delays), wrong, sorted(delays)))
+
+
+def main ():
+
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    inverters = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    latest.verbose = 0
+    frames = replies(inverters)
+    cache = latest.LatestCache()
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        path = os.path.join(tmp, 'latest.sock')
+        latest.serve(cache, path)
+        stop = threading.Event()
+        costs = []
+        subscribed = []
+        answered = {'json': [], 'binary': []}
+
+        subscribers = [connect(path) for n in range(2)]
+        for s, f in subscribers:
+            s.sendall(b'{"cmd": "subscribe", "format": "binary"}\n')
+        threads = [threading.Thread(target=subscribe, args=(s, f, frames, subscribed)) for s, f in subscribers]
+        for n in range(clients):
+            request = {'cmd': 'latest'}
+            if n % 2:
+                request['format'] = 'binary'
+            threads.append(threading.Thread(target=query, args=(path, request, stop,
+                                                                 answered[request.get('format', 'json')])))
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)                 # Let the subscribers connect before the first block
+
+        collector(cache, frames, seconds, costs)
+        time.sleep(0.2)
+        stop.set()
+        for s, f in subscribers:
+            s.shutdown(socket.SHUT_RDWR)
+        for thread in threads:
+            thread.join()
+        latest.close()
+
+    costs.sort()
+    print("%d replies from %d inverters in %.0f s, put() takes %.1f us median, %.1f us p99" %
+          (len(costs), inverters, seconds, 1e6 * costs[len(costs) // 2], 1e6 * costs[int(len(costs) * 0.99)]))
+    for name, counts in answered.items():
+        print("%-6s 'latest' for %d inverters: %6.0f answers/s to %d clients" %
+              (name, inverters, len(counts) / seconds, (clients + (name == 'json')) // 2))
+    for received, wrong, delays in subscribed:
+        print("Subscriber: %d blocks, %d wrong, pushed within %.2f ms median, %.2f ms p99" %
+              (received, wrong, 1e3 * delays[len(delays) // 2], 1e3 * delays[int(len(delays) * 0.99)]))
+
+    if any(received != len(costs) or wrong for received, wrong, delays in subscribed):
+        print("MISMATCH: subscribers should get all", len(costs), "blocks, unchanged")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
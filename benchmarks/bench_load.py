@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+# bench_load.py
+
+# End-to-end load test: poll 1 to 64 simulated inverters (simulator.py) on
+# a pseudo-terminal with the same framing, scheduling and decoding code as
+# soliviamonitor.py, and measure decoded frames per second, request to reply
+# latency, CPU time per frame and memory growth.
+# Usage: python3 benchmarks/bench_load.py [seconds per run [latency [error rate]]]
+# The error rate is applied to noise, truncation and CRC errors alike.
+
+import multiprocessing
+import os
+import resource
+import selectors
+import sys
+import time
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import decoder
+import framing
+import protocol
+import scheduler
+import simulator
+
+
+def rss_kb ():
+
+    """ Return the resident set size of this process in kB """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile (values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def collect (port, inverters, duration, replytimeout):
+
+    """ Poll inverters as fast as the bus allows, decode all replies, and return statistics """
+
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    tty.setraw(fd)
+    reader = framing.FrameReader()
+    polls = scheduler.PollScheduler(range(1, inverters + 1), interval=0,
+                                    replytimeout=replytimeout, turnaround=0)
+    sel = selectors.DefaultSelector()
+    sel.register(fd, selectors.EVENT_READ)
+
+    sent = {}
+    latencies = []
+    frames = 0
+    requests = 0
+    power = 0
+
+    # Warm up for a moment before measuring, so imports and buffers don't count
+
+    start = time.monotonic()
+    warmup = start + min(0.5, duration / 4)
+    end = start + duration
+    rss_start = cpu_start = None
+
+    while True:
+
+        now = time.monotonic()
+        if now >= end:
+            break
+        if cpu_start is None and now >= warmup:
+            rss_start, cpu_start, frames_start, t_start = rss_kb(), time.process_time(), frames, now
+            latencies = []
+
+        inv_id = polls.pop_due(now)
+        if inv_id is not None:
+            os.write(fd, protocol.build_request(inv_id, b'\x60\x01'))
+            sent[inv_id] = now
+            requests += 1
+
+        timeout = max(0, min(polls.next_deadline(), end) - time.monotonic())
+        for key, events in sel.select(timeout):
+            now = time.monotonic()
+            for frame in reader.feed(os.read(fd, 4096)):
+                polls.received(frame[2], frame[1] == framing.ENQ, now)
+                if frame[1] != framing.ACK:
+                    continue
+                dec = decoder.lookup(frame, 6, len(frame) - 9)
+                if not dec:
+                    continue
+                u = dec.decode(frame, 6)
+                power += u.power
+                dec.subset(u)
+                frames += 1
+                if frame[2] in sent:
+                    latencies.append(now - sent.pop(frame[2]))
+                if polls.sample_due(frame[2], now):
+                    polls.sampled(frame[2], now)
+
+    elapsed = time.monotonic() - t_start
+    stats = {'frames/s': (frames - frames_start) / elapsed,
+             'cpu us/frame': (time.process_time() - cpu_start) * 1e6 / max(frames - frames_start, 1),
+             'p50 ms': percentile(latencies, 50) * 1000,
+             'p90 ms': percentile(latencies, 90) * 1000,
+             'p99 ms': percentile(latencies, 99) * 1000,
+             'rss +kB': rss_kb() - rss_start,
+             'lost': requests - frames,
+             'crc errors': reader.crc_errors}
+    os.close(fd)
+    return stats
+
+
+def run (inverters, duration, latency, errors):
+
+    sim = simulator.BusSimulator(inverters, latency, errors, errors, errors)
+    process = multiprocessing.get_context('fork').Process(target=sim.run, args=(duration + 1,))
+    process.start()
+    os.close(sim.master)
+    try:
+        return collect(sim.port, inverters, duration, replytimeout=max(0.05, latency * 5))
+    finally:
+        process.terminate()
+        process.join()
+        os.close(sim.slave)
+
+
+def main ():
+
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    errors = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+
+    print("Reply latency %g s, error rate %g, %g s per run" % (latency, errors, duration))
+
+    header = None
+    for inverters in (1, 2, 4, 8, 16, 32, 64):
+        stats = run(inverters, duration, latency, errors)
+        if not header:
+            header = list(stats)
+            print("%10s" % "inverters" + "".join("%13s" % name for name in header))
+        print("%10d" % inverters + "".join("%13.1f" % stats[name] for name in header))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+# bench_query.py
+
+# Compare a full scan of a sample file with an indexed query.py lookup,
+# on a synthetic file with several years of samples in the CSV layout of
+# soliviamonitor.py.
+# Usage: python3 benchmarks/bench_query.py [years [sample interval in seconds]]
+
+import csv
+import datetime
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import decoder
+import query
+
+
+def make_file (fname, start, years, interval):
+
+    """ Write a synthetic sample file, with AC power following the sun """
+
+    dec = decoder.rpi_m
+    header = ["time"] + dec.subset_header
+    power = header.index("power")
+    rng = random.Random(1)
+    template = [str(rng.randrange(1000)) for name in header]
+
+    t = start
+    end = start + datetime.timedelta(days=365 * years)
+    step = datetime.timedelta(seconds=interval)
+    rows = 0
+
+    with open(fname, "w") as f:
+        csvw = csv.writer(f, delimiter='\t')
+        csvw.writerow(header)
+        while t < end:
+            hour = t.hour + t.minute / 60
+            template[0] = t.isoformat()
+            template[power] = str(max(0, int(15000 * math.sin((hour - 6) * math.pi / 12))))
+            csvw.writerow(template)
+            t += step
+            rows += 1
+
+    return rows, t
+
+
+def full_scan (fname, field, start, end):
+
+    """ Read the whole file with csv.reader, the way we had to before """
+
+    with open(fname) as f:
+        reader = csv.reader(f, delimiter='\t')
+        column = next(reader).index(field)
+        start, end = start.isoformat(), end.isoformat()
+        return [(row[0], float(row[column])) for row in reader if start <= row[0] < end]
+
+
+def timed (label, function):
+    t0 = time.perf_counter()
+    result = function()
+    print("%-40s %9.3f s" % (label, time.perf_counter() - t0))
+    return result
+
+
+def main ():
+
+    years = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    start = datetime.datetime(2016, 1, 1)
+    year = start.year + max(int(years) - 1, 0)      # March of the last full year
+    march = (datetime.datetime(year, 3, 1), datetime.datetime(year, 4, 1))
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        fname = os.path.join(tmp, "2-123456789012345678.csv")
+        rows, t_end = timed("Writing synthetic file", lambda: make_file(fname, start, years, interval))
+        print(rows, "rows,", os.path.getsize(fname) // 2**20, "MB")
+
+        scanned = timed("Full scan, March", lambda: full_scan(fname, "power", *march))
+        index = timed("Building index", lambda: query.LogIndex(fname))
+        print(len(index.times), "index entries,", os.path.getsize(index.idxname), "bytes")
+        index = timed("Opening saved index", lambda: query.LogIndex(fname))
+
+        found = timed("Indexed query, March", lambda: list(query.query(fname, ["power"], *march, index=index)))
+        if len(found) != len(scanned) or any(a[1] != b[1][0] for a, b in zip(scanned, found)):
+            print("MISMATCH between full scan and indexed query")
+            sys.exit(1)
+        print(len(found), "rows, identical to full scan")
+
+        hourly = timed("Indexed query, hourly mean", lambda: list(query.query(fname, ["power"], *march, bucket=3600, index=index)))
+        print(len(hourly), "buckets, peak hourly mean", max([v[0] for t, v in hourly], default=0), "W")
+
+        day = (march[0], march[0] + datetime.timedelta(days=1))
+        timed("Indexed query, one day (x100)", lambda: [list(query.query(fname, ["power"], *day, index=index)) for i in range(100)])
+
+        # Append a day of samples, the index should only read the new rows
+
+        with open(fname, "a") as f:
+            csvw = csv.writer(f, delimiter='\t')
+            t = t_end
+            for i in range(int(86400 / interval)):
+                csvw.writerow([t.isoformat()] + ["0"] * (len(index.fields()) - 1))
+                t += datetime.timedelta(seconds=interval)
+
+        timed("Incremental index update (one day)", lambda: query.LogIndex(fname))
+
+
+if __name__ == "__main__":
+    main()
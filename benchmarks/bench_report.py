@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+# bench_report.py
+
+# Check reportqueue.ReportQueue against the stand-in HTTP server in
+# reportqueue.py: queueing must not wait for a slow or unreachable server,
+# totals must survive a restart, also when the inverters get other indexes
+# after it, and only the latest total of each inverter should be sent once
+# the server is back.
+# Usage: python3 benchmarks/bench_report.py
+
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import reportqueue
+
+
+def put_times (reports, rounds, inverters=3):
+
+    """ Queue rounds of totals for all inverters, and return the slowest put() in seconds """
+
+    slowest = 0.0
+    for r in range(rounds):
+        for idx in range(inverters):
+            t0 = time.perf_counter()
+            reports.put(idx, 1000000 * idx + r)
+            slowest = max(slowest, time.perf_counter() - t0)
+    return slowest
+
+
+def wait_for (condition, timeout):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def main ():
+
+    handler = reportqueue.StandInHandler
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        path = os.path.join(tmp, 'report-queue.json')
+
+        # Slow server: each report takes 2 s, queueing should not notice
+
+        handler.delay = 2.0
+        sender = reportqueue.HttpReport(url, timeout=0.5)
+        reports = reportqueue.ReportQueue(sender.send_total, sender.init, path, retry=0.05, maxretry=0.2)
+        for idx in range(3):
+            reports.init(idx, 'SERIAL%d' % idx)
+        print("Slow server:    slowest put() %.2f ms" % (put_times(reports, 100) * 1000))
+
+        # Outage: every request fails
+
+        handler.delay = 0.0
+        handler.failure_rate = 1.0
+        print("Server down:    slowest put() %.2f ms" % (put_times(reports, 100) * 1000))
+        time.sleep(0.5)
+        print("Queue depth", reports.depth(), "lag %.2f s," % reports.lag(), reports.failed, "failed attempts")
+        reports.close()
+
+        # Restart with the saved queue, with the inverters found in another order, and bring the server back
+
+        handler.failure_rate = 0.0
+        sender = reportqueue.HttpReport(url, timeout=0.5)
+        reports = reportqueue.ReportQueue(sender.send_total, sender.init, path, retry=0.05, maxretry=0.2)
+        for idx in range(3):
+            reports.init(idx, 'SERIAL%d' % (2 - idx))
+        if not wait_for(lambda: reports.depth() == 0, 10):
+            print("FAILED: queue not empty after the server came back")
+            sys.exit(1)
+        reports.close()
+
+    latest = {}
+    for report in handler.received:
+        latest[report['serial']] = report['energytotal_Wh']
+    expected = {'SERIAL%d' % idx: 1000000 * idx + 99 for idx in range(3)}
+    if latest != expected:
+        print("FAILED: server received", latest)
+        sys.exit(1)
+
+    print("Server back:    received", len(handler.received), "reports for 600 queued totals, latest totals correct")
+
+
+if __name__ == "__main__":
+    main()
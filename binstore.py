@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+# binstore.py
+
+# Append-only binary storage of inverter samples, in per-day segment files
+# Usage: python3 binstore.py <directory> [start [end]] > samples.csv
+# exports the samples in a directory (between ISO-format start and end
+# times, if given) in the same tab-separated layout as soliviamonitor.py
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Each segment file starts with a header:
+#
+#  - 8 bytes magic, b'SLVBIN01'
+#  - 4 bytes header length (little-endian), also the offset of the first record
+#  - 4 bytes record length (little-endian)
+#  - JSON description of the decoder and field layout, padded with zero-bytes
+#
+# followed by fixed-width records, each consisting of an 8-byte big-endian
+# double with the sample time (seconds since the epoch) and the data block
+# exactly as the inverter sent it. Records can be read without parsing,
+# e.g. with numpy.memmap(fname, dtype=numpy_dtype(header), offset=header['offset']).
+
+
+import csv
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+
+import decoder
+
+MAGIC = b'SLVBIN01'
+PREFIX = struct.Struct('<8sII')     # Magic, header length, record length
+TIME = struct.Struct('>d')          # Sample time at the start of every record
+ALIGN = 256                         # Header length is a multiple of this
+
+numpy_types = {'B': 'u1', 'H': '>u2', 'I': '>u4', 'h': '>i2', 'i': '>i4'}
+
+
+def make_header (dec, magic=MAGIC, recordsize=None):
+
+    """ Return the header for a segment with data blocks decoded by dec """
+
+    description = json.dumps({'version': 1, 'decoder': dec.name, 'layout': dec.layout,
+                              'identity': dec.identity,
+                              'hexfields': [dec.header[dec.identity + idx] for idx in dec.hexfields]})
+    description = description.encode('utf-8')
+    length = -(-(PREFIX.size + len(description)) // ALIGN) * ALIGN
+    if recordsize is None:
+        recordsize = TIME.size + dec.size
+    header = PREFIX.pack(magic, length, recordsize) + description
+    return header.ljust(length, b'\0')
+
+
+def read_header (f, magic=MAGIC):
+
+    """ Read and return the header of an open segment file as a dictionary """
+
+    found, length, recordsize = PREFIX.unpack(f.read(PREFIX.size))
+    if found != magic:
+        raise ValueError("Not a sample segment of this type: " + str(found))
+    header = json.loads(f.read(length - PREFIX.size).rstrip(b'\0').decode('utf-8'))
+    header['offset'] = length
+    header['recordsize'] = recordsize
+    header['layout'] = tuple(tuple(var) for var in header['layout'])
+    return header
+
+
+def header_decoder (header):
+
+    """ Return a decoder for the layout described in a segment header """
+
+    return decoder.BlockDecoder(header['decoder'], header['layout'],
+                                identity=header['identity'], hexfields=header['hexfields'])
+
+
+def numpy_dtype (header):
+
+    """ Return a NumPy dtype for the records in a segment """
+
+    import numpy
+
+    fields = [('time', '>f8')]
+    for var in header['layout']:
+        fmt = var[1]
+        fields.append((var[0], 'S' + fmt[:-1] if fmt.endswith('s') else numpy_types[fmt]))
+    return numpy.dtype(fields)
+
+
+def read_numpy (fname):
+
+    """ Return the records in a segment as a read-only NumPy structured array """
+
+    import numpy
+
+    with open(fname, 'rb') as f:
+        header = read_header(f)
+        count = (os.fstat(f.fileno()).st_size - header['offset']) // header['recordsize']
+
+    return numpy.memmap(fname, dtype=numpy_dtype(header), mode='r',
+                        offset=header['offset'], shape=(count,))
+
+
+def read_segment (fname, start=None, end=None):
+
+    """
+    Yield (time, decoder, record) for every complete record in a segment file,
+    optionally only for times (seconds since the epoch) from start up to end
+    """
+
+    with open(fname, 'rb') as f:
+
+        header = read_header(f)
+        dec = header_decoder(header)
+        offset = header['offset']
+        recordsize = header['recordsize']
+        size = os.fstat(f.fileno()).st_size
+
+        if size <= offset:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            end_data = offset + (size - offset) // recordsize * recordsize   # Ignore a partial last record
+            for pos in range(offset, end_data, recordsize):
+                t = TIME.unpack_from(m, pos)[0]
+                if start is not None and t < start:
+                    continue
+                if end is not None and t >= end:
+                    break
+                yield t, dec, dec.decode(m, pos + TIME.size)
+
+
+def segments (path, start=None, end=None, ext='.bin'):
+
+    """ Return the segment files in a directory, optionally only for days from start to end (datetimes) """
+
+    names = sorted(name for name in os.listdir(path) if name.endswith(ext))
+    if start:
+        names = [name for name in names if name[:-len(ext)] >= start.date().isoformat()]
+    if end:
+        names = [name for name in names if name[:-len(ext)] <= end.date().isoformat()]
+    return [os.path.join(path, name) for name in names]
+
+
+def last_time (path):
+
+    """ Return the time (seconds since the epoch) of the last record in a directory, or None """
+
+    for fname in reversed(segments(path)):
+        with open(fname, 'rb') as f:
+            header = read_header(f)
+            count = (os.fstat(f.fileno()).st_size - header['offset']) // header['recordsize']
+            if count:
+                f.seek(header['offset'] + (count - 1) * header['recordsize'])
+                return TIME.unpack(f.read(TIME.size))[0]
+    return None
+
+
+class SegmentWriter:
+
+    """
+    Append samples of one inverter to per-day segment files in a directory.
+    writerow() and writerows() mirror csv.writer, with (time, record) pairs as rows.
+    """
+
+    def __init__ (self, path, dec):
+
+        self.path = path
+        self.dec = dec
+        self.header = make_header(dec)
+        self.day = None
+        self.file = None
+
+        os.makedirs(path, exist_ok=True)
+
+    def _open (self, day):
+
+        """ Open the segment for a given date, and check that its layout matches ours """
+
+        if self.file:
+            self.file.close()
+
+        fname = os.path.join(self.path, day.isoformat() + '.bin')
+        self.file = open(fname, 'ab')
+        self.day = day
+
+        if self.file.tell() == 0:
+            self.file.write(self.header)
+        else:
+            with open(fname, 'rb') as f:
+                if f.read(len(self.header)) != self.header:
+                    raise ValueError("Segment " + fname + " has a different layout")
+            recordsize = TIME.size + self.dec.size
+            partial = (self.file.tell() - len(self.header)) % recordsize
+            if partial:                             # Skip a partial record, e.g. after a crash
+                self.file.truncate(self.file.tell() - partial)
+                self.file.seek(0, os.SEEK_END)
+
+    def writerow (self, row):
+
+        time, record = row
+
+        if time.date() != self.day:
+            self._open(time.date())
+
+        self.file.write(TIME.pack(time.timestamp()) + self.dec.struct.pack(*record))
+
+    def writerows (self, rows):
+        for row in rows:
+            self.writerow(row)
+        self.flush()
+
+    def flush (self):
+        if self.file:
+            self.file.flush()
+
+    def fileno (self):
+        return self.file.fileno()
+
+    def close (self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def export_csv (path, out, start=None, end=None, read=read_segment, ext='.bin'):
+
+    """
+    Write the samples in a directory to 'out' in the CSV layout of soliviamonitor.py,
+    using read(fname, start, end) to read the segments with extension ext
+    """
+
+    csvw = csv.writer(out, delimiter='\t')
+    t_start = start.timestamp() if start else None
+    t_end = end.timestamp() if end else None
+    header_written = False
+
+    for fname in segments(path, start, end, ext):
+        for t, dec, record in read(fname, t_start, t_end):
+            if not header_written:
+                csvw.writerow(["time"] + dec.subset_header)
+                header_written = True
+            csvw.writerow([datetime.datetime.fromtimestamp(t).isoformat()] + dec.subset(record))
+
+
+def main ():
+
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<directory> [start [end]]", file=sys.stderr)
+        sys.exit(1)
+
+    start = end = None
+    if len(sys.argv) > 2:
+        start = datetime.datetime.fromisoformat(sys.argv[2])
+    if len(sys.argv) > 3:
+        end = datetime.datetime.fromisoformat(sys.argv[3])
+
+    export_csv(sys.argv[1], sys.stdout, start, end)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+#!/usr/bin/python3
+
+# capture.py
+
+# Capture every valid message on the bus, exactly as it was received, in
+# per-day segment files with an index, so stored history can be decoded
+# again when the meaning of a field turns out to be different
+# Usage: python3 capture.py <capture directory> <output directory> [field map [processes]]
+#        python3 capture.py --fieldmap [decoder name] > fieldmap.json
+# The first form decodes all data blocks in the captures again, with the
+# field map if given, and writes tab-separated files in the layout of
+# soliviamonitor.py to the output directory, one per bus, bus ID and day.
+# Segments are decoded in parallel, by a pool of processes (one per CPU by
+# default). The second form prints the field map of a decoder (default
+# RPI_M) as a starting point for corrections.
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# A capture segment, <date>.cap, starts with 8 bytes magic, b'SLVCAP01',
+# followed by records (little-endian):
+#
+#  - 8 bytes wall-clock time of arrival (seconds since the epoch, double)
+#  - 8 bytes monotonic time of arrival (double)
+#  - 1 byte bus index, 2 bytes length of the message
+#  - the message, from STX to ETX
+#
+# Its index, <date>.cap.idx, starts with 8 bytes magic, b'SLVCIX01',
+# followed by a 16-byte entry for every record: the wall-clock time
+# (double) and the offset of the record in the segment (64-bit). Both can
+# be used with mmap, e.g. record n is at the offset in index entry n. If
+# the collector stopped between writing a record and its index entry, the
+# missing entries are added when the segment is opened for writing again.
+#
+# A field map is a JSON object in the format of the description in a
+# binstore.py segment header: the decoder name, its layout (like
+# protocol.rvars), the number of identity fields and the hex fields.
+# A data block is decoded with the field map if it has the size of that
+# layout, other blocks with the decoder that matches them.
+
+
+import bisect
+import csv
+import datetime
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+from time import monotonic
+
+import binstore
+import decoder
+import framing
+
+MAGIC = b'SLVCAP01'
+INDEX_MAGIC = b'SLVCIX01'
+RECORD = struct.Struct('<ddBH')         # Wall-clock time, monotonic time, bus index, message length
+ENTRY = struct.Struct('<dQ')            # Wall-clock time, offset of the record
+COMMAND = b'\x60\x01'                   # Replies to this command have a data block
+DATA_OFFSET = 6                         # Start of the data block in a reply
+
+verbose = 1
+
+
+def scan (m, start, end):
+
+    """ Yield (offset, wall-clock time) of the complete records in m from offset start up to end """
+
+    pos = start
+    while pos + RECORD.size <= end:
+        wall, received, bus_idx, length = RECORD.unpack_from(m, pos)
+        if pos + RECORD.size + length > end:
+            break
+        yield pos, wall
+        pos += RECORD.size + length
+
+
+class CaptureWriter:
+
+    """
+    Append messages to per-day capture segments in a directory. Data is
+    written to disk every 'interval' seconds, and by flush() and close().
+    """
+
+    def __init__ (self, path, interval=60):
+
+        self.path = path
+        self.interval = interval
+        self.day = None
+        self.file = None
+        self.index = None
+        self.offset = 0                 # Where the next record goes in the segment
+        self.flushed = monotonic()
+        self.frames = 0
+
+        os.makedirs(path, exist_ok=True)
+
+    def _open (self, day):
+
+        """ Open the segment for a given date, and repair its end and index after a crash """
+
+        self.close()
+
+        fname = os.path.join(self.path, day.isoformat() + '.cap')
+        self.file = open(fname, 'ab')
+        self.index = open(fname + '.idx', 'ab')
+        self.day = day
+
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        if self.index.tell() == 0:
+            self.index.write(INDEX_MAGIC)
+        self.file.flush()
+        self.index.flush()
+
+        # Drop index entries for records that were not written completely,
+        # index the complete records after them, and cut off a partial record
+
+        count = (self.index.tell() - len(INDEX_MAGIC)) // ENTRY.size
+
+        with open(fname, 'rb') as f, open(fname + '.idx', 'rb') as idx, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+
+            records = []
+            while count:
+                idx.seek(len(INDEX_MAGIC) + (count - 1) * ENTRY.size)
+                offset = ENTRY.unpack(idx.read(ENTRY.size))[1]
+                records = list(scan(m, offset, len(m)))
+                if records and records[0][0] == offset:
+                    break
+                count -= 1
+
+            if not count:
+                records = list(scan(m, len(MAGIC), len(m)))
+            end = len(MAGIC)
+            if records:
+                offset = records[-1][0]
+                end = offset + RECORD.size + RECORD.unpack_from(m, offset)[3]
+            entries = [ENTRY.pack(wall, offset) for offset, wall in records[1 if count else 0:]]
+
+        self.index.truncate(len(INDEX_MAGIC) + count * ENTRY.size)
+        self.index.seek(0, os.SEEK_END)
+        self.index.write(b''.join(entries))
+        self.file.truncate(end)
+        self.file.seek(0, os.SEEK_END)
+        self.offset = self.file.tell()
+
+    def append (self, bus_idx, received, wall, data):
+
+        """ Add a message that arrived at monotonic time received and wall-clock time wall """
+
+        day = datetime.date.fromtimestamp(wall)
+        if day != self.day:
+            self._open(day)
+
+        self.file.write(RECORD.pack(wall, received, bus_idx, len(data)) + data)
+        self.index.write(ENTRY.pack(wall, self.offset))
+        self.offset += RECORD.size + len(data)
+        self.frames += 1
+
+        if monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush (self):
+
+        """ Write buffered records to disk, the segment before its index """
+
+        if self.file:
+            self.file.flush()
+            self.index.flush()
+        self.flushed = monotonic()
+
+    def close (self):
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.index.close()
+            self.file = None
+            self.index = None
+
+
+class CaptureSegment:
+
+    """ Read access to a capture segment through its index: segment[n] is (wall, received, bus index, message) """
+
+    def __init__ (self, fname):
+
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(fname + " is not a capture segment")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with open(fname + '.idx', 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(fname + ".idx is not a capture index")
+            count = (os.fstat(f.fileno()).st_size - len(INDEX_MAGIC)) // ENTRY.size
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if count else b''
+
+        # Ignore index entries for records that were not written completely
+
+        while count and self._end(count - 1) > len(self.data):
+            count -= 1
+        self.count = count
+
+    def _entry (self, n):
+        return ENTRY.unpack_from(self.index, len(INDEX_MAGIC) + n * ENTRY.size)
+
+    def _end (self, n):
+        offset = self._entry(n)[1]
+        if offset + RECORD.size > len(self.data):
+            return offset + RECORD.size
+        return offset + RECORD.size + RECORD.unpack_from(self.data, offset)[3]
+
+    def __len__ (self):
+        return self.count
+
+    def __getitem__ (self, n):
+        if not 0 <= n < self.count:
+            raise IndexError("record " + str(n) + " is not in " + self.fname)
+        offset = self._entry(n)[1]
+        wall, received, bus_idx, length = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        return wall, received, bus_idx, self.data[start:start + length]
+
+    def find (self, t):
+
+        """ Return the number of the first record at or after wall-clock time t """
+
+        class Times:
+            def __len__ (inner):
+                return self.count
+            def __getitem__ (inner, n):
+                return self._entry(n)[0]
+
+        return bisect.bisect_left(Times(), t)
+
+    def records (self, start=None, end=None):
+
+        """ Yield the records with wall-clock times from start up to end (seconds since the epoch) """
+
+        for n in range(self.find(start) if start is not None else 0, self.count):
+            record = self[n]
+            if end is not None and record[0] >= end:
+                break
+            yield record
+
+    def close (self):
+        self.data.close()
+        if self.index:
+            self.index.close()
+
+
+def fieldmap (dec):
+
+    """ Return the field map of a decoder, as a dictionary for JSON """
+
+    return json.loads(binstore.make_header(dec)[binstore.PREFIX.size:].rstrip(b'\0').decode('utf-8'))
+
+
+def map_decoder (mapping):
+
+    """ Return a decoder for a field map """
+
+    return binstore.header_decoder(dict(mapping, layout=tuple(tuple(var) for var in mapping['layout'])))
+
+
+def redecode_segment (fname, outpath, mapping=None):
+
+    """
+    Decode the data blocks in a capture segment, and write them to a file per
+    bus and bus ID in outpath. Returns (segment, messages, data blocks, blocks
+    with an unknown layout).
+    """
+
+    dec_map = map_decoder(mapping) if mapping else None
+    segment = CaptureSegment(fname)
+    day = os.path.basename(fname)[:-len('.cap')]
+    files = {}
+    writers = {}
+    blocks = unknown = 0
+
+    try:
+        for wall, received, bus_idx, data in segment.records():
+
+            if data[1] != framing.ACK or data[4:6] != COMMAND:
+                continue
+
+            length = data[3] - 2
+            if dec_map and dec_map.size == length:
+                dec = dec_map
+            else:
+                dec = decoder.lookup(data, DATA_OFFSET, length)
+            if not dec:
+                unknown += 1
+                continue
+
+            key = (bus_idx, data[2], dec.name)
+            writer = writers.get(key)
+            if not writer:
+                name = "%d-%d-%s-%s.csv" % (bus_idx, data[2], dec.name, day)
+                files[key] = open(os.path.join(outpath, name), 'w')
+                writer = writers[key] = csv.writer(files[key], delimiter='\t')
+                writer.writerow(["time"] + dec.subset_header)
+
+            writer.writerow([datetime.datetime.fromtimestamp(wall).isoformat()] +
+                            dec.subset(dec.decode(data, DATA_OFFSET)))
+            blocks += 1
+
+    finally:
+        for f in files.values():
+            f.close()
+        count = len(segment)
+        segment.close()
+
+    return fname, count, blocks, unknown
+
+
+def _redecode (args):
+    return redecode_segment(*args)
+
+
+def redecode (path, outpath, mapping=None, processes=None, start=None, end=None):
+
+    """
+    Decode all capture segments in a directory again, optionally only for days
+    from start to end (datetimes), spread over a pool of processes. Returns
+    the total numbers of messages, data blocks and unknown blocks.
+    """
+
+    os.makedirs(outpath, exist_ok=True)
+    jobs = [(fname, outpath, mapping) for fname in binstore.segments(path, start, end, '.cap')]
+    totals = [0, 0, 0]
+
+    with multiprocessing.Pool(processes) as pool:
+        for fname, *counts in pool.imap_unordered(_redecode, jobs):
+            totals = [total + count for total, count in zip(totals, counts)]
+            if verbose:
+                print(os.path.basename(fname) + ":", counts[0], "messages,", counts[1], "data blocks,",
+                      counts[2], "unknown", file=sys.stderr)
+
+    return tuple(totals)
+
+
+def main ():
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--fieldmap':
+        dec = decoder.find(sys.argv[2] if len(sys.argv) > 2 else decoder.rpi_m.name)
+        if not dec:
+            print("Unknown decoder, use one of", ", ".join(d.name for d in decoder.decoders), file=sys.stderr)
+            sys.exit(1)
+        json.dump(fieldmap(dec), sys.stdout, indent=4)
+        print()
+        return
+
+    if len(sys.argv) < 3:
+        print("Usage:", sys.argv[0], "<capture directory> <output directory> [field map [processes]]", file=sys.stderr)
+        print("      ", sys.argv[0], "--fieldmap [decoder name] > fieldmap.json", file=sys.stderr)
+        sys.exit(1)
+
+    mapping = None
+    if len(sys.argv) > 3 and sys.argv[3]:
+        with open(sys.argv[3]) as f:
+            mapping = json.load(f)
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    start = monotonic()
+    messages, blocks, unknown = redecode(sys.argv[1], sys.argv[2], mapping, processes)
+    print("Decoded", blocks, "data blocks in", messages, "messages in %.1f s," % (monotonic() - start),
+          unknown, "with an unknown layout", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import array
+import sys
+
 INITIAL_MODBUS = 0xFFFF
 INITIAL_DF1 = 0x0000
 
@@ -58,14 +61,76 @@ table = (
 0x4400, 0x84C1, 0x8581, 0x4540, 0x8701, 0x47C0, 0x4680, 0x8641,
 0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081, 0x4040 )
 
+# Table for processing two bytes per step. With a 16-bit CRC register,
+# two bytes shift out the whole register, so the new CRC depends only on
+# the register XOR-ed with the next two bytes (little-endian).
+# Built on first use, since it takes a few milliseconds, as an array of
+# 16-bit values (128 kB, a list of int objects would take about 2 MB).
+
+table16 = None
+
+def _buildTable16():
+    global table16
+    table16 = array.array('H', ((table[lo] >> 8) ^ table[(hi ^ table[lo]) & 0xFF]
+                                for hi in range(256) for lo in range(256)))
+    return table16
+
 def calcByte(byte, crc):
     """Given a new Byte and previous CRC, calculate a new CRC-16"""
     crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
     return (crc & 0xFFFF)
 
-def calcData(data, crc=INITIAL_DF1):
-    """Given binary data and starting CRC, calculate a final CRC-16"""
+def calcDataTable(data, crc=INITIAL_DF1):
+    """Given binary data and starting CRC, calculate a final CRC-16, one byte per step"""
     for byte in data:
         crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
     return crc
-	
+
+def calcDataPairs(data, crc=INITIAL_DF1):
+    """Given binary data and starting CRC, calculate a final CRC-16, two bytes per step"""
+    t16 = table16 or _buildTable16()
+    length = len(data)
+    words = array.array('H')
+    words.frombytes(data[:length & ~1])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    for word in words:
+        crc = t16[crc ^ word]
+    if length & 1:
+        crc = (crc >> 8) ^ table[(crc ^ data[length - 1]) & 0xFF]
+    return crc
+
+# Use the fastest available implementation for calcData():
+# the C-extension of crcmod if installed, otherwise the two-byte table
+
+try:
+    import crcmod
+    if not crcmod._usingExtension:
+        raise ImportError("crcmod C-extension not available")
+    _crcmodFun = crcmod.mkCrcFun(0x18005, initCrc=INITIAL_DF1, rev=True)
+
+    def calcDataCrcmod(data, crc=INITIAL_DF1):
+        """Given binary data and starting CRC, calculate a final CRC-16 using crcmod"""
+        if not isinstance(data, bytes):
+            data = bytes(data)      # crcmod only accepts read-only buffers
+        return _crcmodFun(data, crc)
+
+    calcData = calcDataCrcmod
+except (ImportError, AttributeError):
+    calcData = calcDataPairs
+
+class CRC16:
+    """Incremental CRC-16, for computing the CRC while data streams in"""
+
+    def __init__(self, data=b'', crc=INITIAL_DF1):
+        self.crc = crc
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        """Add binary data to the CRC, and return the CRC so far"""
+        self.crc = calcData(data, self.crc)
+        return self.crc
+
+    def copy(self):
+        return CRC16(crc=self.crc)
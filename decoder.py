@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+
+# decoder.py
+
+# Registry of data block decoders for different Delta Solivia inverter models
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+
+import collections
+import struct
+
+import protocol
+
+
+def attrname (name):
+
+    """ Turn a variable name from a layout into a valid attribute name, e.g. bus+V into busposV """
+
+    return name.replace('+', 'pos').replace('-', 'neg')
+
+
+class BlockDecoder:
+
+    """
+    Decoder for the data block that an inverter model returns in reply to
+    command 0x60 0x01. The layout is a tuple of variables in the same format
+    as protocol.rvars: name, struct-definition, size in bytes, and optionally
+    multiplier-exponent (10^x), unit and SunSpec equivalent.
+    """
+
+    def __init__(self, name, layout, partnos=(), identity=12, hexfields=()):
+
+        self.name = name
+        self.layout = layout
+        self.partnos = tuple(partnos)   # Part number prefixes of models that use this layout
+
+        self.struct = struct.Struct(">" + "".join(var[1] for var in layout))
+        self.size = self.struct.size
+        self.header = [var[0] for var in layout]
+        self.index = {var[0]: idx for idx, var in enumerate(layout)}
+        self.record = collections.namedtuple(name, [attrname(var[0]) for var in layout])
+
+        # Multiplier, divisor and unit for every variable that has an exponent
+        # (dividing by 10 is more accurate than multiplying by 0.1)
+
+        self.scales = tuple((idx, 10 ** max(var[3], 0), 10 ** max(-var[3], 0), var[4])
+                            for idx, var in enumerate(layout) if len(var) > 4)
+
+        # The first 'identity' variables (part number, serial, firmware) are not
+        # stored with each sample, variables in 'hexfields' are stored as hex values
+
+        self.identity = identity
+        self.subset_header = self.header[identity:]
+        self.hexfields = tuple(self.index[name] - identity for name in hexfields)
+
+        # Offset of every variable in the block, so single variables can be
+        # unpacked without the rest (see select())
+
+        self.offsets = []
+        offset = 0
+        for var in layout:
+            self.offsets.append(offset)
+            offset += var[2]
+        self.identity_size = self.offsets[identity] if identity < len(layout) else self.size
+        self.selections = {}
+
+    def matches (self, data, offset, length):
+
+        """ Return True if a data block at offset in data is probably meant for this decoder """
+
+        if length != self.size:
+            return False
+        if not self.partnos:
+            return True
+        return bytes(data[offset:offset + 11]).startswith(self.partnos)
+
+    def decode (self, data, offset=0):
+
+        """ Unpack a data block directly from a buffer, and return a record of raw values """
+
+        return self.record._make(self.struct.unpack_from(data, offset))
+
+    def select (self, names):
+
+        """ Return a Selection that decodes only the given variables """
+
+        names = tuple(names)
+        selection = self.selections.get(names)
+        if selection is None:
+            selection = self.selections[names] = Selection(self, names)
+        return selection
+
+    def scaled (self, record):
+
+        """ Return a dictionary with the values of all variables that have a unit, scaled to that unit """
+
+        header = self.header
+        return {header[idx]: record[idx] / div if div > 1 else record[idx] * mul
+                for idx, mul, div, unit in self.scales}
+
+    def units (self):
+        return {self.header[idx]: unit for idx, mul, div, unit in self.scales}
+
+    def subset (self, record):
+
+        """ Return the part of a record that we store with each sample """
+
+        subset = list(record[self.identity:])
+        for idx in self.hexfields:              # Variables with unknown meaning, store as hex value
+            value = subset[idx]
+            subset[idx] = value.hex() if isinstance(value, bytes) else hex(value)
+        return subset
+
+
+class Selection:
+
+    """
+    Decoder for only some variables of a data block, e.g. power and
+    energytotal_day for reporting. A single struct with pad bytes for the
+    variables in between unpacks them at their known offsets, so the
+    others are never converted.
+    """
+
+    def __init__ (self, dec, names):
+
+        self.dec = dec
+        self.names = names
+
+        indexes = sorted(set(dec.index[name] for name in names))
+        fmt = ">"
+        pos = 0
+        for idx in indexes:
+            if dec.offsets[idx] > pos:
+                fmt += str(dec.offsets[idx] - pos) + "x"
+            fmt += dec.layout[idx][1]
+            pos = dec.offsets[idx] + dec.layout[idx][2]
+
+        self.struct = struct.Struct(fmt)
+        self.order = [indexes.index(dec.index[name]) for name in names]
+        if self.order == list(range(len(indexes))):
+            self.order = None               # Already in the order of the layout
+        self.record = collections.namedtuple(dec.name + "_selection", [attrname(name) for name in names])
+
+    def decode (self, data, offset=0):
+
+        """ Unpack the selected variables from a data block in a buffer, and return them as a record """
+
+        values = self.struct.unpack_from(data, offset)
+        if self.order:
+            values = [values[idx] for idx in self.order]
+        return self.record._make(values)
+
+
+Identity = collections.namedtuple('Identity', 'decoder raw record serial')
+
+
+class IdentityCache:
+
+    """
+    Identity variables (part number, serial, firmware revisions) of each
+    inverter, decoded on first contact. They never change for a given bus
+    ID, so later replies are only checked by comparing the raw bytes.
+    """
+
+    def __init__ (self):
+        self.identities = {}        # Key (e.g. bus ID) -> Identity
+        self.changes = 0            # Identities that changed, e.g. after replacing an inverter
+
+    def get (self, key, dec, data, offset=0):
+
+        """ Return the Identity of the inverter that sent the data block at offset in data """
+
+        identity = self.identities.get(key)
+        end = offset + dec.identity_size
+
+        if identity is not None and identity.decoder is dec and data[offset:end] == identity.raw:
+            return identity
+
+        if identity is not None:
+            self.changes += 1
+
+        record = dec.select(dec.header[:dec.identity]).decode(data, offset)
+        serial = str(record.serial, "ascii") if "serial" in dec.index else ""
+        identity = self.identities[key] = Identity(dec, bytes(data[offset:end]), record, serial)
+        return identity
+
+
+# Known layouts, searched in order. Decoders with part number prefixes
+# should be registered before decoders that only check the block length.
+
+decoders = []
+
+
+def register (decoder):
+    decoders.append(decoder)
+    return decoder
+
+
+def find (name):
+
+    """ Return the registered decoder with a given name, or None """
+
+    for decoder in decoders:
+        if decoder.name == name:
+            return decoder
+    return None
+
+
+def lookup (data, offset, length):
+
+    """ Return the decoder for a data block of 'length' bytes at offset in data, or None """
+
+    for decoder in decoders:
+        if decoder.matches(data, offset, length):
+            return decoder
+    return None
+
+
+# Delta Solivia RPI M-series (European three-phase), e.g. M15A and M20A
+
+rpi_m = register(BlockDecoder("RPI_M", protocol.rvars, hexfields=("bus+V", "bus-V")))
+
+# Delta Solivia NA G4 (North-American split-phase). Only the part number and
+# serial are known, the rest of the 148-byte block is stored as a hex string.
+
+rvars_na_g4 = (("partno", "11s", 11),
+               ("serial", "18s", 18),
+               ("data", "119s", 119))
+
+na_g4 = register(BlockDecoder("NA_G4", rvars_na_g4, identity=2, hexfields=("data",)))
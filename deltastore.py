@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+
+# deltastore.py
+
+# Compact storage of inverter samples: a full keyframe every so often, and
+# in between only the variables that changed since the previous sample
+# Usage: python3 deltastore.py <directory> [start [end]] > samples.csv
+# exports the samples in a directory in the same tab-separated layout as
+# soliviamonitor.py
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Segment files (one per day, named YYYY-MM-DD.dlt) start with the same
+# header as binstore.py segments, with magic b'SLVDLT01' and a record length
+# of 0. Each record that follows consists of:
+#
+#  - 1 byte record type, 0 for a keyframe or 1 for a delta
+#  - record length as a varint (7 bits per byte, least significant first)
+#  - keyframe: 8-byte big-endian double with the sample time (seconds since
+#    the epoch, rounded to milliseconds like the deltas), and the data block
+#    exactly as the inverter sent it
+#  - delta: time since the previous sample in milliseconds as a varint, a
+#    bitmap of the variables that changed (one bit per variable, least
+#    significant bit of the first byte is the first variable), and for each
+#    changed variable: the difference with the previous value as a zigzag
+#    varint for numbers, or the new value for byte strings
+#
+# Status bytes, firmware versions and the status history hardly ever
+# change, and at night all power values stay zero, so most deltas are only
+# a few bytes. Every segment starts with a keyframe, and so does a writer
+# that opens an existing segment or gets a sample from before the previous
+# one (e.g. after the clock was set back), so a segment can always be
+# decoded on its own and a partial record at the end (after a crash) is
+# simply ignored. Reading stops at a record that can't be decoded.
+
+
+import datetime
+import os
+import struct
+import sys
+
+import binstore
+
+MAGIC = b'SLVDLT01'
+KEYFRAME = 0
+DELTA = 1
+EXT = '.dlt'
+
+
+def put_varint (out, value):
+
+    """ Append an unsigned integer to a bytearray as a varint """
+
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def get_varint (data, pos):
+
+    """ Return the varint at pos in data, and the position after it """
+
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class Codec:
+
+    """ Encode and decode the records of one data block layout (a decoder.BlockDecoder) """
+
+    def __init__ (self, dec):
+
+        self.dec = dec
+        self.numeric = tuple(not var[1].endswith('s') for var in dec.layout)
+        self.bitmap_size = (len(dec.layout) + 7) // 8
+
+    def keyframe (self, t, record):
+        body = binstore.TIME.pack(t) + self.dec.struct.pack(*record)
+        out = bytearray([KEYFRAME])
+        put_varint(out, len(body))
+        return out + body
+
+    def delta (self, dt_ms, previous, record):
+
+        """ Return a delta record, with the time since the previous record in milliseconds """
+
+        body = bytearray()
+        put_varint(body, dt_ms)
+        bitmap_pos = len(body)
+        body.extend(bytes(self.bitmap_size))
+        bitmap = 0
+
+        for idx, (old, new) in enumerate(zip(previous, record)):
+            if old == new:
+                continue
+            bitmap |= 1 << idx
+            if self.numeric[idx]:
+                diff = new - old
+                put_varint(body, diff << 1 if diff >= 0 else (-diff << 1) - 1)     # Zigzag
+            else:
+                body.extend(new)
+
+        body[bitmap_pos:bitmap_pos + self.bitmap_size] = bitmap.to_bytes(self.bitmap_size, 'little')
+
+        out = bytearray([DELTA])
+        put_varint(out, len(body))
+        return out + body
+
+    def records (self, data, pos=0, end=None):
+
+        """ Yield (time, record) for every complete record in data from pos, up to the first one that is corrupt """
+
+        dec = self.dec
+        make = dec.record._make
+        numeric = self.numeric
+        sizes = tuple(var[2] for var in dec.layout)
+        bitmap_size = self.bitmap_size
+        time_size = binstore.TIME.size
+        unpack_time = binstore.TIME.unpack_from
+
+        if end is None:
+            end = len(data)
+
+        t = t_ms = None
+        values = None
+
+        while pos < end:
+
+            kind = data[pos]
+            try:
+                length, start = get_varint(data, pos + 1)
+            except IndexError:
+                return                              # Partial record at the end
+            if start + length > end:
+                return
+
+            try:
+                if kind == KEYFRAME:
+                    if length != time_size + dec.size:
+                        raise ValueError("keyframe of " + str(length) + " bytes")
+                    t = unpack_time(data, start)[0]
+                    t_ms = round(t * 1000)
+                    values = list(dec.struct.unpack_from(data, start + time_size))
+
+                elif kind == DELTA and values is not None:
+                    dt_ms, p = get_varint(data, start)
+                    t_ms += dt_ms
+                    t = t_ms / 1000
+                    bitmap = int.from_bytes(data[p:p + bitmap_size], 'little')
+                    p += bitmap_size
+                    while bitmap:
+                        low = bitmap & -bitmap
+                        idx = low.bit_length() - 1
+                        bitmap ^= low
+                        if numeric[idx]:
+                            zz, p = get_varint(data, p)
+                            values[idx] += -(zz + 1 >> 1) if zz & 1 else zz >> 1
+                        else:
+                            values[idx] = bytes(data[p:p + sizes[idx]])
+                            p += sizes[idx]
+                    if p > start + length:
+                        raise ValueError("delta longer than its record")
+
+                else:
+                    raise ValueError("record type " + str(kind) + (" without a keyframe" if kind == DELTA else ""))
+
+            except (IndexError, ValueError, struct.error) as error:
+                print("Corrupt record at offset", pos, "(" + str(error) + "), ignoring the rest of the segment",
+                      file=sys.stderr)
+                return
+
+            pos = start + length
+            yield t, make(values)
+
+
+def read_segment (fname, start=None, end=None):
+
+    """
+    Yield (time, decoder, record) for every complete record in a segment file,
+    optionally only for times (seconds since the epoch) from start up to end
+    """
+
+    with open(fname, 'rb') as f:
+        header = binstore.read_header(f, MAGIC)
+        dec = binstore.header_decoder(header)
+        data = f.read()
+
+    for t, record in Codec(dec).records(data):
+        if start is not None and t < start:
+            continue
+        if end is not None and t >= end:
+            continue                    # Not break, the clock may have been set back
+        yield t, dec, record
+
+
+def segment_end (fname, offset):
+
+    """ Return the offset just after the last complete record in a segment, and its time """
+
+    with open(fname, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+
+    pos = 0
+    t_ms = None
+    while pos < len(data):
+        try:
+            length, start = get_varint(data, pos + 1)
+        except IndexError:
+            break
+        if start + length > len(data):
+            break
+        if data[pos] == KEYFRAME:
+            t_ms = round(binstore.TIME.unpack_from(data, start)[0] * 1000)
+        elif t_ms is not None:
+            t_ms += get_varint(data, start)[0]
+        pos = start + length
+
+    return offset + pos, t_ms / 1000 if t_ms is not None else None
+
+
+def last_time (path):
+
+    """ Return the time (seconds since the epoch) of the last record in a directory, or None """
+
+    for fname in reversed(binstore.segments(path, ext=EXT)):
+        with open(fname, 'rb') as f:
+            offset = binstore.read_header(f, MAGIC)['offset']
+        end, t = segment_end(fname, offset)
+        if t is not None:
+            return t
+    return None
+
+
+class SegmentWriter:
+
+    """
+    Append samples of one inverter to per-day delta-encoded segment files in a
+    directory, with a keyframe every 'keyframes' samples. writerow() and
+    writerows() mirror csv.writer, with (time, record) pairs as rows.
+    """
+
+    def __init__ (self, path, dec, keyframes=60):
+
+        self.path = path
+        self.dec = dec
+        self.codec = Codec(dec)
+        self.keyframes = keyframes
+        self.header = binstore.make_header(dec, MAGIC, 0)
+        self.day = None
+        self.file = None
+        self.previous = None        # Previous record, time in milliseconds and count since the last keyframe
+
+        os.makedirs(path, exist_ok=True)
+
+    def _open (self, day):
+
+        """ Open the segment for a given date, and check that its layout matches ours """
+
+        if self.file:
+            self.file.close()
+
+        fname = os.path.join(self.path, day.isoformat() + EXT)
+        self.file = open(fname, 'ab')
+        self.day = day
+        self.previous = None            # Start with a keyframe
+
+        if self.file.tell() == 0:
+            self.file.write(self.header)
+        else:
+            with open(fname, 'rb') as f:
+                if f.read(len(self.header)) != self.header:
+                    raise ValueError("Segment " + fname + " has a different layout")
+            end, t = segment_end(fname, len(self.header))
+            if end < self.file.tell():      # Skip a partial record, e.g. after a crash
+                self.file.truncate(end)
+                self.file.seek(0, os.SEEK_END)
+
+    def writerow (self, row):
+
+        time, record = row
+
+        if time.date() != self.day:
+            self._open(time.date())
+
+        t_ms = int(round(time.timestamp() * 1000))
+
+        # A delta can't go back in time, so a sample from before the previous one gets a keyframe
+
+        if self.previous is None or self.previous[2] >= self.keyframes - 1 or t_ms < self.previous[1]:
+            self.file.write(self.codec.keyframe(t_ms / 1000, record))
+            self.previous = (record, t_ms, 0)
+        else:
+            previous, previous_ms, count = self.previous
+            self.file.write(self.codec.delta(t_ms - previous_ms, previous, record))
+            self.previous = (record, t_ms, count + 1)
+
+    def writerows (self, rows):
+        for row in rows:
+            self.writerow(row)
+        self.flush()
+
+    def flush (self):
+        if self.file:
+            self.file.flush()
+
+    def fileno (self):
+        return self.file.fileno()
+
+    def close (self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def main ():
+
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<directory> [start [end]]", file=sys.stderr)
+        sys.exit(1)
+
+    start = end = None
+    if len(sys.argv) > 2:
+        start = datetime.datetime.fromisoformat(sys.argv[2])
+    if len(sys.argv) > 3:
+        end = datetime.datetime.fromisoformat(sys.argv[3])
+
+    binstore.export_csv(sys.argv[1], sys.stdout, start, end, read_segment, EXT)
+
+
+if __name__ == "__main__":
+    main()
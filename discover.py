@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+
+# discover.py
+
+# Find the inverters on an RS485 bus: probe bus IDs 1 to 254 at the common
+# baud rates, and write the port, baud rate, bus IDs, part numbers, serials
+# and reply latencies to a site configuration for the collectors
+# Usage: python3 discover.py <port> [site config [baud rate,...]]
+# e.g. python3 discover.py /dev/ttyUSB0 /root/delta/site.json 19200,9600
+# The site configuration has the same format as the configuration file of
+# multibus.py (python3 multibus.py site.json), soliviamonitor.py reads the
+# first bus from it at startup. Other settings in an existing file are kept.
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Probing one ID at a time and waiting a second for each reply would take
+# over four minutes per baud rate. Instead, requests for a window of IDs
+# are sent back to back, and the replies are collected until the time-out
+# after the last request. Most IDs are unused, so most windows stay quiet.
+# RS485 is half duplex: an inverter that answers while later requests of
+# the window are still being sent collides with them, and an inverter whose
+# request was damaged this way stays silent without any error showing. So
+# if anything at all was received during a window, the IDs in it that did
+# not answer are probed again one at a time. The time-out starts at 0.3 s and
+# adapts to twice the slowest reply seen, plus the transmission time of a
+# reply at the baud rate. Every inverter that answered is probed a few more
+# times on its own, to confirm it and to measure its reply latency.
+
+
+import datetime
+import json
+import os
+import selectors
+import statistics
+import sys
+import termios
+import tty
+from time import monotonic
+
+import decoder
+import framing
+import protocol
+
+verbose = 1
+
+RATES = (19200, 9600, 38400, 4800, 2400)    # Common baud rates, inverters default to 19200
+COMMAND = b'\x60\x01'                       # Request for a data block, the reply has the part number and serial
+REQUEST_LEN = 9                             # Bytes in a request
+REPLY_LEN = 164                             # Bytes in the longest reply we know (RPI M)
+
+
+def open_port (port):
+
+    """ Open a serial port in raw mode, and return its file descriptor """
+
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    tty.setraw(fd)
+    return fd
+
+
+def set_baudrate (fd, baudrate):
+
+    """ Set the speed of a serial port, and drop whatever is waiting in its buffers """
+
+    speed = getattr(termios, 'B' + str(baudrate))
+    attrs = termios.tcgetattr(fd)
+    attrs[4] = attrs[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    termios.tcflush(fd, termios.TCIOFLUSH)
+
+
+def identify (frame):
+
+    """ Return the part number, serial and data block layout in a reply """
+
+    length = frame[3] - 2
+    dec = decoder.lookup(frame, 6, length)
+    if dec:
+        identity = decoder.IdentityCache().get(0, dec, frame, 6).record
+        partno, serial = identity.partno, identity.serial
+    else:
+        partno, serial = frame[6:17], frame[17:35]      # Where all known layouts have them
+    return (partno.decode('ascii', 'replace').strip('\x00 '), serial.decode('ascii', 'replace').strip('\x00 '),
+            dec.name if dec else None)
+
+
+class Discovery:
+
+    """
+    Probe the bus IDs on a serial port (an open file descriptor) with
+    pipelined requests, in windows of 'window' IDs
+    """
+
+    def __init__ (self, fd, ids=range(1, 255), window=16, timeout=0.3, min_timeout=0.05, probes=3):
+
+        self.fd = fd
+        self.ids = list(ids)
+        self.window = window
+        self.initial_timeout = timeout      # Seconds to wait for an inverter to start its reply
+        self.timeout = timeout
+        self.slowest = None                 # Longest time an inverter took to start its reply
+        self.min_timeout = min_timeout
+        self.probes = probes                # Extra requests to each inverter that answered
+        self.baudrate = None
+        self.reader = framing.FrameReader()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(fd, selectors.EVENT_READ)
+        self.requests = 0
+
+    def _errors (self):
+        reader = self.reader
+        return reader.crc_errors + reader.etx_errors + reader.discarded
+
+    def _write (self, data):
+        while data:
+            try:
+                data = data[os.write(self.fd, data):]
+            except BlockingIOError:
+                self.selector.modify(self.fd, selectors.EVENT_WRITE)
+                self.selector.select(1)
+                self.selector.modify(self.fd, selectors.EVENT_READ)
+
+    def probe (self, ids):
+
+        """
+        Send requests to the given bus IDs back to back, and collect the replies.
+        Returns {bus ID: (reply, latency in seconds)}, and True if garbled data
+        was received (e.g. from two inverters answering at the same time, or a
+        reply cut short).
+        """
+
+        byte_time = 10 / self.baudrate          # 8 data bits, start and stop bit
+        reply_time = REPLY_LEN * byte_time
+        errors = self._errors()
+
+        start = monotonic()
+        self._write(b''.join(protocol.build_request(inv_id, COMMAND) for inv_id in ids))
+        self.requests += len(ids)
+
+        # Estimated time at which each request has been transmitted
+
+        sent = {inv_id: start + (n + 1) * REQUEST_LEN * byte_time for n, inv_id in enumerate(ids)}
+        deadline = sent[ids[-1]] + self.timeout + reply_time
+        extended = False
+        replies = {}
+
+        while len(replies) < len(ids):
+
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                if self.reader.buffer and not extended:     # A reply is still coming in
+                    deadline += reply_time
+                    extended = True
+                    continue
+                break
+
+            if not self.selector.select(remaining):
+                continue
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                continue
+            now = monotonic()
+
+            for frame in self.reader.feed(data):
+                inv_id = frame[2]
+                if frame[1] == framing.ACK and inv_id in sent and inv_id not in replies:
+                    replies[inv_id] = (frame, now - sent[inv_id])
+
+        garbled = self._errors() != errors or bool(self.reader.buffer)
+        self.reader.buffer.clear()              # Leftovers of a garbled reply
+        return replies, garbled
+
+    def _adapt (self, replies):
+
+        """ From now on, wait twice as long as the slowest inverter so far took to start its reply """
+
+        for frame, latency in replies.values():
+            start = latency - len(frame) * 10 / self.baudrate
+            self.slowest = start if self.slowest is None else max(self.slowest, start)
+        if self.slowest is not None:
+            self.timeout = max(self.min_timeout, 2 * self.slowest)
+
+    def scan (self, baudrate):
+
+        """
+        Probe all bus IDs at a baud rate. Returns {bus ID: {'partno', 'serial',
+        'layout', 'latency'}} for every inverter that answered.
+        """
+
+        self.baudrate = baudrate
+        self.timeout = self.initial_timeout
+        self.slowest = None
+        set_baudrate(self.fd, baudrate)
+        found = {}
+
+        for first in range(0, len(self.ids), self.window):
+
+            ids = self.ids[first:first + self.window]
+            replies, garbled = self.probe(ids)
+
+            if (garbled or replies) and len(ids) > 1:       # Replies may have collided with our requests
+                if verbose:
+                    print("Garbled replies" if garbled else "Replies", "from bus IDs", ids[0], "to", ids[-1], "at",
+                          baudrate, "baud, probing the others one by one")
+                for inv_id in ids:
+                    if inv_id not in replies:
+                        replies.update(self.probe([inv_id])[0])
+
+            self._adapt(replies)
+            found.update(replies)
+
+        # Confirm each inverter on its own, and measure how fast it replies
+
+        result = {}
+
+        for inv_id, (frame, latency) in sorted(found.items()):
+            latencies = [latency]
+            for n in range(self.probes):
+                replies = self.probe([inv_id])[0]
+                if inv_id in replies:
+                    frame, latency = replies[inv_id]
+                    latencies.append(latency)
+            partno, serial, layout = identify(frame)
+            result[inv_id] = {'partno': partno, 'serial': serial, 'layout': layout,
+                              'latency': round(statistics.median(latencies), 4)}
+            if verbose:
+                print("Bus ID %d: part number %s, serial %s, layout %s, reply in %.3f s" %
+                      (inv_id, partno, serial, layout, result[inv_id]['latency']))
+
+        return result
+
+    def discover (self, rates=RATES):
+
+        """ Scan the baud rates in turn, until inverters answer. Returns (baud rate, inverters) """
+
+        for baudrate in rates:
+            start = monotonic()
+            found = self.scan(baudrate)
+            if verbose:
+                print("%d baud: %d inverters in %.1f s" % (baudrate, len(found), monotonic() - start))
+            if found:
+                return baudrate, found
+        return None, {}
+
+
+def write_site_config (fname, port, baudrate, inverters):
+
+    """ Add or replace the bus on port in a site configuration, keeping everything else """
+
+    try:
+        with open(fname) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {}
+
+    buses = config.setdefault('buses', [])
+    bus = next((bus for bus in buses if bus.get('port') == port), None)
+    if bus is None:
+        bus = {'port': port}
+        buses.append(bus)
+
+    bus['baudrate'] = baudrate
+    bus['inverters'] = sorted(inverters)
+    bus['identities'] = {str(inv_id): identity for inv_id, identity in sorted(inverters.items())}
+    bus['discovered'] = datetime.datetime.now().isoformat(timespec='seconds')
+
+    tmpname = fname + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(config, f, indent=4)
+        f.write('\n')
+    os.replace(tmpname, fname)
+
+
+def main ():
+
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<port> [site config [baud rate,...]]", file=sys.stderr)
+        sys.exit(1)
+
+    port = sys.argv[1]
+    fname = sys.argv[2] if len(sys.argv) > 2 else "site.json"
+    rates = [int(rate) for rate in sys.argv[3].split(',')] if len(sys.argv) > 3 else RATES
+
+    fd = open_port(port)
+    start = monotonic()
+    baudrate, inverters = Discovery(fd).discover(rates)
+    os.close(fd)
+
+    if not inverters:
+        print("No inverters found on", port, "after %.1f s" % (monotonic() - start))
+        sys.exit(1)
+
+    write_site_config(fname, port, baudrate, inverters)
+    print("Found", len(inverters), "inverters at", baudrate, "baud in %.1f s, written to" % (monotonic() - start), fname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+# framering.py
+
+# Ring buffer in shared memory, to pass validated messages from a reader
+# process that only talks to the serial port to the process that decodes,
+# stores and reports them, so a slow disk or report never delays reading
+# the port
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# The shared memory block starts with a header of 64-bit counters: the write
+# and read positions (which only ever increase, the position in the buffer is
+# the counter modulo its size), records written, overruns and the highest
+# number of bytes in use, followed by a copy of the framing.FrameReader
+# counters of the reader process. Every record is a RECORD header and the
+# message itself. There is one writer and one reader. When the buffer is
+# full, the writer drops the message and counts an overrun, it never waits.
+
+
+import math
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+
+FRAME = 0           # Message from the bus
+SAMPLE = 1          # Reply that should be stored as a sample
+TIMEOUT = 2         # Request without a reply in time, no message
+
+HEADER = struct.Struct('<5Q')       # Write position, read position, records, overruns, most bytes in use
+STATS = struct.Struct('<6Q')        # Counters of the FrameReader in the reader process
+RECORD = struct.Struct('<HBBddd')   # Message length, kind, bus ID, monotonic time, wall-clock time, latency
+DATA = 128                          # Offset of the buffer in the shared memory block
+
+# FrameReader attributes copied to shared memory, in order
+
+reader_counters = ('frames_ok', 'received', 'discarded', 'crc_errors', 'etx_errors', 'truncated')
+
+
+class Stats:
+
+    """
+    FrameReader counters of the reader process, with the same attribute
+    names, so they can be exported with metrics.watch()
+    """
+
+    def __init__ (self, buf):
+        self.buf = buf
+
+    def update (self, reader):
+        STATS.pack_into(self.buf, HEADER.size, *(getattr(reader, name) for name in reader_counters))
+
+    def __getattr__ (self, name):
+        if name not in reader_counters:
+            raise AttributeError(name)
+        return STATS.unpack_from(self.buf, HEADER.size)[reader_counters.index(name)]
+
+
+class FrameRing:
+
+    """
+    Single-producer, single-consumer ring buffer of messages in shared
+    memory. Create it before starting the reader process, so both processes
+    share the memory block and the condition variable.
+    """
+
+    def __init__ (self, size=64*1024, context=multiprocessing):
+
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=DATA + size)
+        self.buf = self.shm.buf
+        self.buf[:DATA] = bytes(DATA)
+        self.condition = context.Condition()
+        self.stats = Stats(self.buf)
+
+    def _write (self, pos, data):
+        pos %= self.size
+        first = min(len(data), self.size - pos)
+        self.buf[DATA + pos:DATA + pos + first] = data[:first]
+        self.buf[DATA:DATA + len(data) - first] = data[first:]
+
+    def _read (self, pos, length):
+        pos %= self.size
+        first = min(length, self.size - pos)
+        return bytes(self.buf[DATA + pos:DATA + pos + first]) + bytes(self.buf[DATA:DATA + length - first])
+
+    def put (self, kind, inv_id, data=b'', received=0.0, wall=0.0, latency=None):
+
+        """
+        Add a message with the (monotonic) time it was received, the wall-clock
+        time and the reply latency (or None). Returns False on an overrun.
+        """
+
+        record = RECORD.pack(len(data), kind, inv_id, received, wall,
+                             math.nan if latency is None else latency) + data
+
+        with self.condition:
+            head, tail, records, overruns, most = HEADER.unpack_from(self.buf)
+            if head - tail + len(record) > self.size:
+                HEADER.pack_into(self.buf, 0, head, tail, records, overruns + 1, most)
+                return False
+            self._write(head, record)
+            head += len(record)
+            HEADER.pack_into(self.buf, 0, head, tail, records + 1, overruns, max(most, head - tail))
+            self.condition.notify()
+        return True
+
+    def get (self, timeout=None):
+
+        """
+        Return the oldest message as (kind, bus ID, message, received, wall,
+        latency), waiting at most timeout seconds, or None if there is none
+        """
+
+        with self.condition:
+            head, tail = HEADER.unpack_from(self.buf)[:2]
+            if head == tail:
+                if timeout == 0 or not self.condition.wait(timeout):
+                    return None
+                head, tail = HEADER.unpack_from(self.buf)[:2]
+                if head == tail:
+                    return None
+            length, kind, inv_id, received, wall, latency = RECORD.unpack(self._read(tail, RECORD.size))
+            data = self._read(tail + RECORD.size, length)
+            struct.pack_into('<Q', self.buf, 8, tail + RECORD.size + length)
+
+        return kind, inv_id, data, received, wall, None if math.isnan(latency) else latency
+
+    def used (self):
+        head, tail = HEADER.unpack_from(self.buf)[:2]
+        return head - tail
+
+    def occupancy (self):
+
+        """ Return the fraction of the buffer in use """
+
+        return self.used() / self.size
+
+    def max_occupancy (self):
+        return HEADER.unpack_from(self.buf)[4] / self.size
+
+    def records (self):
+        return HEADER.unpack_from(self.buf)[2]
+
+    def overruns (self):
+        return HEADER.unpack_from(self.buf)[3]
+
+    def close (self, unlink=True):
+
+        """ Release the shared memory; the process that created the ring also removes it """
+
+        self.stats.buf = self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
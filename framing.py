@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+# framing.py
+
+# Buffered, resynchronizing frame reader for the RS485 protocol used by
+# Delta Solivia PV-inverters
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+
+import collections
+
+import crc16
+
+STX = 0x02          # Start of message
+ENQ = 0x05          # Request
+ACK = 0x06          # Reply
+ETX = 0x03          # End of message
+
+HEADER_LEN = 4      # STX + ENQ/ACK + ID + LEN
+TRAILER_LEN = 3     # CRC-16 (2 bytes) + ETX
+
+debugging = 0       # Debugging flag
+
+
+class FrameReader:
+
+    """
+    Extract complete STX...ETX messages from a stream of serial data.
+
+    Incoming bytes are appended to a reusable buffer, from which every
+    complete message is taken. Bytes belonging to a partial message are
+    kept until the next read. If a candidate message has an invalid ENQ/ACK,
+    ETX or CRC, the reader skips its STX and scans forward for the next
+    0x02, so a stray STX inside a payload can't cause good messages to be lost.
+    The same happens to a candidate that is not complete yet, if a complete
+    and valid message already follows its STX: stray bytes that look like a
+    header can't hold up the messages behind them until more data comes in.
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.buffer = bytearray()               # Unprocessed serial data
+        self.frames = collections.deque()       # Validated messages not yet returned
+
+        # Counters, mostly useful for debugging a noisy bus
+
+        self.frames_ok = 0          # Valid messages found
+        self.discarded = 0          # Bytes skipped while looking for STX
+        self.etx_errors = 0         # Candidate messages with a bad ETX
+        self.crc_errors = 0         # Candidate messages with a bad CRC
+        self.truncated = 0          # Messages cut short by the start of another message
+        self.received = 0           # Bytes fed to the reader
+        self.reads = 0              # Calls to connection.read()
+
+        self.suspect_end = 0        # End of the last candidate with a bad ETX, in the buffer
+
+    def feed(self, data):
+
+        """
+        Add serial data to the buffer, and return a list of all
+        complete and valid messages (as bytes) found so far
+        """
+
+        self.buffer.extend(data)
+        self.received += len(data)
+
+        buf = self.buffer
+        end_buf = len(buf)
+        frames = []
+        pos = 0
+
+        while True:
+
+            start = buf.find(b'\x02', pos)          # Look for STX
+
+            if start < 0:                           # No STX, discard everything
+                self.discarded += end_buf - pos
+                pos = end_buf
+                break
+
+            self.discarded += start - pos
+            pos = start
+
+            if end_buf - start < HEADER_LEN:        # Wait for a complete header
+                break
+
+            enqack = buf[start + 1]
+
+            if enqack != ENQ and enqack != ACK:
+                if debugging:
+                    print("Received STX 0x02, but invalid ENQ/ACK:", enqack)
+                self.discarded += 1
+                pos = start + 1
+                continue
+
+            length = buf[start + 3]                 # Length of CMD + data
+            end = start + HEADER_LEN + length + TRAILER_LEN
+
+            if end > end_buf:                       # Incomplete message, wait for more data
+                if self._valid_after(buf, start + 1, end_buf):
+                    if debugging:
+                        print("Incomplete message at", start, "is followed by a valid one, resynchronizing")
+                    self.truncated += 1             # Or junk that looked like a header
+                    self.discarded += 1
+                    pos = start + 1
+                    continue
+                break
+
+            if buf[end - 1] != ETX:
+                if debugging:
+                    print("ETX at", end - 1, "is", buf[end - 1], "but should be 3, resynchronizing")
+                self.etx_errors += 1
+                self.discarded += 1
+                self.suspect_end = max(self.suspect_end, end)
+                pos = start + 1
+                continue
+
+            with memoryview(buf) as view:
+                crc_calc = crc16.calcData(view[start + 1 : end - TRAILER_LEN])
+
+            crc_msg = buf[end - 2] << 8 | buf[end - 3]
+
+            if crc_calc != crc_msg:
+                if debugging:
+                    print("CRC-16 is", hex(crc_calc), "but should be", hex(crc_msg), ", resynchronizing")
+                self.crc_errors += 1
+                self.discarded += 1
+                pos = start + 1
+                continue
+
+            frames.append(bytes(buf[start:end]))
+            self.frames_ok += 1
+            pos = end
+
+            # A valid message inside a candidate with a bad ETX means that
+            # candidate was the start of a message that was cut short
+
+            if start < self.suspect_end:
+                self.truncated += 1
+                self.suspect_end = 0
+
+        del buf[:pos]           # Keep only unprocessed bytes
+        self.suspect_end = max(0, self.suspect_end - pos)
+
+        return frames
+
+    def _valid_at(self, buf, start, end_buf):
+
+        """ Return True if a complete and valid message starts at start in the buffer """
+
+        if end_buf - start < HEADER_LEN or (buf[start + 1] != ENQ and buf[start + 1] != ACK):
+            return False
+        end = start + HEADER_LEN + buf[start + 3] + TRAILER_LEN
+        if end > end_buf or buf[end - 1] != ETX:
+            return False
+        with memoryview(buf) as view:
+            return crc16.calcData(view[start + 1 : end - TRAILER_LEN]) == buf[end - 2] << 8 | buf[end - 3]
+
+    def _valid_after(self, buf, pos, end_buf):
+
+        """ Return True if a complete and valid message starts anywhere from pos in the buffer """
+
+        start = buf.find(b'\x02', pos)
+        while start >= 0:
+            if self._valid_at(buf, start, end_buf):
+                return True
+            start = buf.find(b'\x02', start + 1)
+        return False
+
+    def read(self, timeout=None):
+
+        """
+        Read whatever serial data is available (waiting at most 'timeout'
+        seconds for the first byte), and return a list of complete messages
+        """
+
+        connection = self.connection
+        connection.timeout = timeout
+
+        data = connection.read(max(1, connection.in_waiting))
+        self.reads += 1
+
+        if not data:
+            return []
+
+        return self.feed(data)
+
+    def get_message(self, timeout=None):
+
+        """
+        Return the next complete message from the serial connection,
+        or None if no message was completed within 'timeout' seconds.
+        Drop-in replacement for the old byte-at-a-time get_message().
+        """
+
+        if not self.frames:
+            self.frames.extend(self.read(timeout))
+
+        if self.frames:
+            return self.frames.popleft()
+
+        return None
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+# latest.py
+
+# Keep the latest data block of every inverter in memory, and serve it to
+# local clients over TCP or a Unix socket, so a display, a home-automation
+# script or a second logger never has to open the RS485 port itself
+# Usage: python3 latest.py <address> [latest [bus ID] | since <time> [bus ID] | subscribe [bus ID] | layouts]
+# e.g. python3 latest.py /tmp/soliviamonitor.sock subscribe 2
+#      python3 latest.py 127.0.0.1:9106 since 2018-06-01T12:00
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Usage from a collector:
+#
+#   cache = latest.LatestCache(maxage=300)
+#   latest.serve(cache, "/tmp/soliviamonitor.sock")     # Or "127.0.0.1:9106"
+#   cache.put(bus_idx, inv_id, dec, data, offset)       # For every reply with a data block
+#
+# put() only keeps a reference to the reply (frames from framing.py never
+# change, anything else is copied) and wakes up subscribers, about 1 us in a
+# tight loop. Blocks are decoded, once, when a client first asks for them,
+# by the server threads. These share the interpreter with the collector, so
+# put() costs more in a collector: replies come in too far apart to find
+# the CPU caches warm, and busy clients make it wait for the interpreter
+# lock. benchmarks/bench_latest.py measures this with 8 clients asking as
+# fast as they can, between 5 and 50 us median and up to a few hundred us
+# at worst, depending on the machine. Any number of clients can read while
+# the bus only sees the requests of the collector.
+#
+# A client sends requests as JSON objects, one per line, and gets a line
+# of JSON for every answer:
+#
+#   {"cmd": "latest"}            -> {"samples": [sample, ...]}
+#       the latest block of every inverter, if it is at most 'maxage' seconds old
+#   {"cmd": "since", "time": t}  -> {"samples": [sample, ...]}
+#       every block received after t (seconds since the epoch), as far as
+#       they are still in memory (the last 'keep' blocks of all inverters)
+#   {"cmd": "subscribe"}         -> a line with a sample for every new block,
+#       until the client disconnects
+#   {"cmd": "layouts"}           -> {"layouts": [field map, ...]}
+#       the field map of every decoder (see capture.fieldmap()), in the order
+#       of decoder.decoders
+#
+# Requests can also have "bus" (index) and "inverter" (bus ID) to select
+# inverters, "fields" to select values, "maxage" in seconds to override the
+# staleness limit of the cache for "latest", and "format": "binary". An
+# invalid request is answered with {"error": "..."}. A sample is:
+#
+#   {"bus": 0, "inverter": 1, "serial": "...", "decoder": "RPI_M",
+#    "time": <seconds since the epoch>, "age": <seconds>, "values": {...}}
+#
+# with the values scaled to their units, and hex strings for variables
+# with unknown meaning. With "format": "binary" the answer is a 4-byte
+# count (little-endian) followed by that many records, or for "subscribe"
+# a record for every block: RECORD (wall-clock time, bus index, bus ID,
+# number of the decoder in "layouts" and length of the block) followed by
+# the data block exactly as the inverter sent it.
+
+
+import collections
+import datetime
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+from time import monotonic, time
+
+import decoder
+
+RECORD = struct.Struct('<dBBBH')        # Wall-clock time, bus index, bus ID, decoder number, block length
+COUNT = struct.Struct('<I')
+
+verbose = 1
+server = None
+
+
+class Entry:
+
+    """ A data block at offset in a reply as it was received, decoded when a client first asks for it """
+
+    __slots__ = ('seq', 'bus', 'inv_id', 'dec', 'data', 'offset', 'wall', 'received', 'serial', 'values', 'binary')
+
+    def __init__ (self, bus_idx, inv_id, dec, data, offset, wall, received):
+
+        self.seq = 0
+        self.bus = bus_idx
+        self.inv_id = inv_id
+        self.dec = dec
+        self.data = data
+        self.offset = offset
+        self.wall = wall
+        self.received = received
+        self.serial = None
+        self.values = None
+        self.binary = None
+
+    def block (self):
+        return bytes(self.data[self.offset:self.offset + self.dec.size])
+
+    def sample (self, now, fields=None):
+
+        """ Return the block as a dictionary for JSON, with the values of 'fields' (default all) """
+
+        values = self.values
+        if values is None:
+            record = self.dec.decode(self.data, self.offset)
+            self.serial = record.serial.decode('ascii', 'replace') if 'serial' in self.dec.index else ""
+            scaled = self.dec.scaled(record)
+            values = {}
+            for name, value in zip(self.dec.subset_header, self.dec.subset(record)):
+                if isinstance(value, bytes):
+                    value = value.hex()
+                elif not isinstance(value, str):        # Hex fields stay hex
+                    value = scaled.get(name, value)
+                values[name] = value
+            self.values = values                # Races are harmless, every thread computes the same
+        if fields:
+            values = {name: values[name] for name in fields if name in values}
+
+        return {'bus': self.bus, 'inverter': self.inv_id, 'serial': self.serial, 'decoder': self.dec.name,
+                'time': self.wall, 'age': round(now - self.received, 3), 'values': values}
+
+    def record (self):
+        if self.binary is None:
+            self.binary = RECORD.pack(self.wall, self.bus, self.inv_id, decoder.decoders.index(self.dec),
+                                      self.dec.size) + self.block()
+        return self.binary
+
+
+class LatestCache:
+
+    """
+    The latest data block of every inverter, and the last 'keep' blocks of all
+    inverters for "since" queries and subscribers. Blocks older than 'maxage'
+    seconds are not returned as the latest, None to disable.
+    """
+
+    def __init__ (self, maxage=300, keep=4096):
+
+        self.maxage = maxage
+        self.latest = {}                            # (bus index, bus ID) -> Entry
+        self.history = collections.deque(maxlen=keep)
+        self.seq = 0                                # Number of the last block put in the cache
+        self.changed = threading.Condition()
+        self.clients = 0
+
+    def put (self, bus_idx, inv_id, dec, data, offset=0, wall=None, received=None):
+
+        """ Add the data block at offset in a reply from the inverter with bus ID inv_id on bus bus_idx """
+
+        if type(data) is not bytes:             # E.g. a buffer that will be reused
+            data = bytes(data[offset:offset + dec.size])
+            offset = 0
+        entry = Entry(bus_idx, inv_id, dec, data, offset, wall or time(), received or monotonic())
+
+        with self.changed:
+            self.seq += 1
+            entry.seq = self.seq
+            self.latest[(bus_idx, inv_id)] = entry
+            self.history.append(entry)
+            self.changed.notify_all()
+
+    def select (self, request):
+
+        """ Return the entries that answer a "latest" or "since" request """
+
+        bus_idx = request.get('bus')
+        inv_id = request.get('inverter')
+
+        with self.changed:
+            if request['cmd'] == 'latest':
+                maxage = request.get('maxage', self.maxage)
+                oldest = monotonic() - maxage if maxage is not None else None
+                entries = [entry for key, entry in sorted(self.latest.items())
+                           if oldest is None or entry.received >= oldest]
+            else:
+                entries = [entry for entry in self.history if entry.wall > request['time']]
+
+        return [entry for entry in entries if (bus_idx is None or entry.bus == bus_idx) and
+                (inv_id is None or entry.inv_id == inv_id)]
+
+    def wait (self, seq, timeout=None):
+
+        """ Wait for blocks after block number seq, and return them (or those that are still kept) """
+
+        with self.changed:
+            self.changed.wait_for(lambda: self.seq > seq, timeout)
+            entries = []
+            for entry in reversed(self.history):
+                if entry.seq <= seq:
+                    break
+                entries.append(entry)
+        entries.reverse()
+        return entries
+
+    def connected (self, change):
+        with self.changed:
+            self.clients += change
+
+
+def parse_address (address):
+
+    """ Return (family, address) for "host:port", a port number or a Unix socket path """
+
+    if isinstance(address, int) or str(address).isdigit():
+        return socket.AF_INET, ('127.0.0.1', int(address))
+    if '/' in address:
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET6 if ':' in host else socket.AF_INET, (host.strip('[]'), int(port))
+
+
+def serve (cache, address):
+
+    """ Serve the cache to clients on a TCP address or Unix socket path, from background threads """
+
+    global server
+
+    import socketserver                     # Only when serving
+
+    class Handler (socketserver.StreamRequestHandler):
+
+        def write (self, data):
+            self.wfile.write(data)
+            self.wfile.flush()
+
+        def answer (self, request, entries):
+            now = monotonic()
+            if request.get('format') == 'binary':
+                self.write(COUNT.pack(len(entries)) + b''.join(entry.record() for entry in entries))
+            else:
+                samples = [entry.sample(now, request.get('fields')) for entry in entries]
+                self.write(json.dumps({'samples': samples}).encode('utf-8') + b'\n')
+
+        def subscribe (self, request):
+            seq = cache.seq
+            while True:
+                entries = cache.wait(seq, 1.0)
+                if entries:
+                    seq = entries[-1].seq
+                    entries = [entry for entry in entries if request.get('bus') in (None, entry.bus) and
+                               request.get('inverter') in (None, entry.inv_id)]
+                    now = monotonic()
+                    if request.get('format') == 'binary':
+                        self.write(b''.join(entry.record() for entry in entries))
+                    elif entries:
+                        self.write(b''.join(json.dumps(entry.sample(now, request.get('fields'))).encode('utf-8') + b'\n'
+                                            for entry in entries))
+                elif select.select([self.connection], [], [], 0)[0] and not self.connection.recv(1, socket.MSG_PEEK):
+                    return                  # The client is gone
+
+        def handle (self):
+            cache.connected(1)
+            try:
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                        cmd = request['cmd']
+                        if cmd == 'subscribe':
+                            return self.subscribe(request)
+                        elif cmd == 'layouts':
+                            import capture
+                            self.write(json.dumps({'layouts': [capture.fieldmap(dec) for dec in decoder.decoders]})
+                                       .encode('utf-8') + b'\n')
+                        elif cmd in ('latest', 'since'):
+                            self.answer(request, cache.select(request))
+                        else:
+                            raise ValueError("unknown command " + str(cmd))
+                    except (ValueError, KeyError, TypeError, AttributeError) as error:
+                        self.write(json.dumps({'error': "invalid request: " + str(error)}).encode('utf-8') + b'\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                cache.connected(-1)
+
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.unlink(addr)                 # Left behind by a collector that was killed
+        server = socketserver.ThreadingUnixStreamServer(addr, Handler)
+    else:
+        class Server (socketserver.ThreadingTCPServer):
+            address_family = family
+            allow_reuse_address = True
+        server = Server(addr, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='latest', daemon=True).start()
+    if verbose:
+        print("Serving the latest values on", addr if family == socket.AF_UNIX else "%s:%d" % server.server_address[:2])
+    return server
+
+
+def close ():
+
+    """ Stop serving, and remove the Unix socket """
+
+    global server
+
+    if server:
+        server.shutdown()
+        server.server_close()
+        if server.address_family == socket.AF_UNIX and os.path.exists(server.server_address):
+            os.unlink(server.server_address)
+        server = None
+
+
+def main ():
+
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<address> [latest [bus ID] | since <time> [bus ID] | subscribe [bus ID] | layouts]",
+              file=sys.stderr)
+        sys.exit(1)
+
+    cmd = sys.argv[2] if len(sys.argv) > 2 else 'latest'
+    request = {'cmd': cmd}
+    args = sys.argv[3:]
+    if cmd == 'since':
+        if not args:
+            print("Usage:", sys.argv[0], "<address> since <time> [bus ID]", file=sys.stderr)
+            sys.exit(1)
+        request['time'] = datetime.datetime.fromisoformat(args.pop(0)).timestamp()
+    if args:
+        request['inverter'] = int(args[0])
+
+    family, addr = parse_address(sys.argv[1])
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.connect(addr)
+        s.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        f = s.makefile('rb')
+        try:
+            for line in f:
+                sys.stdout.write(line.decode('utf-8'))
+                sys.stdout.flush()
+                if cmd != 'subscribe':
+                    break
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+# metrics.py
+
+# Counters and latency histograms per bus and inverter, exported in the
+# Prometheus text format over HTTP and as a periodic summary log line
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Usage from a collector:
+#
+#   metrics.watch(reader, bus=0)                    # Export the FrameReader counters
+#   metrics.observe('reply_latency_seconds', 0.12, bus=0, inverter=1)
+#   metrics.inc('timeouts_total', bus=0, inverter=1)
+#   with metrics.timer('decode_seconds_total'):
+#       ...
+#   metrics.gauge('report_queue_depth', queue.depth)  # Called at every scrape
+#   metrics.serve(9105)                             # http://localhost:9105/metrics
+#
+# All metric names get the prefix 'solivia_'.
+
+
+import datetime
+import threading
+from time import perf_counter
+
+PREFIX = 'solivia_'
+
+# Bucket upper bounds in seconds for latency histograms (a reply at 19200 baud takes ~85 ms)
+
+buckets = (0.025, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0, 5.0)
+
+descriptions = {
+    'reply_latency_seconds': "Time from request to valid reply",
+    'replies_total': "Valid replies received",
+    'reply_bytes_total': "Bytes in valid replies",
+    'timeouts_total': "Requests without a valid reply within the reply time-out",
+    'observed_requests_total': "Requests sent by another bus master (listen-only mode)",
+    'unknown_blocks_total': "Replies with a data block that did not match any known layout",
+    'frames_total': "Valid messages on the bus, including requests",
+    'received_bytes_total': "Bytes read from the serial port",
+    'discarded_bytes_total': "Bytes skipped while resynchronizing",
+    'crc_errors_total': "Messages with a bad CRC",
+    'etx_errors_total': "Messages with a bad ETX",
+    'truncated_total': "Messages cut short by the start of another message",
+    'decode_seconds_total': "Time spent decoding data blocks",
+    'storage_seconds_total': "Time spent writing samples",
+    'report_seconds_total': "Time spent reporting to an external server",
+    'dropped_samples_total': "Samples dropped because the storage stage fell behind",
+    'reports_total': "Energy totals reported to the external server",
+    'report_failures_total': "Failed attempts to report to the external server",
+    'report_queue_depth': "Inverters with an energy total waiting to be reported",
+    'report_queue_lag_seconds': "Age of the oldest energy total waiting to be reported",
+    'ring_occupancy_ratio': "Fraction of the ring buffer from the reader process in use",
+    'ring_overruns': "Messages dropped by the reader process because the ring buffer was full",
+    'poll_interval_seconds': "Current interval between requests to an inverter (adaptive polling)",
+    'bus_utilisation_ratio': "Estimated fraction of bus time used by our requests and their replies (adaptive polling)",
+    'cache_clients': "Clients connected to the cache of latest values (latest.py)",
+}
+
+# FrameReader attribute for each exported bus counter
+
+reader_counters = (('frames_total', 'frames_ok'),
+                   ('received_bytes_total', 'received'),
+                   ('discarded_bytes_total', 'discarded'),
+                   ('crc_errors_total', 'crc_errors'),
+                   ('etx_errors_total', 'etx_errors'),
+                   ('truncated_total', 'truncated'))
+
+lock = threading.Lock()
+counters = {}           # (name, labels) -> value
+histograms = {}         # (name, labels) -> [count per bucket..., count in +Inf, sum]
+readers = []            # (labels, FrameReader) pairs
+gauges = {}             # (name, labels) -> function returning the current value
+server = None
+
+
+def _labels (labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc (name, value=1, **labels):
+
+    """ Add value to a counter """
+
+    key = (name, _labels(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe (name, value, **labels):
+
+    """ Add an observation (e.g. a latency in seconds) to a histogram """
+
+    key = (name, _labels(labels))
+    with lock:
+        h = histograms.get(key)
+        if h is None:
+            h = histograms[key] = [0] * (len(buckets) + 2)
+        for idx, bound in enumerate(buckets):
+            if value <= bound:
+                h[idx] += 1
+                break
+        else:
+            h[len(buckets)] += 1
+        h[-1] += value
+
+
+class timer:
+
+    """ Context manager that adds the time spent in a block to a counter in seconds """
+
+    def __init__ (self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__ (self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__ (self, *exc):
+        inc(self.name, perf_counter() - self.start, **self.labels)
+        return False
+
+
+def watch (reader, **labels):
+
+    """ Export the counters of a framing.FrameReader, labelled with e.g. bus=0 """
+
+    with lock:
+        readers.append((_labels(labels), reader))
+
+
+def gauge (name, function, **labels):
+
+    """ Export the value returned by function() as a gauge """
+
+    with lock:
+        gauges[(name, _labels(labels))] = function
+
+
+def _format_labels (labels, extra=()):
+    labels = labels + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, value) for key, value in labels) + '}'
+
+
+def _format_value (value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition ():
+
+    """ Return all metrics in the Prometheus text exposition format """
+
+    with lock:
+        values = dict(counters)
+        for labels, reader in readers:
+            for name, attr in reader_counters:
+                values[(name, labels)] = getattr(reader, attr)
+        hist = {key: list(h) for key, h in histograms.items()}
+        functions = dict(gauges)
+
+    lines = []
+
+    for (name, labels), function in sorted(functions.items()):
+        lines.append('# HELP %s%s %s' % (PREFIX, name, descriptions.get(name, name)))
+        lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+        lines.append('%s%s%s %s' % (PREFIX, name, _format_labels(labels), _format_value(function())))
+
+    for name in sorted(set(name for name, labels in values)):
+        lines.append('# HELP %s%s %s' % (PREFIX, name, descriptions.get(name, name)))
+        lines.append('# TYPE %s%s counter' % (PREFIX, name))
+        for (n, labels), value in sorted(values.items()):
+            if n == name:
+                lines.append('%s%s%s %s' % (PREFIX, name, _format_labels(labels), _format_value(value)))
+
+    for name in sorted(set(name for name, labels in hist)):
+        lines.append('# HELP %s%s %s' % (PREFIX, name, descriptions.get(name, name)))
+        lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+        for (n, labels), h in sorted(hist.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), h):
+                cumulative += count
+                lines.append('%s%s_bucket%s %d' % (PREFIX, name, _format_labels(labels, (('le', str(bound)),)), cumulative))
+            lines.append('%s%s_sum%s %s' % (PREFIX, name, _format_labels(labels), repr(float(h[-1]))))
+            lines.append('%s%s_count%s %d' % (PREFIX, name, _format_labels(labels), cumulative))
+
+    return '\n'.join(lines) + '\n'
+
+
+def quantile (h, q):
+
+    """ Estimate a quantile from histogram counts, as the upper bound of the bucket it falls in """
+
+    total = sum(h[:-1])
+    if not total:
+        return None
+    cumulative = 0
+    for bound, count in zip(buckets + (float('inf'),), h):
+        cumulative += count
+        if cumulative >= q * total:
+            return bound
+    return float('inf')
+
+
+def summary ():
+
+    """ Return a one-line summary: errors per bus, replies, time-outs and latency per inverter """
+
+    parts = []
+
+    with lock:
+        for labels, reader in readers:
+            parts.append('%s: %d frames, %d crc, %d etx, %d truncated, %d bytes discarded' %
+                         (' '.join('%s %s' % label for label in labels), reader.frames_ok, reader.crc_errors,
+                          reader.etx_errors, reader.truncated, reader.discarded))
+
+        inverters = set(labels for name, labels in histograms if name == 'reply_latency_seconds')
+        inverters.update(labels for name, labels in counters if name == 'timeouts_total')
+
+        for labels in sorted(inverters):
+            h = histograms.get(('reply_latency_seconds', labels), [0] * (len(buckets) + 2))
+            part = '%s: %d replies, %d time-outs' % (' '.join('%s %s' % label for label in labels), sum(h[:-1]),
+                                                     counters.get(('timeouts_total', labels), 0))
+            if sum(h[:-1]):
+                part += ', latency p50 <= %gs p99 <= %gs' % (quantile(h, 0.5), quantile(h, 0.99))
+            parts.append(part)
+
+        timing = ['%s %.3fs' % (name[:-len('_seconds_total')], value) for (name, labels), value
+                  in sorted(counters.items()) if name.endswith('_seconds_total') and not labels]
+        functions = sorted(gauges.items())
+
+    if timing:
+        parts.append('time spent: ' + ', '.join(timing))
+    if functions:
+        parts.append(', '.join('%s%s %g' % (name.replace('_', ' '), ''.join(' %s %s' % label for label in labels), function())
+                               for (name, labels), function in functions))
+
+    return datetime.datetime.now().isoformat(timespec='seconds') + ' metrics: ' + '; '.join(parts)
+
+
+def serve (port, host='127.0.0.1'):
+
+    """ Serve the metrics over HTTP from a background thread """
+
+    global server
+
+    import http.server                      # Only when serving, it takes longer to import than the rest
+
+    class Handler (http.server.BaseHTTPRequestHandler):
+
+        def do_GET (self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message (self, format, *args):
+            pass                            # Don't log every scrape
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print("Serving metrics on http://%s:%d/metrics" % (host, server.server_address[1]))
+    return server
@@ -0,0 +1,758 @@
+#!/usr/bin/python3
+
+# multibus.py
+
+# Collect data from Delta Solivia inverters on several RS485 buses
+# (serial ports) in a single process, using asyncio.
+# Usage: python3 multibus.py [configuration file]
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# The configuration file is a JSON object like this:
+#
+# {
+#     "basepath": "/root/delta/",
+#     "sampleinterval": 60,
+#     "loginterval": 600,
+#     "storage": "csv",
+#     "buses": [
+#         {"port": "/dev/ttyUSB0", "baudrate": 19200, "inverters": [1, 2]},
+#         {"port": "/dev/ttyUSB1", "baudrate": 9600, "inverters": [1],
+#          "sampleintervals": {"1": 300}},
+#         {"port": "/dev/ttyUSB2", "inverters": [1, 2, 3], "listenonly": true}
+#     ]
+# }
+#
+# discover.py writes the buses of a site in this format, with the part
+# number, serial and reply latency of each inverter under "identities".
+#
+# A bus with "listenonly" is never written to: samples are taken from the
+# replies to requests sent by another master, e.g. a vendor datalogger.
+#
+# With "ringstore" set to true (for ringstore.TIERS) or to a list of tiers
+# like [[1, 3600, false], [60, 10080, true]] (step in seconds, rows, and
+# whether to write the tier to a file), samples are kept in RAM in a
+# ringstore.RingStore per inverter, and only the tiers are written. Set
+# "sampleinterval" to the smallest step, e.g. 1, to sample every reply.
+#
+# With "adaptive" set to true, the interval of each inverter adapts to what
+# it reports (see scheduler.AdaptiveScheduler): it backs off when an
+# inverter is off or stops answering, is shortened down to "pollfloor"
+# seconds while power ramps quickly, and all intervals are stretched when
+# the polls would take more than "busbudget" of the time on a bus.
+#
+# With "aggregates" set to true, hourly and daily energy, peak power and
+# the mean, minimum and maximum of each AC phase and DC string are kept
+# for every sample, in <inverter>-hourly.sum and <inverter>-daily.sum
+# next to the samples (see aggregates.py).
+#
+# With "capture" set to a directory, every valid message on every bus is
+# kept there exactly as it was received, so it can be decoded again with
+# a corrected field map (see capture.py).
+#
+# With "cache" set to a Unix socket path like "/tmp/multibus.sock" or to
+# "127.0.0.1:9106", the latest data block of every inverter on every bus
+# is served to local clients (see latest.py), so they don't need to open
+# a port themselves. Blocks older than "cachemaxage" seconds are not
+# returned as the latest.
+#
+# Importing this module has no side effects: pyserial and the modules for
+# the storage, reporting, capture and cache options in the configuration
+# are only loaded by collect() and the storage classes.
+
+
+import asyncio
+import csv
+import datetime
+import json
+import os.path
+import signal
+import sys
+from time import monotonic
+
+import decoder
+import framing
+import metrics
+import protocol
+import scheduler
+import sniffer
+
+reporting = False           # Set by load_backends() if report.py or reporturl is there
+report = None
+
+verbose = 1                 # Verbosity flag
+debugging = 0               # Debugging flag
+
+queuesize = 1000            # Maximum number of samples waiting for the storage stage
+
+defaults = {
+    'basepath': "/root/delta/",     # Path where CSV output files should be saved
+    'storage': "csv",               # "csv" for tab-separated files, "binary" for binstore segments, "delta" for deltastore
+    'walpath': "/tmp/multibus.wal", # Write-ahead log for samples not yet written (on RAM-disk), null to disable
+    'walsize': 4*1024*1024,         # Size of the write-ahead log in bytes
+    'walsync': False,               # Sync the log after every sample, only useful if walpath is on flash
+    'logbytes': 1024*1024,          # Write samples early if this many bytes are waiting in the log
+    'sampleinterval': 60,           # Inverter sampling interval in seconds
+    'loginterval': 60*10,           # Data write-interval in seconds
+    'replytimeout': 1,              # Seconds to wait for a reply before moving on
+    'turnaround': 0.1,              # Seconds the bus should be quiet before we send a request
+    'metricsport': 9105,            # Serve Prometheus metrics on http://localhost:<port>/metrics, null to disable
+    'summaryinterval': 60*10,       # Seconds between metrics summary lines in the log, 0 to disable
+    'reporturl': None,              # Without report.py, POST energy totals to this URL (see reportqueue.py)
+    'reportqueue': "report-queue.json",     # Energy totals not reported yet (relative to basepath), null for memory only
+    'ringstore': None,              # Tiers of consolidated samples in RAM instead of storing every sample, see above
+    'adaptive': False,              # Adapt the interval of each inverter to its power and whether it answers, see above
+    'pollfloor': 5,                 # Shortest interval in seconds with adaptive polling
+    'pollceiling': 600,             # Longest interval in seconds with adaptive polling
+    'busbudget': 0.5,               # Maximum fraction of time on a bus for our requests and their replies
+    'rampthreshold': 0.2,           # Relative change in power per minute at which adaptive polling speeds up
+    'aggregates': False,            # Keep hourly and daily statistics in small summary files, see above
+    'capture': None,                # Directory to capture every valid message in, see above, null to disable
+    'cache': None,                  # Serve the latest values to local clients on this address, see above, null to disable
+    'cachemaxage': 300,             # Seconds after which the cache no longer returns a value as the latest
+    'buses': [{'port': '/dev/ttyUSB0', 'baudrate': 19200, 'inverters': [1, 2]}],
+}
+
+
+def load_config (fname):
+
+    """ Read a JSON configuration file, and fill in defaults for missing settings """
+
+    with open(fname) as f:
+        config = json.load(f)
+
+    for key, value in defaults.items():
+        config.setdefault(key, value)
+
+    return config
+
+
+class Bus:
+
+    """
+    A serial port with one or more inverters, polled by its own coroutine.
+    Decoded data blocks are put on a queue shared by all buses.
+    """
+
+    def __init__(self, index, port, baudrate, inv_ids, queue, config, sampleintervals=None, listenonly=False,
+                 captures=None, cache=None):
+
+        self.index = index                  # Position of this bus in the configuration
+        self.port = port
+        self.baudrate = baudrate
+        self.inv_ids = list(inv_ids)
+        self.queue = queue
+        self.listenonly = listenonly        # Never transmit, only follow another master
+        self.captures = captures            # capture.CaptureWriter shared by all buses, if enabled
+        self.cache = cache                  # latest.LatestCache shared by all buses, if enabled
+
+        intervals = {int(k): v for k, v in (sampleintervals or {}).items()}
+        if config['adaptive'] and not listenonly:
+            self.polls = scheduler.AdaptiveScheduler(self.inv_ids, config['sampleinterval'], intervals,
+                                                     config['replytimeout'], config['turnaround'],
+                                                     floor=config['pollfloor'], ceiling=config['pollceiling'],
+                                                     budget=config['busbudget'], ramp=config['rampthreshold'])
+        else:
+            self.polls = scheduler.PollScheduler(self.inv_ids, config['sampleinterval'], intervals,
+                                                 config['replytimeout'], config['turnaround'])
+        self.adaptive = isinstance(self.polls, scheduler.AdaptiveScheduler)
+        self.sniffer = sniffer.BusSniffer(config['replytimeout'])
+
+        self.connection = None
+        self.reader = None
+        self.wakeup = None
+        self.dropped = 0                    # Samples dropped because the queue was full
+
+    def open (self):
+
+        """ Open the serial port and start watching it for data """
+
+        self.connection = serial.Serial(self.port, self.baudrate, timeout=0)
+        self.reader = framing.FrameReader(self.connection)
+        metrics.watch(self.reader, bus=self.index)
+        if self.adaptive:
+            for inv_id in self.inv_ids:
+                metrics.gauge('poll_interval_seconds', lambda inv_id=inv_id: self.polls.effective(inv_id),
+                              bus=self.index, inverter=inv_id)
+            metrics.gauge('bus_utilisation_ratio', self.polls.utilisation, bus=self.index)
+        self.wakeup = asyncio.Event()
+        asyncio.get_running_loop().add_reader(self.connection.fileno(), self._readable)
+
+        if verbose:
+            print("Opened", self.port, "at", self.baudrate, "baud, inverters", self.inv_ids,
+                  "(listen-only)" if self.listenonly else "")
+
+    def close (self):
+        if self.connection:
+            asyncio.get_running_loop().remove_reader(self.connection.fileno())
+            self.connection.close()
+            self.connection = None
+
+    def _readable (self):
+
+        """ Called by the event loop when serial data is available """
+
+        for data in self.reader.read(0):
+            if self.captures:
+                self.captures.append(self.index, monotonic(), datetime.datetime.now().timestamp(), data)
+            if self.listenonly:
+                latency = self.sniffer.observe(data)
+                if data[1] == framing.ENQ:
+                    metrics.inc('observed_requests_total', bus=self.index, inverter=data[2])
+            else:
+                latency = self.polls.received(data[2], data[1] == framing.ENQ)
+            if latency is not None:
+                metrics.observe('reply_latency_seconds', latency, bus=self.index, inverter=data[2])
+            if data[1] == framing.ACK:
+                metrics.inc('replies_total', bus=self.index, inverter=data[2])
+                metrics.inc('reply_bytes_total', len(data), bus=self.index, inverter=data[2])
+            self.process_message(data)
+
+        self.wakeup.set()
+
+    def process_message (self, data):
+
+        """ Decode a message, and queue a sample if one is due """
+
+        decode_start = monotonic()
+        rvals = protocol.decode_response(data)
+
+        if not rvals:
+            return
+
+        inv_id = rvals['inv_id']
+        start = rvals['data_offset']
+
+        dec = None
+        if rvals['cmd'] == 0x60 and rvals['subcmd'] == 0x01:
+            dec = decoder.lookup(data, start, rvals['data_length'])
+
+        if not dec:
+            metrics.inc('unknown_blocks_total', bus=self.index, inverter=inv_id)
+            if verbose:
+                print(self.port, "Data did not match struct.")
+            return
+
+        if self.cache:                      # Every reply, for local clients
+            self.cache.put(self.index, inv_id, dec, data, start)
+
+        if inv_id not in self.polls.deadline or not self.polls.sample_due(inv_id):
+            return
+
+        u = dec.decode(data, start)
+        metrics.inc('decode_seconds_total', monotonic() - decode_start)
+        if self.adaptive:
+            self.polls.adapt(inv_id, {name: getattr(u, name) for name in self.polls.watched if name in dec.index})
+        self.polls.sampled(inv_id)
+
+        try:
+            self.queue.put_nowait((datetime.datetime.now(), self.index, inv_id, dec, u))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.inc('dropped_samples_total', bus=self.index)
+            if verbose:
+                print(self.port, "Storage queue full, dropping sample of inverter", inv_id)
+
+    async def run (self):
+
+        """ Send requests whenever the scheduler says so, until cancelled """
+
+        if self.listenonly:
+            return
+
+        polls = self.polls
+
+        while True:
+
+            timeout = polls.next_deadline() - monotonic()
+
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+
+            unanswered = polls.pending
+            inv_id = polls.pop_due()
+            if inv_id:
+                if unanswered is not None:
+                    metrics.inc('timeouts_total', bus=self.index, inverter=unanswered)
+                if debugging:
+                    print(self.port, "Sending data query to inverter", inv_id)
+                self.connection.write(protocol.build_request(inv_id, b'\x60\x01'))
+
+
+class CsvStorage:
+
+    """
+    Shared storage and reporting stage: keeps samples in memory and
+    writes them to a CSV-file per inverter serial every loginterval seconds,
+    or earlier if the write-ahead log holds more than logbytes of samples
+    """
+
+    def __init__(self, basepath, loginterval, samplelog=None, logbytes=1024*1024, reports=None):
+
+        self.basepath = basepath
+        self.loginterval = loginterval
+        self.lastlogtime = monotonic()
+        self.samplelog = samplelog      # Write-ahead log, if enabled
+        self.logbytes = logbytes
+        self.reports = reports          # Background queue for reports to the external server, if any
+
+        self.samples = {}           # Samples waiting to be written, per inverter key
+        self.serials = {}           # Inverter serial for each key
+        self.writers = {}           # CSV writer for each key
+        self.files = {}             # Open output file for each key
+        self.decoders = {}          # Data block decoder for each key
+        self.total_energy_Wh = {}
+        self.total_energy_Wh_prev = {}
+        self.report_idx = {}        # Inverter index used for reporting
+        self.summaries = None       # Hourly and daily statistics for each key, if enabled with aggregate()
+
+    def add (self, sample, log=True):
+
+        time, bus_idx, inv_id, dec, u = sample
+        key = (bus_idx, inv_id)
+
+        if key not in self.serials:
+            self._register(key, dec, u)
+
+        if "energytotal" in dec.index:
+            self.total_energy_Wh[key] = u.energytotal * 1000
+        self.samples[key].append(self.row(time, dec, u))
+        self._aggregate(key, time, dec, u)
+
+        if log and self.samplelog:     # Log sample, in case we crash
+            self.samplelog.append(time.timestamp(), bus_idx, inv_id, dec.name, dec.struct.pack(*u))
+
+    def _register (self, key, dec, u):
+
+        """ Set up the bookkeeping for a newly seen inverter """
+
+        self.serials[key] = str(u.serial, "ascii")
+        self.decoders[key] = dec
+        self.samples[key] = []
+        self.total_energy_Wh_prev[key] = 0
+        self.report_idx[key] = len(self.report_idx)
+        if self.reports:
+            self.reports.init(self.report_idx[key], self.serials[key])
+
+    def aggregate (self):
+
+        """ Keep hourly and daily statistics of the samples of each inverter from now on """
+
+        global aggregates
+        import aggregates
+        self.summaries = {}
+
+    def _aggregate (self, key, time, dec, u):
+
+        """ Update the statistics of an inverter with a new sample """
+
+        if self.summaries is None:
+            return
+        summary = self.summaries.get(key)
+        if not summary:
+            path = os.path.join(self.basepath, str(key[1]) + "-" + self.serials[key])
+            summary = self.summaries[key] = aggregates.Summary(dec, path)
+        summary.add(time, u)
+
+    def replay (self):
+
+        """ Put samples from the write-ahead log that were never written back in the sample-lists """
+
+        count = 0
+        last_stored = {}
+
+        for t, bus_idx, inv_id, name, block in self.samplelog.replay():
+
+            dec = decoder.find(name)
+            if not dec:
+                continue
+
+            u = dec.decode(block)
+            key = (bus_idx, inv_id)
+
+            if key not in last_stored:
+                last_stored[key] = self.last_stored(inv_id, str(u.serial, "ascii"))
+
+            # Compare in milliseconds, delta segments keep no more than that
+            if last_stored[key] is not None and round(t * 1000) <= round(last_stored[key] * 1000):
+                continue                    # Already written before we stopped
+
+            self.add((datetime.datetime.fromtimestamp(t), bus_idx, inv_id, dec, u), log=False)
+            count += 1
+
+        if verbose:
+            print("Replayed", count, "samples from the write-ahead log")
+
+    def row (self, time, dec, u):
+        return [time.isoformat()] + dec.subset(u)
+
+    def due (self):
+        if self.samplelog and self.samplelog.pending >= self.logbytes:
+            return True
+        return monotonic() - self.lastlogtime >= self.loginterval
+
+    def _path (self, inv_id, serial):
+        return os.path.join(self.basepath, str(inv_id) + "-" + serial + ".csv")
+
+    def last_stored (self, inv_id, serial):
+
+        """ Return the time (seconds since the epoch) of the last sample stored for an inverter, or None """
+
+        last = wal.csv_last_time(self._path(inv_id, serial))
+        return datetime.datetime.fromisoformat(last).timestamp() if last else None
+
+    def _writer (self, key):
+
+        """ Open a CSV-file for this inverter, if not already done """
+
+        csvw = self.writers.get(key)
+
+        if not csvw:
+            fname = self._path(key[1], self.serials[key])
+            print("Will write to", fname)
+            write_header = not os.path.isfile(fname) or not os.path.getsize(fname)
+            self.files[key] = open(fname, "a")
+            csvw = csv.writer(self.files[key], delimiter='\t')
+            if write_header:
+                csvw.writerow(["time"] + self.decoders[key].subset_header)
+            self.writers[key] = csvw
+
+        return csvw
+
+    def take (self):
+
+        """
+        Return the stored samples per inverter and the last write-ahead log
+        sequence number in them, and start collecting new ones
+        """
+
+        batch = self.samples
+        self.samples = {key: [] for key in batch}
+        self.lastlogtime = monotonic()
+        return batch, self.samplelog.seq if self.samplelog else None
+
+    def put_back (self, batch, failed):
+
+        """ Return the samples of inverters that could not be written to the sample-lists """
+
+        for key in failed:
+            self.samples[key][:0] = batch[key]
+
+    def write (self, batch, use_report):
+
+        """
+        Write a batch of samples, and optionally report energy totals.
+        Returns the keys of inverters for which writing failed.
+        """
+
+        failed = []
+
+        for key, samples in batch.items():
+
+            if verbose and samples:
+                print("Writing", len(samples), "samples for inverter", self.serials[key])
+
+            try:
+                if samples:
+                    with metrics.timer('storage_seconds_total'):
+                        self._writer(key).writerows(samples)
+                        self.files[key].flush()
+                        os.fsync(self.files[key].fileno())      # One sync per batch
+            except (OSError, ValueError) as error:
+                print(datetime.datetime.now(), "Error writing samples to file:", str(error))
+                failed.append(key)
+
+            total = self.total_energy_Wh.get(key)
+
+            if total and total != self.total_energy_Wh_prev[key]:
+                if self.reports and use_report:
+                    self.reports.put(self.report_idx[key], total)
+                self.total_energy_Wh_prev[key] = total
+
+        return failed
+
+    def flush (self, use_report):
+
+        """ Write all stored samples now, and mark them as stored in the write-ahead log """
+
+        batch, seq = self.take()
+        self.written(batch, seq, self.write(batch, use_report))
+
+    def written (self, batch, seq, failed):
+
+        """ Handle the result of write() """
+
+        if failed:
+            self.put_back(batch, failed)
+        elif self.samplelog:
+            self.samplelog.checkpoint(seq)
+
+        for summary in (self.summaries or {}).values():
+            try:
+                summary.flush()
+            except OSError as error:
+                print(datetime.datetime.now(), "Error writing summary file:", str(error))
+
+
+class BinaryStorage(CsvStorage):
+
+    """ Like CsvStorage, but writes raw records to binstore segments """
+
+    def __init__(self, *args, **kwargs):
+        global binstore
+        import binstore
+        super().__init__(*args, **kwargs)
+
+    def row (self, time, dec, u):
+        return (time, u)
+
+    def _path (self, inv_id, serial):
+        return os.path.join(self.basepath, str(inv_id) + "-" + serial)
+
+    def last_stored (self, inv_id, serial):
+        if not os.path.isdir(self._path(inv_id, serial)):
+            return None
+        return binstore.last_time(self._path(inv_id, serial))
+
+    def _writer (self, key):
+
+        """ Open a directory with binary segments for this inverter, if not already done """
+
+        writer = self.writers.get(key)
+
+        if not writer:
+            dname = self._path(key[1], self.serials[key])
+            print("Will write to", dname)
+            writer = binstore.SegmentWriter(dname, self.decoders[key])
+            self.writers[key] = writer
+            self.files[key] = writer
+
+        return writer
+
+
+class DeltaStorage(BinaryStorage):
+
+    """ Like BinaryStorage, but writes delta-encoded deltastore segments """
+
+    def __init__(self, *args, **kwargs):
+        global deltastore
+        import deltastore
+        super().__init__(*args, **kwargs)
+
+    def last_stored (self, inv_id, serial):
+        if not os.path.isdir(self._path(inv_id, serial)):
+            return None
+        return deltastore.last_time(self._path(inv_id, serial))
+
+    def _writer (self, key):
+
+        """ Open a directory with delta-encoded segments for this inverter, if not already done """
+
+        writer = self.writers.get(key)
+
+        if not writer:
+            dname = self._path(key[1], self.serials[key])
+            print("Will write to", dname)
+            writer = deltastore.SegmentWriter(dname, self.decoders[key])
+            self.writers[key] = writer
+            self.files[key] = writer
+
+        return writer
+
+
+class RingStorage(CsvStorage):
+
+    """
+    Keeps samples in a ringstore.RingStore per inverter, which writes the
+    consolidated tiers itself (ringstore.TIERS if tiers is None). Samples
+    are not written, energy totals are reported as usual.
+    """
+
+    def __init__(self, basepath, loginterval, tiers=None, reports=None):
+        global ringstore
+        import ringstore
+        super().__init__(basepath, loginterval, None, reports=reports)
+        self.tiers = tiers or ringstore.TIERS
+        self.rings = {}             # RingStore for each key
+
+    def add (self, sample, log=True):
+
+        time, bus_idx, inv_id, dec, u = sample
+        key = (bus_idx, inv_id)
+
+        if key not in self.serials:
+            self._register(key, dec, u)
+            path = os.path.join(self.basepath, str(inv_id) + "-" + self.serials[key])
+            self.rings[key] = ringstore.RingStore(dec, self.tiers, path)
+            if verbose:
+                print("Keeping %.1f MB of samples in RAM for inverter %s" % (self.rings[key].memory() / 1e6,
+                                                                          self.serials[key]))
+
+        if "energytotal" in dec.index:
+            self.total_energy_Wh[key] = u.energytotal * 1000
+        with metrics.timer('storage_seconds_total'):
+            self.rings[key].add(time.timestamp(), u)
+        self._aggregate(key, time, dec, u)
+
+    def flush (self, use_report):
+        super().flush(use_report)
+        for rings in self.rings.values():
+            rings.close()
+
+
+async def store (queue, storage):
+
+    """ Take samples from the queue, and write them out in the background """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+
+        try:
+            storage.add(await asyncio.wait_for(queue.get(), storage.loginterval))
+        except asyncio.TimeoutError:
+            pass
+
+        if storage.due():
+            batch, seq = storage.take()
+            failed = await loop.run_in_executor(None, storage.write, batch, True)
+            storage.written(batch, seq, failed)
+
+
+async def summarize (interval, buses):
+
+    """ Print a summary of the metrics every interval seconds """
+
+    while True:
+        await asyncio.sleep(interval)
+        print(metrics.summary())
+        for bus in buses:
+            if bus.listenonly:
+                print(bus.port, bus.sniffer.summary())
+            elif bus.adaptive:
+                print(bus.port, bus.polls.summary())
+
+
+def load_backends (config):
+
+    """ Import pyserial, and the modules for the reporting, write-ahead log, capture and cache options that are enabled """
+
+    global capture, latest, reportqueue, serial, wal, report, reporting
+
+    import serial
+
+    try:
+        import report
+        reporting = True
+    except ImportError:
+        report = None
+    if reporting or config['reporturl']:
+        import reportqueue
+
+    if config['walpath'] and not config['ringstore']:
+        import wal
+    if config['capture']:
+        import capture
+    if config['cache']:
+        import latest
+
+
+async def collect (config):
+
+    """ Run all buses and the storage stage until SIGINT or SIGTERM """
+
+    load_backends(config)
+
+    queue = asyncio.Queue(queuesize)
+    samplelog = None
+    if config['walpath'] and not config['ringstore']:     # Samples in RAM don't need a log
+        samplelog = wal.WriteAheadLog(config['walpath'], config['walsize'], config['walsync'])
+
+    # Energy totals are reported by a background worker, so a slow server can't stall polling
+
+    reports = None
+    if reporting or config['reporturl']:
+        sender = report if reporting else reportqueue.HttpReport(config['reporturl'])
+        path = os.path.join(config['basepath'], config['reportqueue']) if config['reportqueue'] else None
+        reports = reportqueue.ReportQueue(sender.send_total, sender.init, path)
+
+    if config['ringstore']:
+        tiers = None if config['ringstore'] is True else config['ringstore']
+        storage = RingStorage(config['basepath'], config['loginterval'], tiers, reports)
+    elif config['storage'] == "binary":
+        storage = BinaryStorage(config['basepath'], config['loginterval'], samplelog, config['logbytes'], reports)
+    elif config['storage'] == "delta":
+        storage = DeltaStorage(config['basepath'], config['loginterval'], samplelog, config['logbytes'], reports)
+    else:
+        storage = CsvStorage(config['basepath'], config['loginterval'], samplelog, config['logbytes'], reports)
+
+    if samplelog:
+        storage.replay()
+    if config['aggregates']:            # After the replay: replayed samples may have been counted already
+        storage.aggregate()
+
+    captures = capture.CaptureWriter(config['capture']) if config['capture'] else None
+    cache = latest.LatestCache(config['cachemaxage']) if config['cache'] else None
+
+    buses = []
+    for index, bus in enumerate(config['buses']):
+        buses.append(Bus(index, bus['port'], bus.get('baudrate', 19200), bus['inverters'],
+                         queue, config, bus.get('sampleintervals'), bus.get('listenonly', False), captures, cache))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    for bus in buses:
+        bus.open()
+
+    tasks = [asyncio.create_task(bus.run()) for bus in buses]
+    tasks.append(asyncio.create_task(store(queue, storage)))
+    if config['summaryinterval']:
+        tasks.append(asyncio.create_task(summarize(config['summaryinterval'], buses)))
+
+    if config['metricsport']:
+        metrics.serve(config['metricsport'])
+    if cache:
+        latest.serve(cache, config['cache'])
+        metrics.gauge('cache_clients', lambda: cache.clients)
+
+    await stop.wait()
+
+    print("Received signal, writing data")
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    for bus in buses:
+        bus.close()
+
+    while not queue.empty():
+        storage.add(queue.get_nowait())
+    storage.flush(False)
+    if captures:
+        captures.close()
+    if cache:
+        latest.close()
+    if reports:
+        reports.close()
+
+
+def main ():
+    fname = sys.argv[1] if len(sys.argv) > 1 else "soliviamonitor.json"
+    config = load_config(fname)
+    protocol.verbose = verbose
+    protocol.debugging = debugging
+    asyncio.run(collect(config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+# protocol.py
+
+# Message layout and request/response handling for the RS485 protocol
+# used by Delta Solivia PV-inverters
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+
+import struct
+import sys
+
+import crc16
+
+verbose = 0                 # Verbosity flag
+debugging = 0               # Debugging flag
+
+# Variables in the data-block of a Delta RPI M-series inverter,
+# as far as I've been able to establish their meaning.
+# The fields for each variable are as follows: 
+# name, struct-definition, size in bytes, multiplier-exponent (10^x), unit, SunSpec equivalent
+
+rvars = (("partno", "11s", 11),
+        ("serial", "18s", 18),
+        ("fwrev_sap", "6s", 6),
+        ("fwrev_pwr_maj", "B", 1),
+        ("fwrev_pwr_min", "B", 1),
+        ("fwrev_pwr_date", "2s", 2),
+        ("fwrev_sts_maj", "B", 1),
+        ("fwrev_sts_min", "B", 1),
+        ("fwrev_sts_date", "2s", 2),
+        ("fwrev_disp_maj", "B", 1),
+        ("fwrev_disp_min", "B", 1),
+        ("fwrev_disp_date", "2s", 2),
+        ("ac1V", "H", 2, -1, "V"),
+        ("ac1I", "H", 2, -2, "A", "AphA"),
+        ("ac1P", "H", 2, 0, "W"),
+        ("ac1F1", "H", 2, -2, "Hz"),
+        ("ac1V2", "H", 2, -1, "V"),
+        ("ac1F2", "H", 2, -2, "Hz"),
+        ("ac2V", "H", 2, -1, "V"),
+        ("ac2I", "H", 2, -2, "A", "AphB"),
+        ("ac2P", "H", 2, 0, "W"),
+        ("ac2F1", "H", 2, -2, "Hz"),
+        ("ac2V2", "H", 2, -1, "V"),
+        ("ac2F2", "H", 2, -2, "Hz"),
+        ("ac3V", "H", 2, -1, "V"),
+        ("ac3I", "H", 2, -2, "A", "AphC"),
+        ("ac3P", "H", 2, 0, "W"),
+        ("ac3F1", "H", 2, -2, "Hz"),
+        ("ac3V2", "H", 2, -1, "V"),
+        ("ac3F2", "H", 2, -2, "Hz"),
+        ("dc1V", "H", 2, -1, "V"),
+        ("dc1I", "H", 2, -2, "A"),
+        ("dc1P", "H", 2, 0, "W"),
+        ("dc2V", "H", 2, -1, "V"),
+        ("dc2I", "H", 2, -2, "A"),
+        ("dc2P", "H", 2, 0, "W"),
+        ("power", "H", 2, 0, "W"),
+        ("bus+V", "H", 2, -1, "V"),
+        ("bus-V", "H", 2, -1, "V"),
+        ("energytotal_day", "I", 4, 0, "Wh"),
+        ("feedintime_day", "I", 4, 0, "s"),
+        ("energytotal", "I", 4, 0, "kWh"),
+        ("feedintime_total", "I", 4, 0, "s"),
+        ("temp", "H", 2, 0, "C", "TmpSnk"),
+        ("status_ac1", "B", 1),
+        ("status_ac2", "B", 1),
+        ("status_ac3", "B", 1),
+        ("status_ac4", "B", 1),
+        ("status_dc1", "B", 1),
+        ("status_dc2", "B", 1),
+        ("status_error", "B", 1),
+        ("status_error_ac1", "B", 1),
+        ("status_error_global1", "B", 1),
+        ("status_error_cpu", "B", 1),
+        ("status_error_global2", "B", 1),
+        ("limits_ac1", "B", 1),
+        ("limits_ac2", "B", 1),         
+        ("status_error_global3", "B", 1),
+        ("limits_dc1", "B", 1),
+        ("limits_dc2", "B", 1),         
+        ("status_history", "20s", 20))
+
+
+structstr = ">"     # Initial struct description string for the data block
+structlen = 0       # Length of our struct data
+varheader = []      # Variable names for the CSV header
+
+idx = 0
+varlookup = {}      # Dict for finding the index of a given variable
+
+# Construct a full struct description for our data block, 
+# and a header line for our CSV.
+
+for var in rvars:
+    varheader.append(var[0])
+    structstr += var[1]
+    structlen += var[2]
+    varlookup[var[0]] = idx
+    idx += 1
+
+
+def build_request (inv_id, cmd):
+    
+    """ Return a request message with command cmd (e.g. b'\x60\x01') for the inverter with id inv_id """
+    
+    # Borrowed from DeltaPVOutput
+    
+    length = len(cmd)
+    msgbody = struct.pack('BBB%ds'%length, 5, inv_id, length, cmd)
+    crcval = crc16.calcData(msgbody)
+    lsb = crcval & (0xff)
+    msb = (crcval >> 8) & 0xff
+    return struct.pack('BBBB%dsBBB'%length, 2, 5, inv_id, length, cmd, lsb, msb, 3)
+
+
+def send_request (connection, inv_id, cmd):
+    
+    """ Send command (e.g. b'\x60\x01') to the inverter with id inv_id """
+    
+    data = build_request(inv_id, cmd)
+    
+    if debugging:
+        print("Sending data query to inverter", inv_id)
+        
+    connection.write(data)
+    connection.flush()
+
+
+def decode_response (data):
+
+    """ 
+    Try to decode an inverter-messages from serial data and return 
+    a dictionary with message parameters (including length, inverter_id, 
+    command, subcommand).
+    Checks message validity, consistency and CRC, and returns None 
+    if a message is not valid. Request-messages are parsed, but are 
+    currently not returned. 
+    """
+    
+    try:
+    
+        stx = data[0]
+        enqack = data[1]
+        
+        if stx != 0x02:
+            if verbose:
+                print("Invalid message, STX =", stx)
+            return None
+                        
+        if enqack != 0x05 and enqack != 0x06:
+            if verbose:
+                print("Invalid message, ENQ/ACK =", enqack)
+            return None
+        
+        inv_id = data[2]
+        length = data[3]
+        
+        if (len(data)) < length + 4 + 3:    # should be 4 bytes (STX + ACK + ID + LEN) + data length + 3 bytes (CRC16 + ETX) 
+            if verbose:
+                print("Incomplete data block of", len(data), "bytes, should be", length + 7, "bytes")
+            return None
+        
+        cmd = data[4]                   # Command ID
+        subcmd = data[5]                # Subcommand ID
+        
+        data_offset = 6                 # Start of data
+        data_length = length - 2        # Length of data
+        
+        crc_lsb = data[4 + length]      # Least-significant byte of CRC-16 over preceding bytes after STX
+        crc_msb = data[4 + length + 1]  # Most-significant byte of CRC-16 over preceding bytes after STX
+        
+        etx = data[4 + length + 2]      # ETX-byte to signify end of message, should be 0x03
+        
+        rvals = {'enqack': enqack, 'inv_id': inv_id, 'length': length, 'cmd': cmd, 'subcmd': subcmd, \
+                 'data_offset': data_offset, 'data_length': data_length}
+        
+        if etx != 0x03:                         # ETX isn't 0x03, data probably isn't valid
+            
+            if verbose:
+                print("ETX at", length + 2, "is", etx, "but should be 3")
+                print(rvals)
+            
+            return None
+            
+        else:                                   # ETX is 0x03, we probably have a valid data block
+            
+            crc_calc = crc16.calcData(data[1 : 4 + length])     # Calculate CRC-16 over message, excluding STX
+            crc_msg = crc_msb << 8 | crc_lsb                    # Compare with CRC transmitted at end of message
+            
+            if crc_calc != crc_msg:
+                
+                print("WARNING: CRC-16 is", hex(crc_calc), " but should be", hex(crc_msg))
+                return None
+                
+            else:
+            
+                if enqack == 0x05:                 # ENQ, marks start of request message
+                    if debugging:
+                        print("Found request-message for inverter", inv_id, "with length", length, "and CMD", cmd, "SUB", subcmd)
+                    return None                     # Currently we do not return requests, only replies
+        
+                if debugging:
+                    print("Found valid response:", rvals);
+                
+                return rvals;
+            
+    except:
+        
+        print("Error decoding response:", str(sys.exc_info()[0]))
+        return None
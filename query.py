@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+
+# query.py
+
+# Time-range queries on the tab-separated sample files written by
+# soliviamonitor.py and multibus.py
+# Usage: python3 query.py <file> <start> <end> <field>[,<field>...] [bucket-seconds [mean|min|max]]
+# e.g. python3 query.py /home/pi/delta/2-1234.csv 2018-03-01 2018-04-01 power 3600 mean
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Sample files are sorted by time, so a sparse index with the time of the
+# first row in every block of (by default) 64 kB is enough to find a time
+# range with a binary search, after which only that part of the file is read.
+# The index is kept next to the sample file as <file>.idx:
+#
+#  - 8 bytes magic, b'SLVIDX01'
+#  - 8 bytes number of bytes of the sample file covered by the index (little-endian)
+#  - 4 bytes CRC-32 of the first line of the sample file, to notice a replaced file
+#  - 4 bytes block size
+#
+# followed by (time, byte offset) entries as a little-endian double and
+# 64-bit integer. Rows that were appended since the index was last saved
+# are indexed on the next query, without reading the rest of the file.
+
+
+import bisect
+import datetime
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'SLVIDX01'
+HEADER = struct.Struct('<8sQII')    # Magic, bytes covered, CRC-32 of first line, block size
+ENTRY = struct.Struct('<dQ')        # Time, offset of the row in the sample file
+
+verbose = 0
+
+aggregates = {'mean': lambda values: sum(values) / len(values),
+              'min': min,
+              'max': max}
+
+
+def row_time (line):
+
+    """ Return the time (seconds since the epoch) at the start of a row, or None for the header """
+
+    try:
+        return datetime.datetime.fromisoformat(line[:line.index(b'\t')].decode('ascii')).timestamp()
+    except ValueError:
+        return None
+
+
+def number (value):
+
+    """ Convert a stored value to a number; hex values (e.g. bus voltages) are stored as 0x... """
+
+    try:
+        return float(value)
+    except ValueError:
+        return int(value, 0)
+
+
+class LogIndex:
+
+    """ Sparse time index of a sample file """
+
+    def __init__ (self, fname, blocksize=65536, save=True):
+
+        self.fname = fname
+        self.idxname = fname + '.idx'
+        self.blocksize = blocksize
+        self.save = save                # Keep the index on disk, next to the sample file
+
+        self.covered = 0                # Bytes of the sample file that have been indexed
+        self.signature = None
+        self.times = []
+        self.offsets = []
+        self.saved = 0                  # Number of entries in the index file
+
+        with open(fname, 'rb') as f:
+            self.header = f.readline()
+
+        if save:
+            self._load()
+
+        self.update()
+
+    def _load (self):
+
+        """ Read the index file, if it exists and belongs to this sample file """
+
+        try:
+            with open(self.idxname, 'rb') as f:
+                magic, covered, signature, blocksize = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or signature != zlib.crc32(self.header) or blocksize != self.blocksize:
+                    return
+                if covered > os.path.getsize(self.fname):
+                    return              # Sample file was truncated or replaced
+                entries = f.read()
+        except (OSError, struct.error):
+            return
+
+        entries = entries[:len(entries) // ENTRY.size * ENTRY.size]
+        for t, offset in ENTRY.iter_unpack(entries):
+            self.times.append(t)
+            self.offsets.append(offset)
+
+        self.covered = covered
+        self.signature = signature
+        self.saved = len(self.times)
+
+    def _store (self):
+
+        """ Append new entries to the index file, and update its header """
+
+        try:
+            if self.saved == 0 or self.signature is None:
+                f = open(self.idxname, 'wb')
+                f.write(bytes(HEADER.size))
+                self.saved = 0
+            else:
+                f = open(self.idxname, 'r+b')
+                f.seek(HEADER.size + self.saved * ENTRY.size)
+                f.truncate()
+            with f:
+                f.write(b''.join(ENTRY.pack(t, offset) for t, offset in
+                                 zip(self.times[self.saved:], self.offsets[self.saved:])))
+                f.seek(0)
+                f.write(HEADER.pack(MAGIC, self.covered, zlib.crc32(self.header), self.blocksize))
+        except OSError as error:
+            if verbose:
+                print("Could not save index", self.idxname, ":", str(error), file=sys.stderr)
+            self.save = False
+            return
+
+        self.signature = zlib.crc32(self.header)
+        self.saved = len(self.times)
+
+    def update (self):
+
+        """ Index rows that were appended to the sample file since the last update """
+
+        size = os.path.getsize(self.fname)
+        if size <= self.covered:
+            return
+
+        next_entry = self.offsets[-1] + self.blocksize if self.offsets else 0
+
+        with open(self.fname, 'rb') as f:
+            f.seek(self.covered)
+            offset = self.covered
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break               # Row that is still being written
+                if offset >= next_entry:
+                    t = row_time(line)
+                    if t is not None:
+                        self.times.append(t)
+                        self.offsets.append(offset)
+                        next_entry = offset + self.blocksize
+                offset += len(line)
+
+        if verbose:
+            print("Indexed", offset - self.covered, "bytes of", self.fname)
+
+        self.covered = offset
+        if self.save:
+            self._store()
+
+    def fields (self):
+
+        """ Return the names of the columns in the sample file """
+
+        return self.header.decode('ascii').rstrip('\r\n').split('\t')
+
+    def offset (self, t):
+
+        """ Return the offset of a row at or before the first row with a time of at least t """
+
+        idx = bisect.bisect_left(self.times, t) - 1
+        return self.offsets[idx] if idx >= 0 else 0
+
+    def rows (self, start=None, end=None):
+
+        """
+        Yield (time, columns) for every row from start up to end (seconds since
+        the epoch), with the columns as a list of byte strings, including time
+        """
+
+        self.update()
+
+        with open(self.fname, 'rb') as f:
+
+            f.seek(max(self.offset(start) if start is not None else 0, len(self.header)))
+
+            # Comparing the time strings is much cheaper than parsing them, only
+            # rows within a second of start or end need to be parsed
+
+            start_iso = datetime.datetime.fromtimestamp(start).isoformat()[:19].encode('ascii') if start is not None else None
+            end_iso = datetime.datetime.fromtimestamp(end).isoformat()[:19].encode('ascii') if end is not None else None
+
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                columns = line.rstrip(b'\r\n').split(b'\t')
+                prefix = columns[0][:19]
+                if start_iso is not None and prefix < start_iso:
+                    continue
+                if end_iso is not None and prefix > end_iso:
+                    if row_time(line) is None:
+                        continue        # Not a valid row, e.g. damaged by a power failure
+                    break
+                t = row_time(line)
+                if t is None:
+                    continue            # Not a valid row, e.g. damaged by a power failure
+                if start is not None and t < start:
+                    continue
+                if end is not None and t >= end:
+                    break
+                yield t, columns
+
+
+def query (fname, fields, start=None, end=None, bucket=None, how='mean', index=None):
+
+    """
+    Yield (time, values) for the given fields of the rows in a sample file from
+    start up to end (datetimes). If bucket is given, yield one row per bucket of
+    that many seconds instead, with the mean, min or max of each field.
+    """
+
+    if index is None:
+        index = LogIndex(fname)
+
+    names = index.fields()
+    try:
+        columns = [names.index(field) for field in fields]
+    except ValueError:
+        raise ValueError("Unknown field, " + fname + " has " + ", ".join(names[1:]))
+
+    rows = index.rows(start.timestamp() if start else None, end.timestamp() if end else None)
+
+    if not bucket:
+        for t, row in rows:
+            yield datetime.datetime.fromtimestamp(t), [number(row[idx]) for idx in columns]
+        return
+
+    aggregate = aggregates[how]
+    current = None
+    values = [[] for field in fields]
+
+    for t, row in rows:
+
+        # Buckets are aligned to local midnight, so that e.g. hourly buckets start on the hour
+
+        local = datetime.datetime.fromtimestamp(t)
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        seconds = (local - midnight).total_seconds()
+        bucket_start = midnight + datetime.timedelta(seconds=seconds // bucket * bucket)
+
+        if bucket_start != current:
+            if current is not None:
+                yield current, [aggregate(v) for v in values]
+            current = bucket_start
+            values = [[] for field in fields]
+
+        for v, idx in zip(values, columns):
+            v.append(number(row[idx]))
+
+    if current is not None:
+        yield current, [aggregate(v) for v in values]
+
+
+def main ():
+
+    if len(sys.argv) < 5:
+        print("Usage:", sys.argv[0], "<file> <start> <end> <field>[,<field>...] [bucket-seconds [mean|min|max]]", file=sys.stderr)
+        sys.exit(1)
+
+    fname = sys.argv[1]
+    start = datetime.datetime.fromisoformat(sys.argv[2])
+    end = datetime.datetime.fromisoformat(sys.argv[3])
+    fields = sys.argv[4].split(',')
+    bucket = float(sys.argv[5]) if len(sys.argv) > 5 else None
+    how = sys.argv[6] if len(sys.argv) > 6 else 'mean'
+
+    if how not in aggregates:
+        print("Unknown aggregate", how, "use one of", ", ".join(aggregates), file=sys.stderr)
+        sys.exit(1)
+
+    print("\t".join(["time"] + fields))
+    for t, values in query(fname, fields, start, end, bucket, how):
+        print("\t".join([t.isoformat()] + ["%g" % v for v in values]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+
+# reportqueue.py
+
+# Background reporting of energy totals to an external server, so a slow
+# or unreachable server can never stall polling of the inverters
+# Usage: python3 reportqueue.py [port [failure rate]]
+# runs a stand-in HTTP server on localhost that prints the totals it receives
+# (and fails the given fraction of requests), for testing HttpReport.
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Reports are sent by a worker thread. Only the latest total of each inverter
+# is kept, so an outage of any length needs one queue entry per inverter.
+# The worker saves the queue to a small JSON file when it has changed, at
+# most every 'saveinterval' seconds and when it stops, so totals that were
+# not reported yet survive a restart without a flash write for every total.
+# Entries are kept by serial, with the inverter index they were queued
+# with, since indexes are assigned in the order inverters are first seen
+# and can differ after a restart. Failed reports are retried with
+# exponential backoff.
+
+
+import http.server
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.request
+
+import metrics
+
+verbose = 0
+
+
+class ReportQueue:
+
+    """
+    Queue of energy totals for report.init() and report.send_total(), or any
+    pair of functions with the same arguments, handled by a worker thread
+    """
+
+    def __init__ (self, send_total, init=None, path=None, maxsize=1000, retry=5.0, maxretry=600.0, saveinterval=60.0):
+
+        self.send_total = send_total
+        self.send_init = init
+        self.path = path                    # File to keep the queue in, None for memory only
+        self.maxsize = maxsize              # Maximum number of inverters waiting
+        self.retry = retry                  # First retry after this many seconds
+        self.maxretry = maxretry            # Maximum time between retries
+        self.saveinterval = saveinterval    # Minimum time between saves of the queue
+
+        self.entries = {}                   # Serial -> {'idx', 'total', 'time'}
+        self.serials = {}                   # Serial of each inverter index
+        self.initialized = {}               # Inverter index -> serial that init() was sent for
+        self.failures = 0                   # Consecutive failed attempts
+        self.retry_at = 0.0                 # No attempts before this time (monotonic clock)
+        self.dirty = False                  # Entries changed since the last save
+        self.saved_at = -saveinterval       # Time of the last save (monotonic clock)
+        self.saved = None                   # What was saved last
+        self.sent = 0
+        self.failed = 0
+        self.stopping = False
+        self.condition = threading.Condition()
+
+        self._load()
+
+        metrics.gauge('report_queue_depth', self.depth)
+        metrics.gauge('report_queue_lag_seconds', self.lag)
+
+        self.thread = threading.Thread(target=self._run, name='reports', daemon=True)
+        self.thread.start()
+
+    def _load (self):
+
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                for key, entry in json.load(f).items():
+                    if 'idx' not in entry:          # Saved by index, by an older version
+                        entry['idx'] = int(key)
+                        key = entry.pop('serial')
+                    self.entries[key] = entry
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print("Could not read report queue", self.path, ":", str(error))
+            return
+
+        self.saved = json.dumps(self.entries)
+        if self.entries:
+            print("Loaded", len(self.entries), "unreported energy totals from", self.path)
+
+    def _save (self, data):
+
+        """ Write the queue (as JSON) to a temporary file, and rename it over the old one """
+
+        try:
+            tmpname = self.path + '.tmp'
+            with open(tmpname, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpname, self.path)
+        except OSError as error:
+            print("Could not save report queue", self.path, ":", str(error))
+
+    def _snapshot (self):
+
+        """ Return the queue as JSON if it should be saved now, otherwise None. Call with the condition held. """
+
+        if not self.path or not self.dirty:
+            return None
+        if not self.stopping and time.monotonic() < self.saved_at + self.saveinterval:
+            return None
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        data = json.dumps(self.entries)
+        if data == self.saved:
+            return None                     # E.g. a total that was queued and reported since the last save
+        self.saved = data
+        return data
+
+    def init (self, idx, serial):
+
+        """ Set the serial of an inverter; report.init() is called before its first report """
+
+        with self.condition:
+            self.serials[idx] = serial
+
+    def put (self, idx, total):
+
+        """ Queue an energy total, replacing a total of the same inverter that was not sent yet """
+
+        with self.condition:
+            serial = self.serials.get(idx)
+            key = serial if serial is not None else "index " + str(idx)
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= self.maxsize:       # Drop the oldest entry
+                    oldest = min(self.entries, key=lambda k: self.entries[k]['time'])
+                    print("Report queue full, dropping total of inverter", oldest)
+                    del self.entries[oldest]
+                entry = self.entries[key] = {'time': time.time()}
+            entry['idx'] = idx
+            entry['total'] = total
+            self.dirty = True
+            self.condition.notify()
+
+    def depth (self):
+        return len(self.entries)
+
+    def lag (self):
+
+        """ Return the age in seconds of the oldest total that was not reported yet """
+
+        entries = list(self.entries.values())
+        return time.time() - min(entry['time'] for entry in entries) if entries else 0.0
+
+    def _wait (self):
+
+        """ Seconds until a report or a save is due, None if nothing is waiting. Call with the condition held. """
+
+        now = time.monotonic()
+        due = []
+        if self.entries:
+            due.append(self.retry_at - now)
+        if self.dirty and self.path:
+            due.append(self.saved_at + self.saveinterval - now)
+        return max(0.0, min(due)) if due else None
+
+    def _run (self):
+
+        while True:
+
+            with self.condition:
+                while not self.stopping and self._wait() != 0.0:
+                    self.condition.wait(self._wait())
+                data = self._snapshot()
+                key = None
+                if not self.stopping and self.entries and time.monotonic() >= self.retry_at:
+                    key = min(self.entries, key=lambda k: self.entries[k]['time'])
+                    entry = dict(self.entries[key])
+                    serial = key if not key.startswith("index ") else None
+
+            if data is not None:
+                self._save(data)
+            if self.stopping:
+                return
+            if key is None:
+                continue
+            idx = entry['idx']
+
+            try:
+                with metrics.timer('report_seconds_total'):
+                    if self.send_init and serial is not None and self.initialized.get(idx) != serial:
+                        self.send_init(idx, serial)
+                        self.initialized[idx] = serial
+                    self.send_total(idx, entry['total'])
+
+            except Exception as error:
+                self.failures += 1
+                self.failed += 1
+                metrics.inc('report_failures_total')
+                delay = min(self.maxretry, self.retry * 2 ** (self.failures - 1)) * random.uniform(0.5, 1.0)
+                self.retry_at = time.monotonic() + delay
+                print("Error while reporting energy total of inverter", key, ":", repr(error),
+                      "- retrying in %.0f s" % delay)
+                continue
+
+            self.failures = 0
+            self.sent += 1
+            metrics.inc('reports_total')
+            if verbose:
+                print("Reported energy total of inverter", key, ":", entry['total'])
+
+            with self.condition:
+                current = self.entries.get(key)
+                if current is not None:
+                    if current['total'] == entry['total'] and current['idx'] == idx:
+                        del self.entries[key]
+                    else:                       # New total came in while we were sending
+                        current['time'] = time.time()
+                    self.dirty = True
+
+    def close (self, timeout=5.0):
+
+        """ Stop the worker and save the queue, waiting at most timeout seconds for a report in progress """
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(timeout)
+
+
+class HttpReport:
+
+    """
+    Report energy totals with an HTTP POST of a JSON object
+    {"inverter": index, "serial": serial, "energytotal_Wh": total} to a URL,
+    for use instead of a site-specific report.py
+    """
+
+    def __init__ (self, url, timeout=10.0):
+        self.url = url
+        self.timeout = timeout
+        self.serials = {}
+
+    def init (self, idx, serial):
+        self.serials[idx] = serial
+
+    def send_total (self, idx, total):
+        body = json.dumps({'inverter': idx, 'serial': self.serials.get(idx), 'energytotal_Wh': total})
+        request = urllib.request.Request(self.url, body.encode('utf-8'), {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class StandInHandler (http.server.BaseHTTPRequestHandler):
+
+    """ Stand-in report server: accepts POSTed totals, slowly (delay) and failing a fraction of the requests """
+
+    failure_rate = 0.0
+    delay = 0.0
+    received = []
+
+    def do_POST (self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.delay)
+        if random.random() < self.failure_rate:
+            self.send_error(503)
+            return
+        self.received.append(json.loads(body))
+        if verbose:
+            print("Received", body.decode('utf-8'))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message (self, format, *args):
+        pass
+
+
+def main ():
+
+    global verbose
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8088
+    StandInHandler.failure_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    verbose = 1
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    print("Stand-in report server on http://127.0.0.1:%d/" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+
+# ringstore.py
+
+# Fixed-size store in RAM of recent inverter data at several resolutions,
+# in the style of RRDtool: e.g. every second for an hour, averages per
+# minute for a week and per 15 minutes for a year. Every sample is
+# consolidated into all tiers as it arrives (average, minimum and maximum of
+# each variable), so memory use never grows. Tiers can be appended to a
+# tab-separated file as their slots are completed, which makes that the
+# permanent store.
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# Usage from a collector:
+#
+#   rings = ringstore.RingStore(decoder.rpi_m, ringstore.TIERS, "/root/delta/1-<serial>")
+#   rings.add(time.timestamp(), record)         # For every reply
+#   for t, values in rings.query(['power', 'temp'], start, end, 'max'):
+#       ...
+#
+# Only the variables with a unit (see decoder.BlockDecoder.scales) are kept,
+# scaled to that unit. Values in RAM are 32-bit floats, about 7 significant
+# digits. Each tier takes 12 bytes per variable per row, about 19 MB per
+# inverter for the default tiers. A persisted tier is written to
+# <path>-<step>s.csv, with a row per slot: the start of the slot, and for
+# every variable its average, minimum and maximum. Slots are aligned to
+# multiples of their step since the epoch. close() saves the slot that is
+# still being consolidated in <path>-<step>s.partial, and a new RingStore
+# with the same path continues it, so a restart does not lose or split it.
+
+
+import array
+import csv
+import datetime
+import json
+import math
+import os
+
+# Step in seconds, number of rows, and whether the tier is written to a file
+
+TIERS = ((1, 3600, False),              # Every second for an hour
+         (60, 7*24*60, True),           # Every minute for a week
+         (900, 366*24*4, True))         # Every 15 minutes for a year
+
+FUNCTIONS = ('mean', 'min', 'max')
+
+
+class Tier:
+
+    """ Consolidated values at one resolution: a ring of 'rows' slots of 'step' seconds each """
+
+    def __init__ (self, step, rows, width, persist=False):
+
+        self.step = step
+        self.rows = rows
+        self.width = width              # Number of variables
+        self.persist = persist
+
+        self.slots = array.array('q', [-1]) * rows                 # Slot number in each row, -1 if empty
+        self.values = {how: array.array('f', [math.nan]) * (rows * width) for how in FUNCTIONS}
+
+        self.slot = None                # Slot being consolidated
+        self.count = 0
+        self.sum = [0.0] * width
+        self.low = [math.inf] * width
+        self.high = [-math.inf] * width
+
+        self.late = 0                   # Samples for a slot that was already completed
+
+    def add (self, t, values):
+
+        """
+        Consolidate the values of a sample at time t. Returns (slot start time,
+        averages, minima, maxima) if this completed the previous slot, else None.
+        """
+
+        slot = int(t // self.step)
+        done = None
+
+        if slot != self.slot:
+            if self.slot is not None:
+                if slot < self.slot:
+                    self.late += 1
+                    return None
+                done = self._complete()
+            self.slot = slot
+            self.count = 0
+            self.sum = [0.0] * self.width
+            self.low = [math.inf] * self.width
+            self.high = [-math.inf] * self.width
+
+        self.count += 1
+        for idx, value in enumerate(values):
+            self.sum[idx] += value
+            if value < self.low[idx]:
+                self.low[idx] = value
+            if value > self.high[idx]:
+                self.high[idx] = value
+
+        return done
+
+    def state (self):
+
+        """ Return the slot being consolidated as a dictionary for JSON, None if there is none """
+
+        if self.slot is None or not self.count:
+            return None
+        return {'slot': self.slot, 'count': self.count, 'sum': self.sum, 'low': self.low, 'high': self.high}
+
+    def restore (self, state):
+
+        """ Continue consolidating a slot saved with state() """
+
+        if len(state['sum']) != self.width:
+            raise ValueError("saved with " + str(len(state['sum'])) + " variables instead of " + str(self.width))
+        self.slot = state['slot']
+        self.count = state['count']
+        self.sum = state['sum']
+        self.low = state['low']
+        self.high = state['high']
+
+    def _complete (self):
+
+        """ Store the slot being consolidated in its row """
+
+        row = self.slot % self.rows
+        averages = [total / self.count for total in self.sum]
+        base = row * self.width
+
+        self.slots[row] = self.slot
+        self.values['mean'][base:base + self.width] = array.array('f', averages)
+        self.values['min'][base:base + self.width] = array.array('f', self.low)
+        self.values['max'][base:base + self.width] = array.array('f', self.high)
+
+        return self.slot * self.step, averages, self.low, self.high
+
+    def oldest (self):
+
+        """ Return the start time of the oldest slot this tier can still hold """
+
+        if self.slot is None:
+            return math.inf
+        return (self.slot - self.rows) * self.step
+
+    def rows_between (self, start, end, how, columns):
+
+        """ Yield (slot start time, values) for the stored rows from start up to end """
+
+        width = self.width
+        values = self.values[how]
+        first = max(int(start // self.step), self.slot - self.rows) if start is not None else self.slot - self.rows
+        last = min(int(math.ceil(end / self.step)), self.slot) if end is not None else self.slot
+
+        for slot in range(first, last):
+            row = slot % self.rows
+            if self.slots[row] != slot:
+                continue
+            base = row * width
+            yield slot * self.step, [values[base + idx] for idx in columns]
+
+    def memory (self):
+        return self.slots.itemsize * self.rows + sum(a.itemsize * len(a) for a in self.values.values())
+
+
+class RingStore:
+
+    """
+    Tiers of consolidated values for one inverter. With a path, tiers with
+    persist set are appended to <path>-<step>s.csv.
+    """
+
+    def __init__ (self, dec, tiers=TIERS, path=None):
+
+        self.dec = dec
+        self.scales = dec.scales
+        self.fields = [dec.header[idx] for idx, mul, div, unit in dec.scales]
+        self.tiers = [Tier(step, rows, len(self.fields), persist) for step, rows, persist in tiers]
+        self.tiers.sort(key=lambda tier: tier.step)
+        self.path = path
+        self.files = {}                 # Open file for each persisted tier
+        self.writers = {}
+
+        if path:
+            self._restore()
+
+    def _partial (self, tier):
+        return self.path + "-" + str(tier.step) + "s.partial"
+
+    def _restore (self):
+
+        """ Continue the slots that were being consolidated when a previous RingStore was closed """
+
+        for tier in self.tiers:
+            fname = self._partial(tier)
+            if not tier.persist or not os.path.isfile(fname):
+                continue
+            try:
+                with open(fname) as f:
+                    tier.restore(json.load(f))
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                print("Could not restore partial slot from", fname, ":", str(error))
+            os.remove(fname)
+
+    def add (self, t, record):
+
+        """ Consolidate a sample (a record from the decoder) at time t (seconds since the epoch) """
+
+        values = [record[idx] / div if div > 1 else record[idx] * mul for idx, mul, div, unit in self.scales]
+
+        for tier in self.tiers:
+            done = tier.add(t, values)
+            if done and tier.persist and self.path:
+                self._write(tier, *done)
+
+    def _write (self, tier, t, averages, minima, maxima):
+
+        writer = self.writers.get(tier.step)
+
+        if not writer:
+            fname = self.path + "-" + str(tier.step) + "s.csv"
+            write_header = not os.path.isfile(fname) or not os.path.getsize(fname)
+            self.files[tier.step] = open(fname, "a")
+            writer = self.writers[tier.step] = csv.writer(self.files[tier.step], delimiter='\t')
+            if write_header:
+                writer.writerow(["time"] + [name + suffix for name in self.fields for suffix in ("", "_min", "_max")])
+
+        row = [datetime.datetime.fromtimestamp(t).isoformat()]
+        for values in zip(averages, minima, maxima):
+            row.extend("%.10g" % value for value in values)
+        writer.writerow(row)
+        self.files[tier.step].flush()
+
+    def tier (self, start=None, step=None):
+
+        """ Return the tier with a given step, or the finest tier that still holds data from start """
+
+        if step is not None:
+            for tier in self.tiers:
+                if tier.step == step:
+                    return tier
+            raise ValueError("No tier with a step of " + str(step) + " seconds")
+
+        for tier in self.tiers:
+            if start is None or tier.oldest() <= start:
+                return tier
+        return self.tiers[-1]
+
+    def query (self, fields, start=None, end=None, how='mean', step=None):
+
+        """
+        Yield (time, values) with the average, minimum or maximum of the given
+        fields in each slot from start up to end (datetimes), from the finest
+        tier that reaches back to start, or from the tier with the given step
+        """
+
+        try:
+            columns = [self.fields.index(field) for field in fields]
+        except ValueError:
+            raise ValueError("Unknown field, the ring store has " + ", ".join(self.fields))
+        if how not in FUNCTIONS:
+            raise ValueError("Unknown aggregate " + how + ", use one of " + ", ".join(FUNCTIONS))
+
+        start = start.timestamp() if start else None
+        end = end.timestamp() if end else None
+        tier = self.tier(start, step)
+
+        if tier.slot is None:
+            return
+
+        for t, values in tier.rows_between(start, end, how, columns):
+            yield datetime.datetime.fromtimestamp(t), values
+
+    def memory (self):
+
+        """ Return the number of bytes used by the tiers """
+
+        return sum(tier.memory() for tier in self.tiers)
+
+    def flush (self):
+
+        """ Make sure the persisted tiers are on disk """
+
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close (self):
+
+        """ Save the slots that are being consolidated, and close the files """
+
+        for tier in self.tiers:
+            state = tier.state()
+            if tier.persist and self.path and state:
+                with open(self._partial(tier), 'w') as f:
+                    json.dump(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.writers = {}
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+# scheduler.py
+
+# Polling scheduler for inverters sharing a single RS485 bus
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+
+import heapq
+import time
+
+
+class PollScheduler:
+
+    """
+    Decide when to request data from each inverter on a bus.
+
+    Deadlines are kept in a heap on the monotonic clock, so they are not
+    affected by NTP adjustments or changes of the system time. Each bus ID
+    can have its own sampling interval. Only one request is outstanding at
+    a time: after a request the bus is considered busy until a reply
+    arrives (plus a short turnaround gap) or until the reply time-out
+    expires, which lets polls of many inverters follow each other closely
+    without collisions.
+    """
+
+    def __init__(self, inv_ids, interval=60, intervals=None, replytimeout=1.0, turnaround=0.1, clock=time.monotonic):
+
+        self.interval = interval                # Default sampling interval in seconds
+        self.intervals = dict(intervals or {})  # Sampling interval per bus ID, overrides the default
+        self.replytimeout = replytimeout        # Seconds to wait for a reply before moving on
+        self.turnaround = turnaround            # Minimum gap between bus traffic and our next request
+        self.clock = clock
+
+        now = clock()
+
+        self.deadline = {}      # Next request time for each bus ID
+        self.lastsample = {}    # Time of the last stored sample for each bus ID
+        self.heap = []          # (deadline, bus ID) pairs, may contain outdated entries
+        self.busy_until = now   # No request may be sent before this time
+        self.pending = None     # Bus ID of the outstanding request, if any
+        self.requested = None   # Time of the outstanding request
+        self.timeouts = 0       # Requests that were not answered in time
+
+        for inv_id in inv_ids:
+            self.lastsample[inv_id] = None
+            self._schedule(inv_id, now)
+
+    def _schedule(self, inv_id, when):
+        self.deadline[inv_id] = when
+        heapq.heappush(self.heap, (when, inv_id))
+
+    def _top(self):
+
+        """ Return the earliest valid heap entry, dropping outdated ones """
+
+        heap = self.heap
+        while heap and self.deadline.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def interval_for(self, inv_id):
+        return self.intervals.get(inv_id, self.interval)
+
+    def next_deadline(self):
+
+        """ Return the monotonic time at which the next request may be sent """
+
+        top = self._top()
+        if top is None:
+            return self.busy_until + self.interval
+        return max(top[0], self.busy_until)
+
+    def pop_due(self, now=None):
+
+        """
+        Return the bus ID of the inverter that should be polled now, or None.
+        The caller is expected to send a request to the returned inverter.
+        """
+
+        if now is None:
+            now = self.clock()
+
+        top = self._top()
+        if top is None or top[0] > now or self.busy_until > now:
+            return None
+
+        if self.pending is not None:
+            self.timeouts += 1  # Previous request was never answered
+
+        inv_id = top[1]
+        self._schedule(inv_id, now + self.replytimeout)    # Retry if no sample arrives
+        self.busy_until = now + self.replytimeout
+        self.pending = inv_id
+        self.requested = now
+        return inv_id
+
+    def received(self, inv_id, request=False, now=None):
+
+        """
+        Note a message on the bus: a reply from inverter inv_id, or a request
+        to it (sent by another master, or the echo of our own request).
+        Returns the time since our request if this is the reply to it, else None.
+        """
+
+        if now is None:
+            now = self.clock()
+
+        if request:                 # A reply will probably follow
+            self.busy_until = max(self.busy_until, now + self.replytimeout)
+        elif inv_id == self.pending:
+            self.pending = None
+            self.busy_until = now + self.turnaround
+            return now - self.requested
+        else:
+            self.busy_until = max(self.busy_until, now + self.turnaround)
+        return None
+
+    def sample_due(self, inv_id, now=None):
+
+        """ Return True if it is time to store a new sample for inverter inv_id """
+
+        if now is None:
+            now = self.clock()
+
+        last = self.lastsample.get(inv_id)
+        return last is None or now - last >= self.interval_for(inv_id)
+
+    def sampled(self, inv_id, now=None):
+
+        """ Record that a sample was stored, and schedule the next request """
+
+        if now is None:
+            now = self.clock()
+
+        self.lastsample[inv_id] = now
+        if inv_id in self.deadline:
+            self._schedule(inv_id, now + self.interval_for(inv_id))
+
+
+class AdaptiveScheduler(PollScheduler):
+
+    """
+    PollScheduler that adapts the interval of each inverter to what it
+    reports. An inverter that stops answering is retried after exponentially
+    longer waits, and one that reports zero power or feed-in time (e.g. at
+    night) is polled half as often after every sample, up to 'ceiling'
+    seconds. While power or DC power changes by more than 'ramp' (a fraction
+    of the value) per minute, the interval is halved, down to 'floor'
+    seconds, and when things calm down it returns to the normal interval.
+    All intervals are stretched when needed to keep the estimated share of
+    bus time used by our polls within 'budget'.
+    """
+
+    watched = ('power', 'feedintime_day', 'dc1P', 'dc2P')    # Variables adapt() looks at
+
+    def __init__(self, inv_ids, interval=60, intervals=None, replytimeout=1.0, turnaround=0.1, clock=time.monotonic,
+                 floor=5, ceiling=600, budget=0.5, ramp=0.2, noise=100):
+
+        super().__init__(inv_ids, interval, intervals, replytimeout, turnaround, clock)
+
+        self.floor = floor              # Shortest interval in seconds
+        self.ceiling = ceiling          # Longest interval, and longest wait between retries
+        self.budget = budget            # Maximum fraction of bus time for our polls
+        self.ramp = ramp                # Relative change per minute that counts as fast
+        self.noise = noise              # Changes smaller than this (in W) are ignored
+
+        self.current = {inv_id: PollScheduler.interval_for(self, inv_id) for inv_id in self.deadline}
+        self.misses = {inv_id: 0 for inv_id in self.deadline}      # Consecutive requests without a reply
+        self.cost = {inv_id: replytimeout for inv_id in self.deadline}  # Bus time per poll (average)
+        self.previous = {}              # Watched values at the last sample of each inverter
+        self.backed_off = None          # Time of the last request we already backed off for
+
+        self.share = {inv_id: 0.0 for inv_id in self.deadline}     # Bus time per second for each inverter, unstretched
+        self.used = 0.0                 # Sum of the shares
+        for inv_id in self.deadline:
+            self._account(inv_id)
+
+    def _retry (self, inv_id):
+        return min(self.ceiling, self.replytimeout * 2 ** self.misses[inv_id])
+
+    def _account (self, inv_id):
+
+        """ Update the share of bus time of an inverter after its cost, interval or misses changed """
+
+        share = self.cost[inv_id] / (self._retry(inv_id) if self.misses[inv_id] else self.current[inv_id])
+        self.used += share - self.share[inv_id]
+        self.share[inv_id] = share
+
+    def scale (self):
+
+        """ Return the factor by which all intervals are stretched to stay within the bus-time budget """
+
+        return max(1.0, self.used / self.budget)
+
+    def interval_for(self, inv_id):
+        if inv_id not in self.current:
+            return PollScheduler.interval_for(self, inv_id)
+        return self.current[inv_id] * self.scale()
+
+    def effective (self, inv_id):
+
+        """ Return the seconds between requests to an inverter: its interval, or the wait before the next retry """
+
+        if self.misses[inv_id]:
+            return self._retry(inv_id) * self.scale()
+        return self.interval_for(inv_id)
+
+    def utilisation (self):
+
+        """ Return the estimated fraction of bus time used by our polls """
+
+        return self.used / self.scale()
+
+    def _cost (self, inv_id, seconds):
+        self.cost[inv_id] += 0.2 * (seconds - self.cost[inv_id])
+
+    def pop_due(self, now=None):
+
+        if now is None:
+            now = self.clock()
+
+        missed = self.pending
+        if missed is not None and now >= self.busy_until and self.requested != self.backed_off:
+
+            # No reply within the time-out: wait twice as long before each retry
+
+            self.backed_off = self.requested
+            self.misses[missed] += 1
+            self._cost(missed, self.replytimeout)
+            self._account(missed)
+            self._schedule(missed, self.requested + self.effective(missed))
+
+        return super().pop_due(now)
+
+    def received(self, inv_id, request=False, now=None):
+
+        latency = super().received(inv_id, request, now)
+        if latency is not None:
+            self.misses[inv_id] = 0
+            self._cost(inv_id, latency + self.turnaround)
+            self._account(inv_id)
+        return latency
+
+    def adapt (self, inv_id, values, now=None):
+
+        """
+        Adjust the interval of an inverter to the watched values in a sample
+        (a dictionary with some or all of the names in 'watched'). Call this
+        before sampled().
+        """
+
+        if inv_id not in self.current:
+            return
+        if now is None:
+            now = self.clock()
+
+        base = PollScheduler.interval_for(self, inv_id)
+        current = self.current[inv_id]
+        previous = self.previous.get(inv_id)
+        last = self.lastsample.get(inv_id)
+        self.previous[inv_id] = values
+
+        if values.get('power') == 0 or values.get('feedintime_day') == 0:      # Off or in standby
+            self.current[inv_id] = min(self.ceiling, max(current, base) * 2)
+            self._account(inv_id)
+            return
+
+        current = min(current, base)                # Back from standby
+
+        if previous and last is not None and now > last:
+            change = 0.0
+            for name in ('power', 'dc1P', 'dc2P'):
+                if name in values and name in previous:
+                    old, new = previous[name], values[name]
+                    if abs(new - old) >= self.noise:
+                        change = max(change, abs(new - old) / max(abs(old), abs(new)))
+            change *= 60 / (now - last)             # Per minute
+            if change >= self.ramp:
+                current = max(self.floor, current / 2)
+            elif change < self.ramp / 2:
+                current = min(base, current * 1.5)
+
+        self.current[inv_id] = current
+        self._account(inv_id)
+
+    def summary (self):
+
+        """ Return a one-line description of the effective interval of each inverter """
+
+        parts = ['ID %d every %.0fs' % (inv_id, self.effective(inv_id)) +
+                 (' (%d misses)' % self.misses[inv_id] if self.misses[inv_id] else '')
+                 for inv_id in sorted(self.current)]
+        return 'Polling: ' + ', '.join(parts) + '; %.0f%% of bus time' % (100 * self.utilisation())
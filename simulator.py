@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+# simulator.py
+
+# Simulate a bus with Delta Solivia RPI M-series inverters on a pseudo-terminal,
+# so soliviamonitor.py and multibus.py can be run without hardware.
+# Usage: python3 simulator.py [inverters [latency [noise truncation crc-errors [poll-interval]]]]
+# e.g. python3 simulator.py 4 0.05 0.01 0.01 0.01
+# prints the name of the pseudo-terminal (e.g. /dev/pts/3) to use as serial port.
+# Latency is in seconds, error rates are the fraction of replies that get
+# random bytes inserted before them, are cut short, or have a corrupted byte.
+# With a poll interval, the simulator also plays another bus master (like a
+# vendor datalogger) that polls the inverters in turn, for testing listen-only mode.
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+
+import datetime
+import heapq
+import math
+import os
+import random
+import selectors
+import sys
+import termios
+import tty
+from time import monotonic, time
+
+import crc16
+import decoder
+import framing
+import protocol
+
+verbose = 0
+
+
+class Inverter:
+
+    """ Values of one simulated inverter, following a clear-sky power curve with passing clouds """
+
+    def __init__ (self, inv_id, peak=15000, rng=None):
+
+        self.inv_id = inv_id
+        self.peak = peak                                    # Peak AC power in W
+        self.rng = rng or random.Random(inv_id)
+        self.serial = ("%018d" % (241051505003463200 + inv_id)).encode('ascii')
+        self.energy = 10000 + self.rng.randrange(50000)      # Total energy in kWh
+        self.feedintime = self.energy * 3600 // 10
+        self.clouds = 1.0
+
+    def values (self, t):
+
+        """ Return a dictionary with the values (in the units of protocol.rvars) at time t (seconds since the epoch) """
+
+        local = datetime.datetime.fromtimestamp(t)
+        hour = local.hour + local.minute / 60 + local.second / 3600
+        sun = max(0.0, math.sin((hour - 6) * math.pi / 14))
+
+        self.clouds = min(1.0, max(0.2, self.clouds + self.rng.uniform(-0.05, 0.05)))
+        ac = self.peak * sun * self.clouds
+        dc = ac * 1.03
+        phase = ac / 3
+        v = {'partno': b'RPI153FA0E0', 'serial': self.serial, 'fwrev_sap': b'\x00' * 6,
+             'fwrev_pwr_maj': 1, 'fwrev_pwr_min': 60, 'fwrev_pwr_date': b'\x0f\x0c',
+             'fwrev_sts_maj': 2, 'fwrev_sts_min': 36, 'fwrev_sts_date': b'\x0f\x26',
+             'fwrev_disp_maj': 15, 'fwrev_disp_min': 193, 'fwrev_disp_date': b'\x08\xba',
+             'dc1V': 620 + self.rng.uniform(-5, 5), 'dc2V': 615 + self.rng.uniform(-5, 5),
+             'power': ac, 'bus+V': 370.4, 'bus-V': 375.0,
+             'energytotal_day': ac * max(hour - 6, 0) / 2, 'feedintime_day': max(hour - 6, 0) * 3600 if ac else 0,
+             'energytotal': self.energy, 'feedintime_total': self.feedintime,
+             'temp': 25 + 30 * sun, 'status_history': bytes(20)}
+
+        for phase_no, volt in ((1, 230.1), (2, 231.4), (3, 229.8)):
+            v['ac%dV' % phase_no] = v['ac%dV2' % phase_no] = volt + self.rng.uniform(-1, 1)
+            v['ac%dF1' % phase_no] = v['ac%dF2' % phase_no] = 50 + self.rng.uniform(-0.02, 0.02)
+            v['ac%dP' % phase_no] = phase
+            v['ac%dI' % phase_no] = phase / volt
+
+        v['dc1P'] = v['dc2P'] = dc / 2
+        v['dc1I'], v['dc2I'] = dc / 2 / v['dc1V'], dc / 2 / v['dc2V']
+
+        if not sun:                 # Standby at night, nothing is measured
+            for name in ('ac1V', 'ac1V2', 'ac1F1', 'ac1F2', 'ac2V', 'ac2V2', 'ac2F1', 'ac2F2',
+                         'ac3V', 'ac3V2', 'ac3F1', 'ac3F2', 'dc1V', 'dc2V', 'temp'):
+                v[name] = 0
+        return v
+
+    def block (self, t):
+
+        """ Return the data block that the inverter would send in reply to command 0x60 0x01 """
+
+        values = self.values(t)
+        raw = []
+        for var in protocol.rvars:
+            value = values.get(var[0], 0)
+            if len(var) > 3:
+                value = int(round(value / 10 ** var[3])) & (0xffff if var[1] == 'H' else 0xffffffff)
+            raw.append(value)
+        return decoder.rpi_m.struct.pack(*raw)
+
+
+def reply (inv_id, cmd, data):
+
+    """ Return a complete reply message with data for command cmd """
+
+    body = bytes([framing.ACK, inv_id, len(cmd) + len(data)]) + cmd + data
+    crc = crc16.calcData(body)
+    return bytes([framing.STX]) + body + bytes([crc & 0xff, crc >> 8, framing.ETX])
+
+
+class BusSimulator:
+
+    """
+    Simulated RS485 bus on a pseudo-terminal. Replies to requests for
+    command 0x60 0x01 after 'latency' seconds (plus the transmission time at
+    the given baud rate), and injects noise, truncated replies and CRC errors
+    at the given rates. If poll_interval is set, another master is simulated
+    that sends a request every poll_interval seconds, to each inverter in turn.
+    Inverters is a number of inverters with bus IDs from 1, or a list of bus
+    IDs. If speed is set, the inverters only understand requests while the
+    baud rate of the pseudo-terminal is set to that speed.
+    """
+
+    def __init__ (self, inverters=1, latency=0.0, noise=0.0, truncation=0.0, crc_errors=0.0,
+                  baudrate=None, speedup=1.0, seed=1, poll_interval=None, speed=None):
+
+        self.latency = latency
+        self.noise = noise
+        self.truncation = truncation
+        self.crc_errors = crc_errors
+        self.baudrate = baudrate            # Add the transmission time of replies, if set
+        self.speedup = speedup              # Run the clock of the power curves faster than real time
+        self.poll_interval = poll_interval  # Interval between requests of the simulated other master
+        self.rng = random.Random(seed)
+        if isinstance(inverters, int):
+            inverters = range(1, inverters + 1)
+        self.inverters = {inv_id: Inverter(inv_id, rng=random.Random(seed * 1000 + inv_id))
+                          for inv_id in inverters}
+        self.speed = getattr(termios, 'B' + str(speed)) if speed else None
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.reader = framing.FrameReader()
+        self.outgoing = []                  # (send time, sequence number, message) heap
+        self.sequence = 0
+        self.start = time()
+        self.started = monotonic()
+
+        # Counters
+
+        self.requests = 0
+        self.replies = 0
+        self.garbled = 0                    # Requests sent at the wrong baud rate
+        self.injected = {'noise': 0, 'truncation': 0, 'crc': 0}
+
+    def now (self):
+        return self.start + (monotonic() - self.started) * self.speedup
+
+    def handle (self, frame):
+
+        """ Queue a reply to a request, if an inverter with that bus ID exists """
+
+        if frame[1] != framing.ENQ:
+            return
+        inv = self.inverters.get(frame[2])
+        cmd = bytes(frame[4:6])
+        self.requests += 1
+        if not inv or cmd != b'\x60\x01':
+            return
+
+        message = reply(inv.inv_id, cmd, inv.block(self.now()))
+        delay = self.latency
+
+        if self.rng.random() < self.crc_errors:
+            message = bytearray(message)
+            message[self.rng.randrange(6, len(message) - 3)] ^= 1 << self.rng.randrange(8)
+            message = bytes(message)
+            self.injected['crc'] += 1
+        if self.rng.random() < self.truncation:
+            message = message[:self.rng.randrange(1, len(message))]
+            self.injected['truncation'] += 1
+        if self.rng.random() < self.noise:
+            message = bytes(self.rng.getrandbits(8) for i in range(self.rng.randrange(1, 16))) + message
+            self.injected['noise'] += 1
+
+        if self.baudrate:
+            delay += len(message) * 10 / self.baudrate
+
+        self.sequence += 1
+        heapq.heappush(self.outgoing, (monotonic() + delay, self.sequence, message))
+
+    def run (self, duration=None):
+
+        """ Answer requests until duration seconds have passed (or forever) """
+
+        sel = selectors.DefaultSelector()
+        sel.register(self.master, selectors.EVENT_READ)
+        end = monotonic() + duration if duration is not None else None
+        next_poll = monotonic()
+        polled = sorted(self.inverters)
+
+        while end is None or monotonic() < end:
+
+            now = monotonic()
+
+            if self.poll_interval and now >= next_poll:     # Request of the other master
+                request = protocol.build_request(polled[0], b'\x60\x01')
+                os.write(self.master, request)
+                self.handle(request)
+                polled.append(polled.pop(0))
+                next_poll += self.poll_interval
+
+            while self.outgoing and self.outgoing[0][0] <= now:
+                os.write(self.master, heapq.heappop(self.outgoing)[2])
+                self.replies += 1
+
+            timeout = self.outgoing[0][0] - now if self.outgoing else 1.0
+            if self.poll_interval:
+                timeout = min(timeout, next_poll - now)
+            if end is not None:
+                timeout = min(timeout, end - now)
+
+            for key, events in sel.select(max(timeout, 0)):
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:         # Other end closed
+                    return
+                if self.speed is not None and termios.tcgetattr(self.slave)[5] != self.speed:
+                    self.garbled += 1           # The inverters can't make sense of this
+                    continue
+                for frame in self.reader.feed(data):
+                    if verbose:
+                        print("Request for inverter", frame[2], "command", bytes(frame[4:6]).hex())
+                    self.handle(frame)
+
+    def close (self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def main ():
+
+    global verbose
+
+    inverters = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    rates = [float(arg) for arg in sys.argv[3:6]] + [0.0] * (6 - min(max(len(sys.argv), 3), 6))
+    poll_interval = float(sys.argv[6]) if len(sys.argv) > 6 else None
+
+    verbose = 1
+    sim = BusSimulator(inverters, latency, *rates, baudrate=19200, poll_interval=poll_interval)
+    print("Simulating", inverters, "inverters on", sim.port, flush=True)
+
+    try:
+        sim.run()
+    except KeyboardInterrupt:
+        print(sim.requests, "requests,", sim.replies, "replies, injected errors:", sim.injected)
+
+
+if __name__ == "__main__":
+    main()
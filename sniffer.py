@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+# sniffer.py
+
+# Follow the traffic of another bus master (e.g. a vendor datalogger)
+# without transmitting: pair each request with its reply, and keep
+# track of what is polled, how often, and how fast the inverters answer
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+
+import time
+
+import framing
+
+
+class Poll:
+
+    """ Statistics for one bus ID and command as polled by the other master """
+
+    def __init__ (self):
+        self.requests = 0
+        self.replies = 0
+        self.unanswered = 0
+        self.last_request = None
+        self.interval = None        # Average time between requests (exponentially weighted)
+        self.latency = None         # Average time from request to reply (exponentially weighted)
+        self.max_latency = 0.0
+
+
+def _average (average, value, weight=0.1):
+    return value if average is None else average + weight * (value - average)
+
+
+class BusSniffer:
+
+    """
+    Pair requests (ENQ) with replies (ACK) on a bus where someone else is
+    polling. A request is answered by the next reply from the same bus ID
+    with the same command, if it arrives within replytimeout seconds.
+    """
+
+    def __init__ (self, replytimeout=1.0, clock=time.monotonic):
+
+        self.replytimeout = replytimeout
+        self.clock = clock
+        self.polls = {}             # (bus ID, command) -> Poll
+        self.outstanding = None     # (bus ID, command, time) of the last request without reply
+        self.unsolicited = 0        # Replies without a matching request
+
+    def poll (self, inv_id, cmd):
+        key = (inv_id, cmd)
+        if key not in self.polls:
+            self.polls[key] = Poll()
+        return self.polls[key]
+
+    def observe (self, frame, now=None):
+
+        """
+        Note a message seen on the bus. Returns the time since the matching
+        request if the message is a reply to it, otherwise None.
+        """
+
+        if now is None:
+            now = self.clock()
+
+        inv_id = frame[2]
+        cmd = bytes(frame[4:6])
+
+        if self.outstanding and now - self.outstanding[2] > self.replytimeout:
+            self.poll(*self.outstanding[:2]).unanswered += 1
+            self.outstanding = None
+
+        if frame[1] == framing.ENQ:
+
+            if self.outstanding:    # Previous request was not answered before this one
+                self.poll(*self.outstanding[:2]).unanswered += 1
+
+            p = self.poll(inv_id, cmd)
+            p.requests += 1
+            if p.last_request is not None:
+                p.interval = _average(p.interval, now - p.last_request)
+            p.last_request = now
+            self.outstanding = (inv_id, cmd, now)
+            return None
+
+        if self.outstanding and self.outstanding[:2] == (inv_id, cmd):
+            latency = now - self.outstanding[2]
+            self.outstanding = None
+            p = self.poll(inv_id, cmd)
+            p.replies += 1
+            p.latency = _average(p.latency, latency)
+            p.max_latency = max(p.max_latency, latency)
+            return latency
+
+        self.unsolicited += 1
+        return None
+
+    def summary (self):
+
+        """ Return a one-line description of the polling by the other master """
+
+        parts = []
+        for (inv_id, cmd), p in sorted(self.polls.items()):
+            part = 'ID %d cmd %s: %d requests, %d replies, %d unanswered' % (inv_id, cmd.hex(), p.requests,
+                                                                           p.replies, p.unanswered)
+            if p.interval is not None:
+                part += ', every %.1fs' % p.interval
+            if p.latency is not None:
+                part += ', reply in %.3fs (max %.3fs)' % (p.latency, p.max_latency)
+            parts.append(part)
+        if self.unsolicited:
+            parts.append('%d unpaired replies' % self.unsolicited)
+        return 'Other master: ' + ('; '.join(parts) if parts else 'no traffic seen')
@@ -26,150 +26,127 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+# Usage: python3 soliviamonitor.py [configuration file]
+# The configuration file is a JSON object with settings that override the
+# ones below, e.g. {"port": "/dev/ttyUSB1", "storage": "delta", "adaptive": true}
+#
+# Importing this module has no side effects: the serial port, the output
+# files, the signal handlers and the modules for the storage, reporting
+# and capture options that are enabled are only set up by setup(), and
+# main() runs the collector.
+
 
-import struct
-import serial
 import datetime
 import csv
+import json
 import os.path
 import sys
 import signal
+import selectors
+from time import monotonic
 
-import crc16
+import decoder
+import framing
+import metrics
+import protocol
+import scheduler
+import sniffer
 
-reporting = True
-try:
-    import report
-    print("Will report energy totals to an external server")
-except ImportError:
-    reporting = False
-    print("Will NOT report energy totals to an external server")
+reporting = False           # Set by setup() if report.py or reporturl is there
+report = None
 
 verbose = 1                 # Verbosity flag
 debugging = 0               # Debugging flag
-inverters = 2               # Number of inverters (TODO: actually use this variable)
+inverters = 2               # Number of inverters, with bus IDs 1 to inverters
 basepath = "/root/delta/"   # Path where CSV output files should be saved 
-
-connection = serial.Serial('/dev/ttyUSB0',19200,timeout=0.2);   # Serial device
-
-# Variables in the data-block of a Delta RPI M-series inverter,
-# as far as I've been able to establish their meaning.
-# The fields for each variable are as follows: 
-# name, struct-definition, size in bytes, multiplier-exponent (10^x), unit, SunSpec equivalent
-
-rvars = (("partno", "11s", 11),
-        ("serial", "18s", 18),
-        ("fwrev_sap", "6s", 6),
-        ("fwrev_pwr_maj", "B", 1),
-        ("fwrev_pwr_min", "B", 1),
-        ("fwrev_pwr_date", "2s", 2),
-        ("fwrev_sts_maj", "B", 1),
-        ("fwrev_sts_min", "B", 1),
-        ("fwrev_sts_date", "2s", 2),
-        ("fwrev_disp_maj", "B", 1),
-        ("fwrev_disp_min", "B", 1),
-        ("fwrev_disp_date", "2s", 2),
-        ("ac1V", "H", 2, -1, "V"),
-        ("ac1I", "H", 2, -2, "A", "AphA"),
-        ("ac1P", "H", 2, 0, "W"),
-        ("ac1F1", "H", 2, -2, "Hz"),
-        ("ac1V2", "H", 2, -1, "V"),
-        ("ac1F2", "H", 2, -2, "Hz"),
-        ("ac2V", "H", 2, -1, "V"),
-        ("ac2I", "H", 2, -2, "A", "AphB"),
-        ("ac2P", "H", 2, 0, "W"),
-        ("ac2F1", "H", 2, -2, "Hz"),
-        ("ac2V2", "H", 2, -1, "V"),
-        ("ac2F2", "H", 2, -2, "Hz"),
-        ("ac3V", "H", 2, -1, "V"),
-        ("ac3I", "H", 2, -2, "A", "AphC"),
-        ("ac3P", "H", 2, 0, "W"),
-        ("ac3F1", "H", 2, -2, "Hz"),
-        ("ac3V2", "H", 2, -1, "V"),
-        ("ac3F2", "H", 2, -2, "Hz"),
-        ("dc1V", "H", 2, -1, "V"),
-        ("dc1I", "H", 2, -2, "A"),
-        ("dc1P", "H", 2, 0, "W"),
-        ("dc2V", "H", 2, -1, "V"),
-        ("dc2I", "H", 2, -2, "A"),
-        ("dc2P", "H", 2, 0, "W"),
-        ("power", "H", 2, 0, "W"),
-        ("bus+V", "H", 2, -1, "V"),
-        ("bus-V", "H", 2, -1, "V"),
-        ("energytotal_day", "I", 4, 0, "Wh"),
-        ("feedintime_day", "I", 4, 0, "s"),
-        ("energytotal", "I", 4, 0, "kWh"),
-        ("feedintime_total", "I", 4, 0, "s"),
-        ("temp", "H", 2, 0, "C", "TmpSnk"),
-        ("status_ac1", "B", 1),
-        ("status_ac2", "B", 1),
-        ("status_ac3", "B", 1),
-        ("status_ac4", "B", 1),
-        ("status_dc1", "B", 1),
-        ("status_dc2", "B", 1),
-        ("status_error", "B", 1),
-        ("status_error_ac1", "B", 1),
-        ("status_error_global1", "B", 1),
-        ("status_error_cpu", "B", 1),
-        ("status_error_global2", "B", 1),
-        ("limits_ac1", "B", 1),
-        ("limits_ac2", "B", 1),         
-        ("status_error_global3", "B", 1),
-        ("limits_dc1", "B", 1),
-        ("limits_dc2", "B", 1),         
-        ("status_history", "20s", 20))
-
-
-structstr = ">"     # Initial struct description string for the data block
-structlen = 0       # Length of our struct data
-varheader = []      # Variable names for the CSV header
-
-idx = 0
-varlookup = {}      # Dict for finding the index of a given variable
-
-# Construct a full struct description for our data block, 
-# and a header line for our CSV.
-
-for var in rvars:
-    varheader.append(var[0])
-    structstr += var[1]
-    structlen += var[2]
-    varlookup[var[0]] = idx
-    idx += 1
-
-if debugging:
-    print(varheader)
-
+port = '/dev/ttyUSB0'       # Serial device
+baudrate = 19200            # Baud rate of the inverters
+siteconfig = basepath + "site.json"     # Port, baud rate and bus IDs found by discover.py, override the above
+                                        # unless port or baudrate are set in the configuration file
+storage = "csv"             # Sample storage: "csv" for tab-separated files, "binary" for binstore segments,
+                            # "delta" for compact deltastore segments, None to only report energy totals
+reporturl = None            # Without report.py, POST energy totals to this URL (see reportqueue.py), None to disable
+reportqueuepath = basepath + "report-queue.json"    # Energy totals not reported yet, None to keep them in memory only
+ringtiers = None            # E.g. ringstore.TIERS to keep samples in RAM at several resolutions, and only write
+                            # the consolidated tiers (set sampleinterval to the smallest step, e.g. 1)
+capturepath = None          # Directory to capture every valid message in, exactly as received, so it can be
+                            # decoded again later (see capture.py), e.g. basepath + "capture", None to disable
+cacheaddress = None         # Serve the latest values of every inverter to local clients (see latest.py), on a
+                            # Unix socket path, e.g. "/tmp/soliviamonitor.sock", or "127.0.0.1:9106", None to disable
+cachemaxage = 300           # Seconds after which the cache no longer returns a value as the latest
+aggregate = False           # Keep hourly and daily energy, peaks and averages of every reply in small
+                            # summary files, <basepath><bus ID>-<serial>-hourly.sum and -daily.sum (see aggregates.py)
 
 # Housekeeping variables for sampling and buffering of data
 
-lastlogtime = 0         # Time of last data write
+lastlogtime = 0         # Time of last data write (monotonic clock)
 sampleinterval = 60     # Inverter sampling interval in seconds 
+sampleintervals = {}    # Sampling intervals for specific bus IDs, e.g. {3: 300}
 loginterval = 60*10     # Data write-interval in seconds 
+replytimeout = 1        # Seconds to wait for a reply before requesting data again
+turnaround = 0.1        # Seconds the bus should be quiet before we send a request
+listenonly = False      # Never transmit, only sample the replies to another master (e.g. a vendor datalogger)
+separatereader = False  # Read the serial port in a separate process, so slow writes or reports can't delay it
+ringsize = 64*1024      # Bytes in the shared memory ring buffer between the reader process and this one
+adaptive = False        # Adapt the interval of each inverter: back off when it is off or silent, poll faster while power ramps
+pollfloor = 5           # Shortest interval in seconds with adaptive polling
+pollceiling = 600       # Longest interval in seconds with adaptive polling
+busbudget = 0.5         # Maximum fraction of bus time for our requests and their replies with adaptive polling
+rampthreshold = 0.2     # Relative change in power per minute at which adaptive polling speeds up
+
+walpath = "/tmp/soliviamonitor.wal"     # Write-ahead log for samples not yet written (on RAM-disk), None to disable
+walsize = 4*1024*1024                   # Size of the write-ahead log in bytes
+walsync = False                         # Sync the log after every sample, only useful if walpath is on flash
+logbytes = 1024*1024                    # Write samples early if this many bytes are waiting in the log
+
+metricsport = 9105          # Serve Prometheus metrics on http://localhost:9105/metrics, None to disable
+summaryinterval = 60*10     # Seconds between metrics summary lines in the log, 0 to disable
+
+configured = set()          # Settings that were set in the configuration file
+
+# Names of the settings above, which can be set in a configuration file
+
+settings = ('verbose', 'debugging', 'inverters', 'basepath', 'port', 'baudrate', 'siteconfig', 'storage',
+            'reporturl', 'reportqueuepath', 'ringtiers', 'capturepath', 'cacheaddress', 'cachemaxage', 'aggregate',
+            'sampleinterval', 'sampleintervals', 'loginterval', 'replytimeout', 'turnaround', 'listenonly',
+            'separatereader', 'ringsize', 'adaptive', 'pollfloor', 'pollceiling', 'busbudget', 'rampthreshold',
+            'walpath', 'walsize', 'walsync', 'logbytes', 'metricsport', 'summaryinterval')
+
+busids = []                 # Bus ID of each inverter
+invindex = {}               # Index in the lists below for each bus ID
+connection = None           # Serial device
+reader = None               # Buffered message reader for the connection
+reports = None              # Background queue for reports to the external server, if any
+polls = None                # Poll scheduler
+sniff = None                # Pairs requests of another master with replies, in listen-only mode
+lastsummary = monotonic()   # Time of the last summary line
+
+ring = None                 # Ring buffer with messages from the reader process, if separatereader is set
+busreader = None            # The reader process
+stopping = False            # Set by the signal handler when the reader process should be stopped
 
 idx = 0
 data = bytes()
 
 time = datetime.datetime.now()      # Current time
-last_data = time - time             # Time of last reply-block (set to zero)
 
 csvwriter_raw = []          # CSV output for "raw" inverter data (written to RAM-disk, not really needed except for debugging)
 csvwriter_subset = []       # CSV output for processed inverter data subset
+outfiles = []               # Open output file for each inverter, so we can sync it after writing
 samples = []                # Data-samples stored in memory, to reduce flash-writes
+firstseq = []               # Write-ahead log sequence number of the first sample in each sample-list
+samplelog = None            # Write-ahead log, if enabled
 total_energy_Wh = []        # Total energy counter for each inverter 
 total_energy_Wh_prev = []   # Previously reported energy count, useful for reporting energy to a server
-lastsampletime = []         # Time of last inverter read
-
-# Build lists
+serials = []                # Serial number of each inverter, once it has replied
+identities = decoder.IdentityCache()    # Part number, serial and firmware of each bus ID, decoded once
+totalfield = ("energytotal",)           # Variables we need from every reply, even if no sample is due
+rings = []                  # Ring store in RAM for each inverter, if ringtiers is set
+summaries = []              # Hourly and daily statistics for each inverter, if aggregate is set
+captures = None             # Every valid message, if capturepath is set
+cache = None                # Latest data block of every inverter, if cacheaddress is set
 
-for inv in range(0, inverters):
-    samples.append(list())
-    total_energy_Wh.append(0) 
-    total_energy_Wh_prev.append(0)
-    csvwriter_subset.append(0)   
-    csvfile = open('/tmp/inv' + str(inv + 1) + '.csv', "a")
-    csvwriter_raw.append(csv.writer(csvfile, delimiter='\t'))
-    lastsampletime.append(datetime.datetime.now())
+varheader = protocol.varheader      # Variables in the data-block are defined in protocol.py
 
 
 def write_samples(use_report):
@@ -190,31 +167,79 @@ def write_samples(use_report):
         
         try:
         
-            for sample in samples[inv]:
-                csvwriter_subset[inv].writerow(sample)
+            if samples[inv]:
+                with metrics.timer('storage_seconds_total'):
+                    csvwriter_subset[inv].writerows(samples[inv])
+                    outfiles[inv].flush()
+                    os.fsync(outfiles[inv].fileno())    # One sync per batch
                 
             samples[inv] = list()   # Clear sample-lists
+            firstseq[inv] = None
         
-        except:
+        except (OSError, ValueError) as error:
             
-            error = sys.exc_info()[0]
-            print(time(), "Error writing samples to file:", str(error))
+            # Keep the samples, we'll try again at the next write
+            
+            print(datetime.datetime.now(), "Error writing samples to file:", str(error))
             
         # Update total energy counters
     
         if total_energy_Wh[inv] and total_energy_Wh[inv] != total_energy_Wh_prev[inv]:
             
             if reporting and use_report:
-                try:
-                    if verbose:
-                        print("Reporting energy total to server, inverter index", inv)
-                    report.send_total(inv, total_energy_Wh[inv])
-                except:
-                    print("Error while calling report.send_total:", str(sys.exc_info()[0]))
+                if verbose:
+                    print("Queueing energy total for the server, inverter index", inv)
+                reports.put(inv, total_energy_Wh[inv])
                     
             total_energy_Wh_prev[inv] = total_energy_Wh[inv]
+    
+    # Samples that have been written can be removed from the write-ahead log
+    
+    if samplelog:
+        unsaved = [seq for seq in firstseq if seq is not None]
+        samplelog.checkpoint(min(unsaved) - 1 if unsaved else None)
+        
+    for ring_store in rings:
+        if ring_store:
+            ring_store.flush()
+    
+    for summary in summaries:
+        if summary:
+            summary.flush()
+    
+    if captures:
+        captures.flush()
         
-    lastlogtime = datetime.datetime.now()   # Update last log time
+    lastlogtime = monotonic()   # Update last log time
+
+
+def shutdown (status=0):
+    
+    """ Stop the reader process (if any), process what it left in the ring buffer, write our data and exit """
+    
+    if busreader:
+        busreader.terminate()
+        busreader.join(5)
+        while True:
+            record = ring.get(0)
+            if not record:
+                break
+            handle_record(record)
+        if verbose:
+            print("Ring buffer:", ring.records(), "messages,", ring.overruns(), "overruns, at most",
+                  "%.0f%%" % (100 * ring.max_occupancy()), "in use")
+        ring.close()
+    write_samples(False)
+    for ring_store in rings:
+        if ring_store:
+            ring_store.close()
+    if captures:
+        captures.close()
+    if cache:
+        latest.close()
+    if reports:
+        reports.close()
+    sys.exit(status)
 
 
 # Catch SIGINT/SIGTERM/SIGKILL and exit gracefully
@@ -223,319 +248,602 @@ def signal_handler(signal, frame):
     
     ''' Signal handler to write data when a lethal signal is received '''
     
+    global stopping
+    
     print("Received signal:", signal)
-    write_samples(False)
-    sys.exit(0)
+    if busreader:
+        stopping = True         # Leave the ring buffer in a consistent state, the main loop will shut down
+        return
+    shutdown()
 
-# Register signal handlers
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+send_request = protocol.send_request
+decode_response = protocol.decode_response
 
 
-def send_request (connection, inv_id, cmd):
+def open_writer (inv_idx, inv_id, serial, dec):
     
-    """ Send command (e.g. b'\x60\x01') to the inverter with id inv_id """
+    """ 
+    Open the output for an inverter, if not already done, and return 
+    the time of the last sample already stored there (or None) 
+    """
     
-    # Borrowed from DeltaPVOutput
+    if csvwriter_subset[inv_idx]:
+        return None
+        
+    if storage in ("binary", "delta"):
+        # Open a directory with binary or delta-encoded segments for this serial
+        dname = basepath + str(inv_id) + "-" + serial
+        print("Will write to" + dname)
+        store = deltastore if storage == "delta" else binstore
+        csvw = store.SegmentWriter(dname, dec)
+        outfiles[inv_idx] = csvw
+        last = store.last_time(dname)
+        last_stored = datetime.datetime.fromtimestamp(last) if last else None
+        
+    else:
+        # Open a CSV-file for this serial
+        fname = basepath + str(inv_id) + "-" + serial + ".csv"
+        print("Will write to" + fname)
+        write_header = True
+        if os.path.isfile(fname) and os.path.getsize(fname):
+            write_header = False        # Don't write header if file exists
+        last = wal.csv_last_time(fname)
+        last_stored = datetime.datetime.fromisoformat(last) if last else None
+        ofile = open(fname, "a")        # Append data
+        csvw = csv.writer(ofile, delimiter='\t')
+        outfiles[inv_idx] = ofile
+        if write_header:
+            csvw.writerow(["time"] + dec.subset_header)     # Write header line
+            
+    csvwriter_subset[inv_idx] = csvw
+    return last_stored
+
+
+def replay_samples ():
     
-    length = len(cmd)
-    msgbody = struct.pack('BBB%ds'%length, 5, inv_id, length, cmd)
-    crcval = crc16.calcData(msgbody)
-    lsb = crcval & (0xff)
-    msb = (crcval >> 8) & 0xff
-    data = struct.pack('BBBB%dsBBB'%length, 2, 5, inv_id, length, cmd, lsb, msb, 3)
+    """ Put samples from the write-ahead log that were never written back in the sample-lists """
     
-    if debugging:
-        print("Sending data query to inverter", inv_id)
+    count = 0
+    last_stored = {}
+    
+    for t, bus_idx, inv_id, name, block in samplelog.replay():
         
-    connection.write(data)
-    connection.flush()
+        inv_idx = invindex.get(inv_id)
+        dec = decoder.find(name)
+        if not dec or inv_idx is None:
+            continue
+            
+        u = dec.decode(block)
+        time = datetime.datetime.fromtimestamp(t)
+        
+        if inv_idx not in last_stored:
+            last_stored[inv_idx] = open_writer(inv_idx, inv_id, str(u.serial, "ascii"), dec)
+            
+        # Compare in milliseconds, delta segments keep no more than that
+        if last_stored[inv_idx] and round(t * 1000) <= round(last_stored[inv_idx].timestamp() * 1000):
+            continue                    # Already written before we stopped
+            
+        if storage in ("binary", "delta"):
+            samples[inv_idx].append((time, u))
+        else:
+            samples[inv_idx].append([time.isoformat()] + dec.subset(u))
+        if firstseq[inv_idx] is None:
+            firstseq[inv_idx] = samplelog.checkpoint_seq + 1
+        count += 1
+        
+    if verbose:
+        print("Replayed", count, "samples from the write-ahead log")
 
 
-def get_message (connection, timeout):
+def process_message (data, received=None, wall=None, sample=None):
     
     """ 
-    Attempt to read a Delta-message from a serial connection, 
-    with an optional time-out in seconds 
+    Decode a message, and store a sample if it contains an inverter data block.
+    The reader process passes the (monotonic and wall-clock) time the message
+    was received, and whether a sample is due.
     """
     
-    connection.timeout = timeout    # Timeout for serial data read, in seconds
+    global time, lastlogtime
     
-    data = connection.read(1)       # Read one byte
-
-    if data and data[0] == 0x02:    # Look for STX
-
-        newdata = connection.read(1)       # STX found, read another byte
-        data = bytearray(data)             # Make "bytes" a mutable byte-array, so we can append bytes
-
-        if newdata: 
-
-            if newdata[0] == 0x05 or newdata[0] == 0x06:    # ENQ or ACK
-                
-                data.extend(newdata)        # Append ACK to STX
-                
-                newdata = connection.read(2)    # Read 2 more bytes
-                
-                if newdata:
-                    data.extend(newdata)
-                    inv_id = newdata[0]            # Inverter ID on the RS485-bus
-                    length = newdata[1]            # Response length (including CMD, excluding CRC and ETX)
-                else:
-                    return None                    # Timeout, discard data
-                
-                if debugging:
-                    print("Found message from/for inverter", inv_id, "with length", length)
-                
-                newdata = connection.read(length + 3)  # Read 'length' bytes + 2 bytes CRC + 1 byte ETX
-                
-                if not newdata:                     # If we get a timeout, discard data
-                    return None
-                
-                data.extend(newdata)                # Append data to buffer and return the buffer
-                return data
-                
+    decode_start = monotonic()
+    rvals = decode_response(data)       # Process message
+        
+    time = datetime.datetime.fromtimestamp(wall) if wall else datetime.datetime.now()   # Current time
+    now = received or monotonic()
 
-            elif debugging:
-                print("Received STX 0x02, but invalid ENQ/ACK:", data[0])
-                
-            return None
-                
-    elif data and debugging:
-        print("Ignoring byte:", data[0])
+    if not rvals:
+        return                          # No reply found in serial data
         
-    return None
+    inv_id = rvals['inv_id']
+    inv_idx = invindex.get(inv_id)
+    if inv_idx is None:
+        return                          # Not one of our inverters
     
+    cmd = rvals['cmd']
+    subcmd = rvals['subcmd']
+    
+    data_offset = rvals['data_offset']
+    data_length = rvals['data_length']
+                  
+    if debugging:
+        print ("Found reply block for inverter ID", inv_id, "command", cmd, "subcommand", subcmd, "data length", data_length)
+        
+    start = data_offset                         # Start of the actual data
 
-def decode_response (data):
-
-    """ 
-    Try to decode an inverter-messages from serial data and return 
-    a dictionary with message parameters (including length, inverter_id, 
-    command, subcommand).
-    Checks message validity, consistency and CRC, and returns None 
-    if a message is not valid. Request-messages are parsed, but are 
-    currently not returned. 
-    """
+    if debugging:
+        print (time.isoformat(), "Data length:", data_length)
+        
+    # Look for a reply to command 0x60 subcommand 0x01, in a layout we know
     
-    try:
+    dec = None
+    if cmd == 0x60 and subcmd == 0x01:
+        dec = decoder.lookup(data, start, data_length)
     
-        stx = data[0]
-        enqack = data[1]
-        
-        if stx != 0x02:
-            if verbose:
-                print("Invalid message, STX =", stx)
-            return None
-                        
-        if enqack != 0x05 and enqack != 0x06:
-            if verbose:
-                print("Invalid message, ENQ/ACK =", enqack)
-            return None
+    if dec:
         
-        inv_id = data[2]
-        length = data[3]
+        # We have a data block, unpack it and do something with the data
         
-        if (len(data)) < length + 4 + 3:    # should be 4 bytes (STX + ACK + ID + LEN) + data length + 3 bytes (CRC16 + ETX) 
-            if verbose:
-                print("Incomplete data block of", len(data), "bytes, should be", length + 7, "bytes")
-            return None
+        if debugging:
+            print("Unpacking", dec.name, "data block")
         
-        cmd = data[4]                   # Command ID
-        subcmd = data[5]                # Subcommand ID
+        identity = identities.get(inv_id, dec, data, start)    # Only decoded if the identity bytes changed
+        serial = identity.serial                # Get the inverter serial number
+
+        # Update total energy count for this inverter, without unpacking the rest
         
-        data_offset = 6                 # Start of data
-        data_length = length - 2        # Length of data
+        if "energytotal" in dec.index:
+            total_energy_Wh[inv_idx] = dec.select(totalfield).decode(data, start).energytotal * 1000
+            if debugging:
+                print("Inverter", serial, "reports", total_energy_Wh[inv_idx], "Wh total energy")
         
-        crc_lsb = data[4 + length]      # Least-significant byte of CRC-16 over preceding bytes after STX
-        crc_msb = data[4 + length + 1]  # Most-significant byte of CRC-16 over preceding bytes after STX
+        metrics.inc('decode_seconds_total', monotonic() - decode_start)
         
-        etx = data[4 + length + 2]      # ETX-byte to signify end of message, should be 0x03
+        if cache:                               # Every reply, for local clients
+            cache.put(0, inv_id, dec, data, start, time.timestamp(), now)
+                                
+        first_sample = not serials[inv_idx]
+        serials[inv_idx] = serial
+        if ringtiers:
+            if not rings[inv_idx]:
+                rings[inv_idx] = ringstore.RingStore(dec, ringtiers, basepath + str(inv_id) + "-" + serial)
+        elif storage:
+            open_writer(inv_idx, inv_id, serial, dec)
         
-        rvals = {'enqack': enqack, 'inv_id': inv_id, 'length': length, 'cmd': cmd, 'subcmd': subcmd, \
-                 'data_offset': data_offset, 'data_length': data_length}
+        if aggregate:                           # Every reply counts, not only the stored samples
+            if not summaries[inv_idx]:
+                summaries[inv_idx] = aggregates.Summary(dec, basepath + str(inv_id) + "-" + serial)
+            with metrics.timer('storage_seconds_total'):
+                summaries[inv_idx].add(time, summaries[inv_idx].selection.decode(data, start))
         
-        if etx != 0x03:                         # ETX isn't 0x03, data probably isn't valid
-            
+        if first_sample and reporting:
             if verbose:
-                print("ETX at", length + 2, "is", etx, "but should be 3")
-                print(rvals)
+                print("Initial report of energy total to server, inverter index", inv_idx)
+            reports.init(inv_idx, serial)
+            reports.put(inv_idx, total_energy_Wh[inv_idx])
+
+
+        # Determine if it's time to store a new sample and/or write our data
+        
+        t_log = 0
+        if lastlogtime:
+            t_log = now - lastlogtime               # Time since last data written
             
-            return None
+        if debugging:
+            print("Seconds since last write:", round(t_log))
+            print("Next write due in:", round(loginterval - t_log))
             
-        else:                                   # ETX is 0x03, we probably have a valid data block
+        if sample if sample is not None else polls.sample_due(inv_id, now):
             
-            crc_calc = crc16.calcData(data[1 : 4 + length])     # Calculate CRC-16 over message, excluding STX
-            crc_msg = crc_msb << 8 | crc_lsb                    # Compare with CRC transmitted at end of message
+            # It's time to store a sample
             
-            if crc_calc != crc_msg:
-                
-                print("WARNING: CRC-16 is", hex(crc_calc), " but should be", hex(crc_msg))
-                return None
-                
-            else:
+            if verbose:
+                print("Storing sample")
+                print("Next write due in:", round(loginterval - t_log))
             
-                if enqack == 0x05:                 # ENQ, marks start of request message
-                    if debugging:
-                        print("Found request-message for inverter", inv_id, "with length", length, "and CMD", cmd, "SUB", subcmd)
-                    return None                     # Currently we do not return requests, only replies
-        
+            if ringtiers or storage:
+                with metrics.timer('decode_seconds_total'):
+                    u = dec.decode(data, start)     # Unpack the struct into a record of variables
+                    subset = dec.subset(u)          # Get a subset of the data, without serial and version numbers
                 if debugging:
-                    print("Found valid response:", rvals);
+                    print(u)
+                    print("Subset:", subset)
                 
-                return rvals;
+            if ringtiers:                                                   # Consolidate in RAM, tiers are written as they fill
+                with metrics.timer('storage_seconds_total'):
+                    rings[inv_idx].add(time.timestamp(), u)
+            elif storage:
+                if storage in ("binary", "delta"):
+                    samples[inv_idx].append((time, u))                      # Store raw record in list
+                else:
+                    samples[inv_idx].append([time.isoformat()] + subset)    # Store sample in list
+                if samplelog:                                               # Log sample, in case we crash
+                    seq = samplelog.append(time.timestamp(), 0, inv_id, dec.name, data[start:start + dec.size])
+                    if firstseq[inv_idx] is None:
+                        firstseq[inv_idx] = seq
+                csvwriter_raw[inv_idx].writerow([time.isoformat()] + list(u))   # Write all samples directly to temporary file (on RAM-disk)
+            if adaptive and sample is None:                                 # The reader process adapts its own scheduler
+                adapt_polling(inv_id, dec, data, start, now)
+            polls.sampled(inv_id, now)                                      # Update last sample time
+
+        if lastlogtime == 0 or t_log >= loginterval or (samplelog and samplelog.pending >= logbytes):
+            if verbose:
+                print("Update time of last data write")
+            if (lastlogtime):
+                write_samples(True)
+            lastlogtime = monotonic()   # Update last log time
             
-    except:
+    else:
         
-        print("Error decoding response:", str(sys.exc_info()[0]))
-        return None
+        # Data did not match any known struct
         
+        metrics.inc('unknown_blocks_total', bus=0, inverter=inv_id)
+        if verbose:
+            print ("Data did not match struct.")
 
-            
 
-while True:     # Main loop
+def handle_frame (data, received, latency=None, wall=None, sample=None):
+    
+    """ Count a message seen on the bus, and process it """
+    
+    if captures:
+        captures.append(0, received, wall or datetime.datetime.now().timestamp(), data)
+    if listenonly:
+        latency = sniff.observe(data, received)     # Pair requests of the other master with replies
+        if data[1] == framing.ENQ:
+            metrics.inc('observed_requests_total', bus=0, inverter=data[2])
+    if latency is not None:
+        metrics.observe('reply_latency_seconds', latency, bus=0, inverter=data[2])
+    if data[1] == framing.ACK:
+        metrics.inc('replies_total', bus=0, inverter=data[2])
+        metrics.inc('reply_bytes_total', len(data), bus=0, inverter=data[2])
+    process_message(data, received, wall, sample)
+
+
+def handle_record (record):
+    
+    """ Handle a message or time-out from the ring buffer """
+    
+    kind, inv_id, data, received, wall, latency = record
+    if kind == framering.TIMEOUT:
+        metrics.inc('timeouts_total', bus=0, inverter=inv_id)
+    else:
+        handle_frame(data, received, latency, wall, None if listenonly else kind == framering.SAMPLE)
 
-    data = None
 
-    while not data:
-        data = get_message(connection, 1.0)   # Try to read a message, with a 1-second time-out
-            
-    rvals = decode_response(data)       # Process message
-        
-    time = datetime.datetime.now()      # Current time
+def print_summary ():
+    
+    global lastsummary
+    
+    if summaryinterval and monotonic() - lastsummary >= summaryinterval:
+        print(metrics.summary())
+        if listenonly:
+            print(sniff.summary())
+        elif adaptive and not busreader:        # The reader process prints its own
+            print(polls.summary())
+        lastsummary = monotonic()
 
-    if rvals:
+
+def adapt_polling (inv_id, dec, data, start, now):
+    
+    """ With adaptive polling, let the scheduler see the power and feed-in time in a sample """
+    
+    names = tuple(name for name in polls.watched if name in dec.index)
+    if names:
+        polls.adapt(inv_id, dec.select(names).decode(data, start)._asdict(), now)
+
+
+def forward_frame (data, received, latency):
+    
+    """ In the reader process: decide if a reply should be sampled, and pass the message on """
+    
+    kind = framering.FRAME
+    if not listenonly and data[1] == framing.ACK and data[4:6] == b'\x60\x01' and polls.sample_due(data[2], received):
+        if adaptive:
+            dec = decoder.lookup(data, 6, data[3] - 2)
+            if dec:
+                adapt_polling(data[2], dec, data, 6, received)
+        polls.sampled(data[2], received)        # Schedule the next request
+        kind = framering.SAMPLE
+    if not ring.put(kind, data[2], data, received, datetime.datetime.now().timestamp(), latency) and verbose:
+        print("Ring buffer full, dropped message from bus ID", data[2])
+
+
+def poll_bus (forward, timed_out, idle):
+    
+    """ 
+    Main loop: wait until either serial data arrives or the next request is due.
+    Every valid message is passed to forward(data, received, latency), and the
+    bus ID of every unanswered request to timed_out(). idle() is called at
+    least every second.
+    """
+    
+    selector = selectors.DefaultSelector()
+    selector.register(connection.fileno(), selectors.EVENT_READ)
+    
+    while True:
         
-        last_data = time                # Update time of last data read
+        if listenonly:
+            timeout = 1
+        else:
+            timeout = min(1, max(0, polls.next_deadline() - monotonic()))
         
+        if selector.select(timeout):
+            for data in reader.read(0):         # Non-blocking read of all available data
+                received = monotonic()
+                latency = None
+                if not listenonly:
+                    latency = polls.received(data[2], data[1] == framing.ENQ, received)
+                forward(data, received, latency)
         
-        inv_id = rvals['inv_id']
-        inv_idx = inv_id - 1
+        idle()
         
-        cmd = rvals['cmd']
-        subcmd = rvals['subcmd']
+        if listenonly:
+            continue
         
-        data_offset = rvals['data_offset']
-        data_length = rvals['data_length']
-                      
-        if debugging:
-            print ("Found reply block for inverter ID", inv_id, "command", cmd, "subcommand", subcmd, "data length", data_length)
-            
-        start = data_offset                         # Start of the actual data
-
-        b = bytes(data[start:start + structlen])    # Get a block of bytes corresponding to the struct 
-        if debugging:
-            print (time.isoformat(), "Data length:", len(b))
-            
-        # Look for a reply to command 0x60 subcommand 0x01
+        # If we haven't seen any data or reply in a while, send a request
         
-        if len(b) == structlen and cmd == 0x60 and subcmd == 0x01:
-            
-            # We have a data block, unpack it and do something with the data
-            
-            if debugging:
-                print("Unpacking data block")
-            
-            try:
-                u = struct.unpack(structstr, b)     # Unpack the struct into a list of variables
-                serial = str(u[1], "ascii")         # Get the inverter serial number
-                if debugging:
-                    print(u)                    
-                
-            except:
-                error = sys.exc_info()[0]
-                print(time(), str(error), "while decoding inverter data block")
+        unanswered = polls.pending
+        inv_id = polls.pop_due()
+        if inv_id:
+            if unanswered is not None:
+                timed_out(unanswered)
+            send_request(connection, inv_id, b'\x60\x01')   # Send request for a data block (command 96 subcommand 1)
 
 
-            # Update total energy count for this inverter
-            
-            total_energy_Wh[inv_idx] = u[varlookup["energytotal"]] * 1000
-            if debugging:
-                print("Inverter", serial, "reports", total_energy_Wh[inv_idx], "Wh total energy")
-            
-                                    
-            csvw = csvwriter_subset[inv_idx]    # Get output file object
-            
-            if not csvw:                        
-                # Open a CSV-file for this serial, if not already done
-                fname = basepath + str(inv_id) + "-" + serial + ".csv"
-                print("Will write to" + fname)
-                write_header = True
-                if os.path.isfile(fname):
-                    write_header = False        # Don't write header if file exists
-                ofile = open(fname, "a")        # Append data
-                csvw = csv.writer(ofile, delimiter='\t')
-                csvwriter_subset[inv_idx] = csvw
-                if write_header:
-                    csvw.writerow(["time"] + varheader[12:])    # Write header line
-                if reporting:
-                    if verbose:
-                        print("Initial report of energy total to server, inverter index", inv_idx)
-                    report.init(inv_idx, serial)
-                    report.send_total(inv_idx, total_energy_Wh[inv_idx])
-                         
-            subset = list(u[12:])           # Get a subset of the data, without serial and version numbers
-            subset[25] = hex(subset[25])    # Variable with unknown meaning, store as hex value
-            subset[26] = hex(subset[26])    # Variable with unknown meaning, store as hex value
+def read_bus (parent):
+    
+    """ The reader process: poll the inverters, and pass every message on through the ring buffer """
+    
+    def reader_idle ():
+        global lastsummary
+        ring.stats.update(reader)
+        if adaptive and summaryinterval and monotonic() - lastsummary >= summaryinterval:
+            print(polls.summary())
+            lastsummary = monotonic()
+        if os.getppid() != parent:          # Don't keep polling if the main process is gone
+            sys.exit(1)
+    
+    signal.signal(signal.SIGINT, signal.SIG_IGN)       # The main process decides when we stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    poll_bus(forward_frame, lambda inv_id: ring.put(framering.TIMEOUT, inv_id), reader_idle)
 
-            if debugging:
-                print("Subset:", subset)
-            
-            # Determine if it's time to store a new sample and/or write our data
-            
-            t_sample = time - lastsampletime[inv_idx]   # Time since last sample stored
-            t_log = time - time                         # (Set t_log to zero)
-            if lastlogtime and lastlogtime < time:
-                t_log = time - lastlogtime              # Time since last data written
-                
-            if debugging:
-                print("Seconds since last sample:", t_sample.seconds)
-                print("Next sample due in:", sampleinterval - t_sample.seconds)
-                print("Seconds since last write:", t_log.seconds)
-                print("Next write due in:", loginterval - t_log.seconds)
-                
-            if round(t_sample.seconds) >= sampleinterval:
-                
-                # It's time to store a sample
-                
-                if verbose:
-                    print("Storing sample")
-                    print("Seconds since last sample:", t_sample.seconds)
-                    print("Next write due in:", loginterval - t_log.seconds)
-                    
-                samples[inv_idx].append([time.isoformat()] + subset)            # Store sample in list
-                csvwriter_raw[inv_idx].writerow([time.isoformat()] + list(u))   # Write all samples directly to temporary file (on RAM-disk)
-                lastsampletime[inv_idx] = datetime.datetime.now()               # Update last sample time
 
-            if lastlogtime == 0 or round(t_log.seconds) >= loginterval:
-                if verbose:
-                    print("Update time of last data write")
-                if (lastlogtime):
-                    write_samples(True)
-                lastlogtime = datetime.datetime.now()   # Update last log time
-                
+def consume ():
+    
+    """ Main loop with a reader process: handle the messages in the ring buffer """
+    
+    while not stopping:
+        record = ring.get(1)
+        if record:
+            handle_record(record)
+        print_summary()
+        if not busreader.is_alive():
+            print("Reader process stopped with exit code", busreader.exitcode)
+            shutdown(1)
+    shutdown()
+
+
+def configure (fname):
+    
+    """ Override the settings with the ones in a JSON configuration file """
+    
+    global siteconfig, reportqueuepath, sampleintervals
+    
+    with open(fname) as f:
+        config = json.load(f)
+    
+    for key, value in config.items():
+        if key not in settings:
+            raise ValueError("Unknown setting " + key + " in " + fname)
+        globals()[key] = value
+    configured.update(config)
+    
+    if 'basepath' in config:                    # Paths in basepath follow it, unless they are set too
+        if 'siteconfig' not in config:
+            siteconfig = basepath + "site.json"
+        if 'reportqueuepath' not in config:
+            reportqueuepath = basepath + "report-queue.json"
+    sampleintervals = {int(inv_id): interval for inv_id, interval in sampleintervals.items()}
+
+
+def load_backends ():
+    
+    """ Import the modules for the storage, reporting, capture and cache options that are enabled """
+    
+    global aggregates, binstore, capture, deltastore, latest, reportqueue, ringstore, wal, report, reporting, ringtiers
+    
+    try:
+        import report
+        reporting = True
+    except ImportError:
+        report = None
+    if reporting or reporturl:
+        import reportqueue
+    
+    if ringtiers:
+        import ringstore
+        if ringtiers is True:
+            ringtiers = ringstore.TIERS
+    elif storage:
+        import binstore
+        import deltastore
+        import wal                              # Also has the CSV helpers
+    if aggregate:
+        import aggregates
+    if capturepath:
+        import capture
+    if cacheaddress:
+        import latest
+
+
+def read_siteconfig (fname):
+    
+    """
+    Return (port, baud rate, bus IDs) of a bus in a site configuration, None if
+    there is no usable bus. With a port in the configuration file, the bus on
+    that port is used, otherwise the first one.
+    """
+    
+    try:
+        with open(fname) as f:
+            buses = json.load(f).get('buses')
+        if not isinstance(buses, list) or not buses:
+            raise ValueError("no buses")
+        if 'port' in configured:
+            site = next((bus for bus in buses if isinstance(bus, dict) and bus.get('port') == port), None)
+            if site is None:
+                print("Site configuration", fname, "has no bus on", port + ", not using it")
+                return None
         else:
-            
-            # Data did not match our struct
-            
-            if verbose:
-                print ("Data did not match struct.")
-                        
+            site = buses[0]
+        busids = site['inverters']
+        if not isinstance(site['port'], str) or not isinstance(busids, list) or not busids or \
+                not all(isinstance(inv_id, int) and 1 <= inv_id <= 254 for inv_id in busids):
+            raise ValueError("invalid port or bus IDs")
+        return site['port'], site.get('baudrate', baudrate), busids
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as error:
+        print("Could not use site configuration", fname + ":", str(error))
+        return None
+
+
+def setup ():
+    
+    """ Load the backends, open the serial port and the outputs, and recover samples from the write-ahead log """
+    
+    global busids, inverters, invindex, port, baudrate, connection, reader, report, reporting, reports
+    global captures, cache, samplelog, polls, sniff
+    
+    load_backends()
+    import serial
+    
+    busids = list(range(1, inverters + 1))     # Bus ID of each inverter
+    
+    site = read_siteconfig(siteconfig) if siteconfig and os.path.isfile(siteconfig) else None
+    if site:
+        if 'baudrate' in configured and site[1] != baudrate:
+            print("Using the baud rate in the configuration file,", baudrate, "instead of", site[1], "from", siteconfig)
+        else:
+            baudrate = site[1]
+        port, busids = site[0], site[2]
+        print("Site configuration", siteconfig + ":", len(busids), "inverters on", port, "at", baudrate, "baud")
+    
+    inverters = len(busids)
+    invindex = {inv_id: idx for idx, inv_id in enumerate(busids)}  # Index in the lists below for each bus ID
+    
+    connection = serial.Serial(port, baudrate, timeout=0.2);        # Serial device
+    reader = framing.FrameReader(connection)                        # Buffered message reader for this connection
+    
+    protocol.verbose = verbose
+    protocol.debugging = debugging
+    
+    # Energy totals are reported by a background worker, so a slow server can't stall polling
+    
+    if not reporting and reporturl:
+        report = reportqueue.HttpReport(reporturl)
+        reporting = True
+    
+    if reporting:
+        print("Will report energy totals to an external server")
+        reports = reportqueue.ReportQueue(report.send_total, report.init, reportqueuepath)
+    else:
+        print("Will NOT report energy totals to an external server")
+    
+    if debugging:
+        print(varheader)
+    
+    # Build lists
+    
+    for inv in range(0, inverters):
+        samples.append(list())
+        firstseq.append(None)
+        total_energy_Wh.append(0) 
+        total_energy_Wh_prev.append(0)
+        serials.append(None)
+        rings.append(None)
+        summaries.append(None)
+        csvwriter_subset.append(0)   
+        outfiles.append(None)
+        csvfile = open('/tmp/inv' + str(busids[inv]) + '.csv', "a")
+        csvwriter_raw.append(csv.writer(csvfile, delimiter='\t'))
+    
+    if capturepath:
+        captures = capture.CaptureWriter(capturepath)
+    if cacheaddress:
+        cache = latest.LatestCache(cachemaxage)
+    
+    # Register signal handlers
+    
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
+    # Open the write-ahead log, and recover samples we lost when we stopped
+    
+    if walpath and storage and not ringtiers:
+        samplelog = wal.WriteAheadLog(walpath, walsize, walsync)
+        replay_samples()
+    
+    if adaptive and not listenonly:
+        polls = scheduler.AdaptiveScheduler(busids, sampleinterval, sampleintervals, replytimeout, turnaround,
+                                            floor=pollfloor, ceiling=pollceiling, budget=busbudget, ramp=rampthreshold)
+        if not separatereader:
+            for inv_id in busids:
+                metrics.gauge('poll_interval_seconds', lambda inv_id=inv_id: polls.effective(inv_id), bus=0, inverter=inv_id)
+            metrics.gauge('bus_utilisation_ratio', polls.utilisation, bus=0)
     else:
+        polls = scheduler.PollScheduler(busids, sampleinterval, sampleintervals, replytimeout, turnaround)
+    sniff = sniffer.BusSniffer(replytimeout)
+
+
+def run ():
+    
+    """ Start the reader process if separatereader is set, serve the metrics, and run the main loop """
+    
+    global framering, ring, busreader
+    
+    if listenonly:
+        print("Listen-only mode, will not send any requests")
+    
+    if separatereader:
+        
+        # Read the serial port in a separate process, which passes messages through shared memory
         
-        # No replies found in serial data, continue main loop
+        import framering
+        import multiprocessing
         
-        continue
+        context = multiprocessing.get_context('fork')
+        ring = framering.FrameRing(ringsize, context)
+        busreader = context.Process(target=read_bus, args=(os.getpid(),), name='busreader', daemon=True)
+        busreader.start()
+        print("Reading the serial port in process", busreader.pid)
+        metrics.watch(ring.stats, bus=0)
+        metrics.gauge('ring_occupancy_ratio', ring.occupancy)
+        metrics.gauge('ring_overruns', ring.overruns)
+        
+    else:
+        metrics.watch(reader, bus=0)
     
-            
-    # Check if we should request data from the inverters
-                
-    t_data = time - last_data
+    if metricsport:
+        metrics.serve(metricsport)
+    if cache:
+        latest.serve(cache, cacheaddress)
+        metrics.gauge('cache_clients', lambda: cache.clients)
     
-    for inv in range(0, inverters):        
-        # If we haven't seen any data or reply in a while, send a request
-        t_sample = time - lastsampletime[inv]
-        if (t_data.seconds >= 1 and t_sample.seconds >= sampleinterval):          
-            send_request(connection, inv + 1, b'\x60\x01')   # Send request for a data block (command 96 subcommand 1)
-            # TODO: Check if inverters wait until the bus is free before sending data... 
-            
+    if busreader:
+        consume()
+    else:
+        poll_bus(lambda data, received, latency: handle_frame(data, received, latency),
+                 lambda inv_id: metrics.inc('timeouts_total', bus=0, inverter=inv_id),
+                 print_summary)
+
+
+def main ():
+    if len(sys.argv) > 1:
+        configure(sys.argv[1])
+    setup()
+    run()
+
+
+if __name__ == "__main__":
+    main()
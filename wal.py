@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+
+# wal.py
+
+# Crash-safe write-ahead log for samples that have not been written
+# to permanent storage yet
+
+# Copyright (c) 2016-2018 Levien van Zon (levien at zonnetjes.net)
+
+# MIT License, see the LICENSE file for details
+
+# The log is a preallocated ring file. The first 4096 bytes hold a header:
+#
+#  - 8 bytes magic, b'SLVWAL01'
+#  - 4 bytes capacity of the ring in bytes (little-endian)
+#  - 8 bytes checkpoint: sequence number of the last sample in permanent storage
+#
+# followed by the ring, containing 8-byte aligned records:
+#
+#  - 2 bytes record magic, 0x5741
+#  - 2 bytes payload length
+#  - 8 bytes sequence number
+#  - 4 bytes CRC-32 of the sequence number and payload
+#  - payload: sample time (double), bus index, bus ID, length of the decoder
+#    name, decoder name, and the data block as the inverter sent it
+#
+# Appending a sample is a single pwrite() to a preallocated file, so on
+# tmpfs it costs no flash writes at all, and with sync enabled the file
+# can live on flash without metadata updates. On start-up, all records
+# newer than the checkpoint are replayed.
+
+
+import collections
+import datetime
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'SLVWAL01'
+HEADER = struct.Struct('<8sIQ')         # Magic, capacity, checkpoint
+HEADER_SIZE = 4096                      # Start of the ring
+RECORD = struct.Struct('<HHQI')         # Record magic, payload length, sequence number, CRC-32
+RECORD_MAGIC = 0x5741
+SAMPLE = struct.Struct('<dHHB')         # Time, bus index, bus ID, decoder name length
+ALIGN = 8
+
+
+def _crc (seq, payload):
+    return zlib.crc32(payload, zlib.crc32(struct.pack('<Q', seq)))
+
+
+class WriteAheadLog:
+
+    """ Ring file with samples waiting to be written to permanent storage """
+
+    def __init__ (self, fname, capacity=4*1024*1024, sync=False):
+
+        self.fname = fname
+        self.capacity = -(-capacity // 4096) * 4096     # Whole pages
+        self.sync = sync                                # fdatasync() after every append
+
+        self.fd = os.open(fname, os.O_RDWR | os.O_CREAT, 0o644)
+
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) == HEADER.size and header[:8] == MAGIC:
+            magic, self.capacity, self.checkpoint_seq = HEADER.unpack(header)
+        else:
+            self.checkpoint_seq = 0
+            self._write_header()
+
+        if os.fstat(self.fd).st_size < HEADER_SIZE + self.capacity:
+            try:
+                os.posix_fallocate(self.fd, 0, HEADER_SIZE + self.capacity)
+            except (AttributeError, OSError):
+                os.ftruncate(self.fd, HEADER_SIZE + self.capacity)
+
+        self.records = self._scan()
+        self.seq = max([self.checkpoint_seq] + [r[0] for r in self.records])
+        self.pos = HEADER_SIZE
+        for seq, pos, size, payload in self.records:
+            if seq == self.seq:
+                self.pos = pos + size
+        self.unsaved = collections.deque(sorted((seq, size) for seq, pos, size, payload in self.records
+                                                if seq > self.checkpoint_seq))
+        self.pending = sum(size for seq, size in self.unsaved)      # Bytes of samples after the checkpoint
+        self.overflow = False
+
+    def _write_header (self):
+        os.pwrite(self.fd, HEADER.pack(MAGIC, self.capacity, self.checkpoint_seq), 0)
+
+    def _scan (self):
+
+        """ Return (seq, position, size, payload) for every valid record in the ring """
+
+        ring = os.pread(self.fd, self.capacity, HEADER_SIZE)
+        marker = struct.pack('<H', RECORD_MAGIC)
+        records = []
+        pos = 0
+
+        while True:
+            pos = ring.find(marker, pos)
+            if pos < 0 or pos + RECORD.size > len(ring):
+                break
+            if pos % ALIGN:
+                pos += ALIGN - pos % ALIGN
+                continue
+            magic, length, seq, crc = RECORD.unpack_from(ring, pos)
+            payload = ring[pos + RECORD.size:pos + RECORD.size + length]
+            if len(payload) == length and length >= SAMPLE.size and _crc(seq, payload) == crc:
+                size = -(-(RECORD.size + length) // ALIGN) * ALIGN
+                records.append((seq, HEADER_SIZE + pos, size, payload))
+                pos += size
+            else:
+                pos += ALIGN
+
+        return records
+
+    def replay (self):
+
+        """
+        Return (time, bus index, bus ID, decoder name, data block) for every
+        sample that was logged after the last checkpoint, in the original order
+        """
+
+        samples = []
+        seen = set()
+
+        for seq, pos, size, payload in sorted(self.records):
+            if seq <= self.checkpoint_seq or seq in seen:
+                continue
+            seen.add(seq)
+            time, bus_idx, inv_id, namelen = SAMPLE.unpack_from(payload)
+            name = payload[SAMPLE.size:SAMPLE.size + namelen].decode('ascii')
+            samples.append((time, bus_idx, inv_id, name, payload[SAMPLE.size + namelen:]))
+
+        self.records = []
+        return samples
+
+    def append (self, time, bus_idx, inv_id, name, block):
+
+        """ Log a sample, and return its sequence number """
+
+        name = name.encode('ascii')
+        payload = SAMPLE.pack(time, bus_idx, inv_id, len(name)) + name + bytes(block)
+        self.seq += 1
+        record = RECORD.pack(RECORD_MAGIC, len(payload), self.seq, _crc(self.seq, payload)) + payload
+        record = record.ljust(-(-len(record) // ALIGN) * ALIGN, b'\0')
+
+        size = len(record)
+
+        if self.pos + size > HEADER_SIZE + self.capacity:     # Wrap around
+            skip = HEADER_SIZE + self.capacity - self.pos
+            os.pwrite(self.fd, bytes(skip), self.pos)
+            size += skip
+            self.pos = HEADER_SIZE
+
+        if self.pending + size > self.capacity and not self.overflow:
+            print("WARNING: write-ahead log", self.fname, "is full, overwriting old samples", file=sys.stderr)
+            self.overflow = True
+
+        os.pwrite(self.fd, record, self.pos)
+        if self.sync:
+            os.fdatasync(self.fd)
+
+        self.pos += len(record)
+        self.pending += size
+        self.unsaved.append((self.seq, size))
+        return self.seq
+
+    def checkpoint (self, seq=None):
+
+        """ Mark all samples up to sequence number seq (default: all) as permanently stored """
+
+        if seq is None:
+            seq = self.seq
+        if seq <= self.checkpoint_seq:
+            return
+
+        while self.unsaved and self.unsaved[0][0] <= seq:
+            self.pending -= self.unsaved.popleft()[1]
+
+        self.checkpoint_seq = seq
+        self.overflow = False
+        self._write_header()
+        if self.sync:
+            os.fdatasync(self.fd)
+
+    def close (self):
+        os.close(self.fd)
+
+
+def csv_last_time (fname):
+
+    """
+    Return the time (ISO string) of the last complete row in a tab-separated
+    sample file, or None. A row cut off by a power failure is skipped.
+    """
+
+    try:
+        with open(fname, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            start = max(0, f.tell() - 4096)
+            f.seek(start)
+            lines = f.read().split(b'\n')
+    except OSError:
+        return None
+
+    lines.pop()                         # Empty, or a row that was not written completely
+    if start and lines:
+        lines.pop(0)                    # Probably only the end of a row
+
+    for line in reversed(lines):
+        time = line.split(b'\t', 1)[0].decode('ascii', 'replace')
+        try:
+            datetime.datetime.fromisoformat(time)
+        except ValueError:
+            continue                    # The header, or a damaged row
+        return time
+    return None